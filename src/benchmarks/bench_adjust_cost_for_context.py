@@ -0,0 +1,73 @@
+import argparse
+import logging
+
+import numpy as np
+
+from src.benchmarks.bench_find_different_pixels import timeit
+from src.metrics.visual_score import adjust_cost_for_context
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def adjust_cost_for_context_loop(cost_matrix, consecutive_bonus=1.0, window_size=20):
+    # the previous implementation, which loops over every cell, kept as the reference
+    if window_size <= 0:
+        return cost_matrix
+
+    n, m = cost_matrix.shape
+    adjusted_cost_matrix = np.copy(cost_matrix)
+
+    for i in range(n):
+        for j in range(m):
+            bonus = 0
+            if adjusted_cost_matrix[i][j] >= -0.5:
+                continue
+            nearby_matrix = cost_matrix[max(0, i - window_size):min(
+                n, i + window_size + 1), max(0, j - window_size):min(m, j + window_size + 1)]
+            flattened_array = nearby_matrix.flatten()
+            sorted_array = np.sort(flattened_array)[::-1]
+            sorted_array = np.delete(sorted_array, np.where(
+                sorted_array == cost_matrix[i, j])[0][0])
+            top_k_elements = sorted_array[- window_size * 2:]
+            sum_top_k = np.sum(top_k_elements)
+            bonus = consecutive_bonus * sum_top_k
+            adjusted_cost_matrix[i][j] += bonus
+    return adjusted_cost_matrix
+
+
+def make_cost_matrix(n: int, m: int, match_ratio: float = 0.02, seed: int = 0) -> np.ndarray:
+    """
+    Returns a cost matrix like the negated text similarities of two pages, with mostly
+    weak similarities, strong ones near the diagonal, and `match_ratio` of strong ones
+    elsewhere.
+    """
+    rng = np.random.default_rng(seed)
+    cost_matrix = -0.5 * rng.random((n, m))
+    diagonal = np.arange(min(n, m))
+    cost_matrix[diagonal, diagonal] = -0.5 - 0.5 * rng.random(len(diagonal))
+    others = rng.random((n, m)) < match_ratio
+    cost_matrix[others] = -0.5 - 0.5 * rng.random(int(others.sum()))
+    return cost_matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=300,
+                        help='The number of blocks of both pages')
+    parser.add_argument('--window_sizes', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--consecutive_bonus', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of every implementation, the best one is reported')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cost_matrix = make_cost_matrix(args.blocks, args.blocks)
+    logger.info(f"Adjusting a {args.blocks}x{args.blocks} cost matrix with {int((cost_matrix < -0.5).sum())} strong matches")
+    for window_size in args.window_sizes:
+        loop_time, expected = timeit(adjust_cost_for_context_loop, cost_matrix,
+                                     args.consecutive_bonus, window_size, repeat=args.repeat)
+        vectorized_time, result = timeit(adjust_cost_for_context, cost_matrix,
+                                         args.consecutive_bonus, window_size, repeat=args.repeat)
+        assert np.array_equal(expected, result), "Vectorized matrix differs from the loop"
+        logger.info(f"window_size={window_size}: loop {loop_time:.4f}s, vectorized {vectorized_time:.4f}s, "
+                    f"speedup {loop_time / vectorized_time:.1f}x")
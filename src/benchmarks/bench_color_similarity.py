@@ -0,0 +1,54 @@
+import argparse
+import logging
+
+import numpy as np
+
+from src.benchmarks.bench_find_different_pixels import timeit
+from src.metrics.color_similarity import color_similarities_ciede2000
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def colormath_similarities(rgbs1, rgbs2) -> np.ndarray:
+    """
+    Scores every pair with colormath objects, one pair at a time, which is how the
+    visual score computed colour similarities before.
+    """
+    from colormath.color_conversions import convert_color
+    from colormath.color_diff import delta_e_cie2000
+    from colormath.color_objects import LabColor, sRGBColor
+
+    # colormath still calls np.asscalar, which was removed from numpy
+    setattr(np, "asscalar", lambda a: a.item())
+    similarities = []
+    for rgb1, rgb2 in zip(rgbs1, rgbs2):
+        lab1 = convert_color(sRGBColor(*rgb1, is_upscaled=True), LabColor)
+        lab2 = convert_color(sRGBColor(*rgb2, is_upscaled=True), LabColor)
+        similarities.append(max(0, 1 - delta_e_cie2000(lab1, lab2) / 100))
+    return np.array(similarities)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=2000,
+                        help='The number of matched colour pairs')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of every implementation, the best one is reported')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    rng = np.random.default_rng(0)
+    rgbs1 = rng.integers(0, 256, (args.pairs, 3)).tolist()
+    rgbs2 = rng.integers(0, 256, (args.pairs, 3)).tolist()
+
+    vectorized_time, result = timeit(color_similarities_ciede2000, rgbs1, rgbs2, repeat=args.repeat)
+    try:
+        colormath_time, expected = timeit(colormath_similarities, rgbs1, rgbs2, repeat=args.repeat)
+    except ImportError:
+        logger.warning("[Warning] colormath is not installed, only timing the vectorized scores")
+        logger.info(f"{args.pairs} pairs: vectorized {vectorized_time:.4f}s")
+    else:
+        assert np.allclose(expected, result, rtol=0, atol=1e-9), "Vectorized scores differ from colormath"
+        logger.info(f"{args.pairs} pairs: colormath {colormath_time:.4f}s, vectorized {vectorized_time:.4f}s, "
+                    f"speedup {colormath_time / vectorized_time:.1f}x, "
+                    f"max difference {np.abs(expected - result).max():.2e}")
@@ -0,0 +1,78 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+from PIL import Image
+
+from src.metrics.ocr_free_utils import find_different_pixels, find_different_pixels_mask, similar
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def find_different_pixels_loop(image1: np.ndarray, image2: np.ndarray):
+    # the previous implementation, which loops over every pixel, kept as the reference
+    img1 = Image.fromarray(image1)
+    img2 = Image.fromarray(image2)
+    pixels1 = img1.load()
+    pixels2 = img2.load()
+    different_pixels = []
+    for x in range(img1.size[0]):
+        for y in range(img1.size[1]):
+            r1, g1, b1 = pixels1[x, y]
+            r2, g2, b2 = pixels2[x, y]
+            if similar((r1 + 50) % 256, r2) and similar((g1 + 50) % 256, g2) and similar((b1 + 50) % 256, b2):
+                different_pixels.append((y, x))
+    if len(different_pixels) > 0:
+        return np.stack(different_pixels)
+    return None
+
+
+def make_perturbed_pair(width: int, height: int, text_ratio: float = 0.1, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns two random renders, where `text_ratio` of the pixels of the second one are
+    the pixels of the first one shifted by 50 with some noise, like perturbed text.
+    """
+    rng = np.random.default_rng(seed)
+    image1 = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    image2 = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    text = rng.random((height, width)) < text_ratio
+    noise = rng.integers(-8, 9, (height, width, 3))
+    shifted = np.clip((image1 + np.uint8(50)).astype(int) + noise, 0, 255).astype(np.uint8)
+    image2[text] = shifted[text]
+    return image1, image2
+
+
+def timeit(function, *args, repeat: int = 1) -> tuple[float, object]:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=8000)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of the vectorized implementations, the best one is reported')
+    parser.add_argument('--skip_loop', action='store_true',
+                        help='Skip the per-pixel loop, which takes a while on tall pages')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    image1, image2 = make_perturbed_pair(args.width, args.height)
+    logger.info(f"Comparing {args.width}x{args.height} renders")
+
+    mask_time, mask = timeit(find_different_pixels_mask, image1, image2, repeat=args.repeat)
+    coords_time, coords = timeit(find_different_pixels, image1, image2, repeat=args.repeat)
+    logger.info(f"find_different_pixels_mask: {mask_time:.4f}s, {int(mask.sum())} pixels")
+    logger.info(f"find_different_pixels (coordinates): {coords_time:.4f}s")
+
+    if not args.skip_loop:
+        loop_time, loop_coords = timeit(find_different_pixels_loop, image1, image2)
+        assert np.array_equal(loop_coords, coords), "Vectorized coordinates differ from the loop"
+        logger.info(f"Per-pixel loop: {loop_time:.4f}s")
+        logger.info(f"Speedup: {loop_time / mask_time:.1f}x (mask), {loop_time / coords_time:.1f}x (coordinates)")
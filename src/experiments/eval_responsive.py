@@ -6,42 +6,23 @@ import time
 
 import pandas as pd
 
-from src.metrics.visual_score import visual_eval_v3_multi
+from src.metrics.block_store import BlockStore, get_block_store, set_block_store
+from src.metrics.ocr_free_utils import DEFAULT_HTML_PARSER
+from src.metrics.text_similarity import SIMILARITY_MODES, get_similarity_cache_stats, set_similarity_mode
+from src.metrics.colorization_cache import ColorizationCache, get_colorization_cache, set_colorization_cache
+from src.metrics.visual_score import visual_eval_v3_multi_viewports
+from src.utils.async_screenshot import AsyncScreenshotEngine
 from src.utils.logger import setup_logger, suppress_module_logging
+from src.utils.render_service import RenderClient
+from src.utils.render_timings import get_render_timings
+from src.utils.process_pool import SharedMemoryPool, get_process_pool, set_process_pool
+from src.utils.request_interceptor import RequestInterceptor, get_request_interceptor, set_request_interceptor
+from src.utils.screenshot import LoadStrategy, get_clipped_pages
+from src.utils.screenshot_cache import ScreenshotCache, get_screenshot_cache, set_screenshot_cache
+from src.utils.viewport import Viewport
 
 logger: logging.Logger = logging.getLogger(__name__)
 
-class Viewport():
-    def __init__(self, width: int, height: int):
-        self.width = width
-        self.height = height
-
-    def __repr__(self) -> str:
-        return f"{self.width}x{self.height}"
-    
-    def __str__(self) -> str:
-        return f"{self.width}x{self.height}"
-    
-    def __eq__(self, value):
-        if isinstance(value, Viewport):
-            return self.width == value.width and self.height == value.height
-        return False
-
-    def __hash__(self):
-        return hash((self.width, self.height))
-    
-    def to_dict(self) -> dict:
-        return {
-            "width": self.width,
-            "height": self.height
-        }
-    
-    @staticmethod
-    def from_str(viewport_str: str) -> 'Viewport':
-        width, height = map(int, viewport_str.split('x'))
-        return Viewport(width, height)
-    
-
 def read_viewports_from_csv(csv_path: str) -> set[Viewport]:
     logger.info("Reading viewports from csv: %s", csv_path)
     df = pd.read_csv(csv_path)
@@ -52,11 +33,7 @@ def read_viewports_from_csv(csv_path: str) -> set[Viewport]:
     return res
 
 
-def eval_responsive(original_dir: str, generated_dir: str, viewport: Viewport) -> list[dict]:
-    generated_files = os.listdir(generated_dir)
-    # read res dict in json
-    generated_res_dict = {}
-    res_dicts = []
+def load_generated_res_dict(generated_dir: str) -> dict:
     if not os.path.exists(os.path.join(generated_dir, 'res_dict.json')):
         logger.info("res_dict.json does not exist.")
         raise FileNotFoundError(
@@ -64,66 +41,122 @@ def eval_responsive(original_dir: str, generated_dir: str, viewport: Viewport) -
 
     with open(os.path.join(generated_dir, 'res_dict.json'), 'r') as f:
         generated_res_dict = json.load(f)
-    generated_res_dict = {item["id"].split('_', 1)[0]: item for item in generated_res_dict}
+    return {item["id"].split('_', 1)[0]: item for item in generated_res_dict}
 
-    for filename in generated_files:
-        if not filename.endswith('.html'):
-            continue
 
-        if filename.endswith('_p.html'):
-            logger.warning(
-                f"Skipping temporary file: {filename}.")
-            try:
-                os.remove(os.path.join(generated_dir, filename))
-            except Exception as e:
-                logger.error(
-                    f"Error removing temporary file {filename}: {e}")
-            continue
-        if filename.endswith('_p_1.html'):
-            logger.warning(
-                f"Skipping temporary file: {filename}.")
-            try:
-                os.remove(os.path.join(generated_dir, filename))
-            except Exception as e:
-                logger.error(
-                    f"Error removing temporary file {filename}: {e}")
-            continue
+def get_eval_html_paths(original_dir: str, generated_dir: str, filename: str) -> tuple[str, str] | None:
+    """
+    Returns the (generated, original) html paths to evaluate for the given file of the
+    generated directory, or None if the file should not be evaluated.
+    """
+    if not filename.endswith('.html'):
+        return None
 
-        img_id = filename.split('_')[0]
-        original_html_path = os.path.join(
-            original_dir, img_id + '.html')
-        generated_html_path = os.path.join(generated_dir, filename)
-
-        if not os.path.exists(original_html_path):
+    if filename.endswith('_p.html'):
+        logger.warning(
+            f"Skipping temporary file: {filename}.")
+        try:
+            os.remove(os.path.join(generated_dir, filename))
+        except Exception as e:
+            logger.error(
+                f"Error removing temporary file {filename}: {e}")
+        return None
+    if filename.endswith('_p_1.html'):
+        logger.warning(
+            f"Skipping temporary file: {filename}.")
+        try:
+            os.remove(os.path.join(generated_dir, filename))
+        except Exception as e:
             logger.error(
-                f"For {img_id}, original html file does not exist. This should never happen unless you remove data from the original dataset, or you specify the wrong datasets. No evaluation will be done.")
+                f"Error removing temporary file {filename}: {e}")
+        return None
+
+    img_id = filename.split('_')[0]
+    original_html_path = os.path.join(
+        original_dir, img_id + '.html')
+    generated_html_path = os.path.join(generated_dir, filename)
+
+    if not os.path.exists(original_html_path):
+        logger.error(
+            f"For {img_id}, original html file does not exist. This should never happen unless you remove data from the original dataset, or you specify the wrong datasets. No evaluation will be done.")
+        return None
+
+    if not os.path.exists(generated_html_path):
+        logger.error(
+            f"For {img_id}, generated html file does not exist. Probably because that your experiment directory has temporary file ending with _p. Skipping evaluation.")
+        return None
+    return generated_html_path, original_html_path
+
+
+def count_clipped(html_paths) -> int:
+    """
+    Returns the number of screenshots of the given pages clipped at the maximum canvas height so far.
+    """
+    clipped_pages = get_clipped_pages()
+    return sum(clipped_pages.get(html_path, 0) for html_path in html_paths)
+
+
+def to_res_dict(filename: str, result: list, generated_res_dict: dict, clipped: bool = False) -> dict:
+    img_id = filename.split('_')[0]
+    sum_sum_areas, final_score, (size_score, text_score,
+                                 position_score, color_score, clip_score) = result
+    return {
+        "id": img_id,
+        "filename": filename,
+        "sum_sum_areas": sum_sum_areas,
+        "final_score": final_score,
+        "size_score": size_score,
+        "text_score": text_score,
+        "position_score": position_score,
+        "color_score": color_score,
+        "clip_score": clip_score,
+        "try_count": generated_res_dict[img_id]["try_count"],
+        "clipped": clipped,
+    }
+
+
+def eval_responsive_multi_viewport(original_dir: str, generated_dir: str, viewports: set[Viewport], visited: set[tuple[str, str]] = set(), engine: AsyncScreenshotEngine = None, strategy: LoadStrategy = None, block_method="pixel", html_parser: str = DEFAULT_HTML_PARSER):
+    """
+    Evaluates every generated file at all of the given viewports, loading each page once
+    per file instead of once per viewport.
+
+    Parameters:
+        visited (set): (viewport, filename) pairs that have been evaluated and are skipped.
+        engine (AsyncScreenshotEngine): Optional engine to capture the pages concurrently.
+        strategy (LoadStrategy): How the pages are loaded and how long each capture may take.
+        block_method (str): How the text blocks are extracted, see `visual_eval_v3_multi_viewports`.
+        html_parser (str): The BeautifulSoup parser of the "pixel" block method, e.g. "lxml".
+
+    Yields:
+        tuple[str, dict]: The filename, and a mapping of viewport to its res_dict.
+    """
+    generated_files = os.listdir(generated_dir)
+    generated_res_dict = load_generated_res_dict(generated_dir)
+
+    for filename in generated_files:
+        html_paths = get_eval_html_paths(original_dir, generated_dir, filename)
+        if html_paths is None:
             continue
+        generated_html_path, original_html_path = html_paths
 
-        if not os.path.exists(generated_html_path):
-            logger.error(
-                f"For {img_id}, generated html file does not exist. Probably because that your experiment directory has temporary file ending with _p. Skipping evaluation.")
+        pending_viewports = [viewport for viewport in viewports
+                             if (str(viewport), filename) not in visited]
+        if len(pending_viewports) == 0:
+            logger.info(f"Skipping visited file: {filename}.")
             continue
 
-        result = visual_eval_v3_multi(
-            [[generated_html_path], original_html_path], viewport=viewport.to_dict())
-        sum_sum_areas, final_score, (size_score, text_score,
-                                     position_score, color_score, clip_score) = result[0]
-
-        res_dict = {
-            "id": img_id,
-            "filename": filename,
-            "sum_sum_areas": sum_sum_areas,
-            "final_score": final_score,
-            "size_score": size_score,
-            "text_score": text_score,
-            "position_score": position_score,
-            "color_score": color_score,
-            "clip_score": clip_score,
-            "try_count": generated_res_dict[img_id]["try_count"],
-        }
-        logger.info(f"res_dict for {img_id} with viewport {viewport}: {res_dict}")
-        res_dicts.append(res_dict)
-    return res_dicts
+        clipped = count_clipped(html_paths)
+        results = visual_eval_v3_multi_viewports(
+            [[generated_html_path], original_html_path], pending_viewports, engine=engine, strategy=strategy, block_method=block_method, html_parser=html_parser)
+        # the screenshots of all viewports are captured together, so a clipped one flags them all
+        clipped = count_clipped(html_paths) > clipped
+        viewport_res_dicts = {}
+        for viewport, result in results.items():
+            res_dict = to_res_dict(filename, result[0], generated_res_dict, clipped)
+            logger.info(f"res_dict for {res_dict['id']} with viewport {viewport}: {res_dict}")
+            viewport_res_dicts[viewport] = res_dict
+        yield filename, viewport_res_dicts
+
 
 if __name__ == "__main__":
     setup_logger(log_file_prefix="responsive_eval")
@@ -135,6 +168,45 @@ if __name__ == "__main__":
     parser.add_argument('--generated_dir', type=str)
     parser.add_argument('--viewports_dir', type=str,
                         default='src/datasets/viewport')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of pages captured concurrently. 1 captures them one after another.')
+    parser.add_argument('--block_method', type=str, default='pixel', choices=['pixel', 'dom'],
+                        help='Extract text blocks by diffing colour-perturbed renders, or from the DOM geometry of a single render.')
+    parser.add_argument('--html_parser', type=str, default=DEFAULT_HTML_PARSER, choices=['html.parser', 'lxml'],
+                        help='The BeautifulSoup parser the html is colour-perturbed with. lxml is faster, but optional and may nest malformed markup differently.')
+    parser.add_argument('--text_similarity', type=str, default='exact', choices=SIMILARITY_MODES,
+                        help='Score block texts like SequenceMatcher.ratio, or approximately from their common characters, which is much faster on pages with many blocks.')
+    parser.add_argument('--block_workers', type=int, default=0,
+                        help='Number of processes extracting text blocks in parallel. 0 extracts them inline.')
+    parser.add_argument('--render_service', type=str, default=None,
+                        help='Address of a render service (src/utils/render_service.py) to render with instead of local browsers, e.g. http://127.0.0.1:8765.')
+    parser.add_argument('--screenshot_cache_dir', type=str, default=None,
+                        help='Directory to cache screenshots in, so that identical pages are only rendered once across runs.')
+    parser.add_argument('--screenshot_cache_size_mb', type=int, default=2048,
+                        help='Maximum size of the screenshot cache.')
+    parser.add_argument('--block_store_dir', type=str, default=None,
+                        help='Directory to store the text blocks of the original pages in, so that they are only extracted once per dataset.')
+    parser.add_argument('--colorization_cache_dir', type=str, default=None,
+                        help='Directory to store the colour-perturbed html in, so that every html is only colourized once across runs.')
+    parser.add_argument('--intercept_requests', action='store_true',
+                        help='Serve local assets from memory and block requests to external hosts while rendering.')
+    parser.add_argument('--allowed_hosts', type=str, nargs='*', default=[],
+                        help='Hosts that are not blocked with --intercept_requests.')
+    parser.add_argument('--wait_until', type=str, default='load',
+                        choices=['commit', 'domcontentloaded', 'load', 'networkidle'],
+                        help='The load state to wait for before taking screenshots.')
+    parser.add_argument('--settle_ms', type=int, default=0,
+                        help='A fixed delay after the load state before taking screenshots.')
+    parser.add_argument('--time_budget', type=float, default=None,
+                        help='Seconds for all attempts of a capture, after which a blank image is used.')
+    parser.add_argument('--adaptive_timeout', action='store_true',
+                        help='Shorten timeouts to what the observed render times suggest.')
+    parser.add_argument('--max_canvas_height', type=int, default=0,
+                        help='Pages taller than this are handled by --canvas_mode to bound memory, 0 for unbounded.')
+    parser.add_argument('--canvas_mode', type=str, default='clip', choices=['clip', 'tile'],
+                        help='Clip taller pages at --max_canvas_height, which is recorded as "clipped" in the results, or capture them in tiles.')
+    parser.add_argument('--tile_height', type=int, default=4096,
+                        help='The height of each tile with --canvas_mode tile.')
     args = parser.parse_args()
     logger.info(f"args: {args}")
     assert args.generated_dir is not None and isinstance(
@@ -164,8 +236,9 @@ if __name__ == "__main__":
         viewports_dict[csv_name] = viewports
         res_dicts[csv_name] = {}
 
-    # remove visited viewports from unique_viewports
-    logger.info(f"Removing visited viewports from unique_viewports")
+    # collect the evaluated (viewport, filename) pairs, so that they are not evaluated again
+    logger.info(f"Collecting visited viewports and files")
+    visited: set[tuple[str, str]] = set()
     for csv in viewports_csvs:
         csv_name = os.path.basename(csv).split('.')[0]
 
@@ -176,29 +249,73 @@ if __name__ == "__main__":
                 visited_dicts = json.load(f)
                 # add to res_dicts
             res_dicts[csv_name] = visited_dicts
-            # remove from viewports
-            for res_dict in visited_dicts.keys():
-                viewport = Viewport.from_str(res_dict)
-                logger.info(f"Visited viewport: {viewport}")
-                if viewport in unique_viewports:
-                    unique_viewports.remove(viewport)
-                    logger.info(f"Removing viewport {viewport} from unique_viewports")
-            
+            for res_dict_key, item_list in visited_dicts.items():
+                logger.info(f"Visited viewport: {res_dict_key}")
+                for item in item_list:
+                    visited.add((res_dict_key, item["filename"]))
 
     logger.info(f"Unique viewports: {unique_viewports}")
     logger.info(f"Viewports dict: {viewports_dict}")
     logger.debug(f"Res dicts: {res_dicts}")
 
-    for viewport in unique_viewports:
-        res_dict_key = str(viewport)
-        logger.info(f"Evaluating for viewport: {res_dict_key}")
+    if args.screenshot_cache_dir is not None:
+        set_screenshot_cache(ScreenshotCache(
+            args.screenshot_cache_dir, max_bytes=args.screenshot_cache_size_mb * 1024 ** 2))
+    if args.block_store_dir is not None:
+        set_block_store(BlockStore(args.block_store_dir))
+    set_similarity_mode(args.text_similarity)
+    if args.block_workers > 0:
+        set_process_pool(SharedMemoryPool(max_workers=args.block_workers).start())
+    if args.colorization_cache_dir is not None:
+        set_colorization_cache(ColorizationCache(cache_dir=args.colorization_cache_dir))
+    if args.intercept_requests:
+        set_request_interceptor(RequestInterceptor(allowed_hosts=args.allowed_hosts))
 
-        viewport_result_list = eval_responsive(original_dir, generated_dir, viewport)
-        logger.info(f"viewport_result_list: {viewport_result_list}")
+    strategy = LoadStrategy(wait_until=args.wait_until, settle_ms=args.settle_ms,
+                            time_budget=args.time_budget, adaptive_timeout=args.adaptive_timeout,
+                            max_canvas_height=args.max_canvas_height or None,
+                            canvas_mode=args.canvas_mode, tile_height=args.tile_height)
+    engine = None
+    if args.render_service is not None:
+        engine = RenderClient(args.render_service)
+        health = engine.connect()
+        if health is None:
+            logger.warning(
+                f"[Warning] Render service at {args.render_service} is not reachable. Rendering locally.")
+            engine = None
+        else:
+            logger.info(f"Render service at {args.render_service}: {health}")
+    if engine is None and args.concurrency > 1:
+        engine = AsyncScreenshotEngine(max_contexts=args.concurrency).start()
+
+    for filename, viewport_res_dicts in eval_responsive_multi_viewport(original_dir, generated_dir, unique_viewports, visited, engine=engine, strategy=strategy, block_method=args.block_method, html_parser=args.html_parser):
+        logger.info(f"Evaluated {filename} for viewports: {list(viewport_res_dicts.keys())}")
 
-        for csv_name, viewport_set in viewports_dict.items():
-            if viewport in viewport_set:
-                res_dicts[csv_name][res_dict_key] = viewport_result_list
+        for viewport, res_dict in viewport_res_dicts.items():
+            res_dict_key = str(viewport)
+            for csv_name, viewport_set in viewports_dict.items():
+                if viewport in viewport_set:
+                    if res_dict_key not in res_dicts[csv_name]:
+                        res_dicts[csv_name][res_dict_key] = []
+                    res_dicts[csv_name][res_dict_key].append(res_dict)
 
+        for csv_name in viewports_dict.keys():
             with open(os.path.join(generated_dir, 'res_dict_eval__' + csv_name + '.json'), 'w') as f:
                 json.dump(res_dicts[csv_name], f, indent=4)
+
+    if isinstance(engine, AsyncScreenshotEngine):
+        engine.close()
+    if get_process_pool() is not None:
+        get_process_pool().close()
+    if get_screenshot_cache() is not None:
+        logger.info(f"Screenshot cache stats: {get_screenshot_cache().stats()}")
+    if get_block_store() is not None:
+        logger.info(f"Block store stats: {get_block_store().stats()}")
+    if get_colorization_cache() is not None:
+        logger.info(f"Colorization cache stats: {get_colorization_cache().stats()}")
+    if get_request_interceptor() is not None:
+        get_request_interceptor().report()
+    logger.info(f"Text similarity cache stats: {get_similarity_cache_stats()}")
+    logger.info(f"Render timings: {get_render_timings().stats()}")
+    if len(get_clipped_pages()) > 0:
+        logger.warning(f"Clipped pages: {get_clipped_pages()}")
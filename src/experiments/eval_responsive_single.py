@@ -8,12 +8,13 @@ import pandas as pd
 
 from src.metrics.visual_score import visual_eval_v3_multi
 from src.utils.logger import setup_logger, suppress_module_logging
+from src.utils.render_service import RenderClient
 from src.experiments.eval_responsive import Viewport
 
 logger: logging.Logger = logging.getLogger(__name__)
 
 
-def eval_responsive_single(original_dir: str, generated_dir: str, viewport: Viewport, filename: str):
+def eval_responsive_single(original_dir: str, generated_dir: str, viewport: Viewport, filename: str, engine=None):
     if not filename.endswith('.html'):
         return None
 
@@ -53,7 +54,7 @@ def eval_responsive_single(original_dir: str, generated_dir: str, viewport: View
         return None
 
     result = visual_eval_v3_multi(
-        [[generated_html_path], original_html_path], viewport=viewport.to_dict())
+        [[generated_html_path], original_html_path], viewport=viewport.to_dict(), engine=engine)
     sum_sum_areas, final_score, (size_score, text_score,
                                  position_score, color_score, clip_score) = result[0]
 
@@ -82,6 +83,8 @@ if __name__ == "__main__":
     parser.add_argument('--generated_dir', type=str)
     parser.add_argument('--viewport', type=str)
     parser.add_argument('--filename', type=str)
+    parser.add_argument('--render_service', type=str, default=None,
+                        help='Address of a render service (src/utils/render_service.py) to render with instead of local browsers.')
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -89,5 +92,6 @@ if __name__ == "__main__":
         original_dir=args.original_dir,
         generated_dir=args.generated_dir,
         viewport=Viewport.from_str(args.viewport),
-        filename=args.filename
+        filename=args.filename,
+        engine=RenderClient(args.render_service) if args.render_service is not None else None
     )
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from src.utils.process_setting import ProcessSetting
+from src.utils.screenshot import LoadStrategy, get_render_options
+from src.utils.screenshot_cache import normalize_html, resolve_base_dir
+from src.utils.storage import atomic_write
+from src.utils.viewport import Viewport
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Bump the version of a method whenever its blocks change, so that stored blocks of
+# the previous extractor are not reused.
+BLOCK_EXTRACTOR_VERSIONS = {"pixel": 1, "dom": 1}
+
+
+class BlockStore:
+    """
+    An on-disk store of the text blocks extracted from original pages, which are the
+    same for every model evaluated against them.
+
+    Entries are keyed by the normalized html, the directory its assets resolve against,
+    the viewport, the block extraction method and its version, the browser version and
+    the render options, see `make_keys`, so that blocks are extracted again after a
+    browser upgrade, or for the same html next to other assets. Every entry is an npz file
+    with the texts, bboxes and colours of the blocks as columns. Blocks are stored as
+    extracted, before `merge_blocks_by_bbox`, so they load back exactly.
+
+    Parameters:
+        store_dir (str): The directory the blocks are stored in.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.store_dir, key[:2], key + ".npz")
+
+    def make_keys(self, html_path: str, html: str, viewports: list[Viewport], block_method: str, browser_version: str, strategy: LoadStrategy = None, html_parser: str = "html.parser") -> dict:
+        """
+        Returns a mapping of viewport to the key of the blocks of the html at that viewport,
+        rendered in place of `html_path`. The html parser only matters to the "pixel"
+        method, which colour-perturbs the html.
+        """
+        html_hash = hashlib.sha256(
+            normalize_html(html).encode("utf-8")).hexdigest()
+        base_dir = resolve_base_dir(html_path)
+        keys = {}
+        for viewport in viewports:
+            key = {
+                "html": html_hash,
+                "base_dir": base_dir,
+                "viewport": [viewport.width, viewport.height],
+                "block_method": block_method,
+                "extractor_version": BLOCK_EXTRACTOR_VERSIONS[block_method],
+                "browser_version": browser_version,
+                "html_parser": html_parser if block_method == "pixel" else None,
+                "options": get_render_options(strategy),
+            }
+            keys[viewport] = hashlib.sha256(json.dumps(
+                key, sort_keys=True).encode("utf-8")).hexdigest()
+        return keys
+
+    def get(self, key: str) -> list[dict] | None:
+        try:
+            with np.load(self._path(key), allow_pickle=False) as data:
+                blocks = [{'text': str(text), 'bbox': tuple(float(value) for value in bbox),
+                           'color': tuple(int(value) for value in color)}
+                          for text, bbox, color in zip(data["texts"], data["bboxes"], data["colors"])]
+        except (OSError, KeyError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return blocks
+
+    def put(self, key: str, blocks: list[dict]):
+        atomic_write(self._path(key), lambda tmp_path: np.savez_compressed(
+            tmp_path,
+            texts=np.array([block['text'] for block in blocks], dtype=str),
+            bboxes=np.array([block['bbox'] for block in blocks], dtype=np.float64).reshape(-1, 4),
+            colors=np.array([block['color'] for block in blocks], dtype=np.int64).reshape(-1, 3)), suffix=".npz")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            }
+
+
+# the store of the blocks of original pages used by the visual score, disabled with None
+_block_store: ProcessSetting[BlockStore | None] = ProcessSetting()
+set_block_store = _block_store.set
+get_block_store = _block_store.get
@@ -0,0 +1,108 @@
+import logging
+
+import numpy as np
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# The sRGB working space matrix and the white of its native illuminant (D65, 2 degree
+# observer), as used by colormath, so that the scores are the same as with its objects.
+SRGB_TO_XYZ = np.array([
+    [0.412424, 0.357579, 0.180464],
+    [0.212656, 0.715158, 0.0721856],
+    [0.0193324, 0.119193, 0.950444],
+])
+D65_WHITE = np.array([0.95047, 1.00000, 1.08883])
+CIE_E = 216.0 / 24389.0
+
+
+def srgb_to_lab(rgb) -> np.ndarray:
+    """
+    Converts sRGB colours to Lab colours.
+
+    Parameters:
+        rgb (array-like): The colours, with values in the range [0, 255] on the last axis.
+
+    Returns:
+        np.ndarray: The L, a and b values of the colours, with the same shape as `rgb`.
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    # remove the gamma of the channels
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, np.power((rgb + 0.055) / 1.055, 2.4))
+    xyz = np.maximum(linear @ SRGB_TO_XYZ.T, 0.0) / D65_WHITE
+    f = np.where(xyz > CIE_E, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    return np.stack([116.0 * f[..., 1] - 16.0,
+                     500.0 * (f[..., 0] - f[..., 1]),
+                     200.0 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def delta_e_cie2000(lab1, lab2) -> np.ndarray:
+    """
+    Returns the Delta E (CIE2000) of every pair of Lab colours, following
+    `colormath.color_diff_matrix.delta_e_cie2000` with Kl = Kc = Kh = 1.
+
+    Parameters:
+        lab1 (array-like): The first colours, with L, a and b on the last axis.
+        lab2 (array-like): The second colours, with the same shape as `lab1`.
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    avg_Lp = (L1 + L2) / 2.0
+    avg_C1_C2 = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2.0
+    G = 0.5 * (1 - np.sqrt(avg_C1_C2 ** 7 / (avg_C1_C2 ** 7 + 25.0 ** 7)))
+
+    a1p = (1.0 + G) * a1
+    a2p = (1.0 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    avg_C1p_C2p = (C1p + C2p) / 2.0
+
+    h1p = np.degrees(np.arctan2(b1, a1p))
+    h1p += (h1p < 0) * 360
+    h2p = np.degrees(np.arctan2(b2, a2p))
+    h2p += (h2p < 0) * 360
+
+    avg_Hp = ((np.fabs(h1p - h2p) > 180) * 360 + h1p + h2p) / 2.0
+    T = 1 - 0.17 * np.cos(np.radians(avg_Hp - 30)) + \
+        0.24 * np.cos(np.radians(2 * avg_Hp)) + \
+        0.32 * np.cos(np.radians(3 * avg_Hp + 6)) - \
+        0.2 * np.cos(np.radians(4 * avg_Hp - 63))
+
+    diff_h2p_h1p = h2p - h1p
+    delta_hp = diff_h2p_h1p + (np.fabs(diff_h2p_h1p) > 180) * 360
+    delta_hp -= (h2p > h1p) * 720
+
+    delta_Lp = L2 - L1
+    delta_Cp = C2p - C1p
+    delta_Hp = 2 * np.sqrt(C2p * C1p) * np.sin(np.radians(delta_hp) / 2.0)
+
+    S_L = 1 + (0.015 * (avg_Lp - 50) ** 2) / np.sqrt(20 + (avg_Lp - 50) ** 2)
+    S_C = 1 + 0.045 * avg_C1p_C2p
+    S_H = 1 + 0.015 * avg_C1p_C2p * T
+
+    delta_ro = 30 * np.exp(-(((avg_Hp - 275) / 25) ** 2))
+    R_C = np.sqrt(avg_C1p_C2p ** 7 / (avg_C1p_C2p ** 7 + 25.0 ** 7))
+    R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+    return np.sqrt((delta_Lp / S_L) ** 2 + (delta_Cp / S_C) ** 2 + (delta_Hp / S_H) ** 2 +
+                   R_T * (delta_Cp / S_C) * (delta_Hp / S_H))
+
+
+def color_similarities_ciede2000(rgbs1, rgbs2) -> np.ndarray:
+    """
+    Returns the colour similarity of every pair of RGB colours, which is
+    max(0, 1 - Delta E (CIE2000) / 100), i.e. 1 for identical colours and 0 for colours
+    with a Delta E of 100 or more.
+
+    Parameters:
+        rgbs1 (array-like): The first colours, as an (n, 3) array in the range [0, 255].
+        rgbs2 (array-like): The second colours, as an (n, 3) array in the range [0, 255].
+
+    Returns:
+        np.ndarray: The n similarities.
+    """
+    lab1 = srgb_to_lab(np.asarray(rgbs1, dtype=np.float64).reshape(-1, 3))
+    lab2 = srgb_to_lab(np.asarray(rgbs2, dtype=np.float64).reshape(-1, 3))
+    return np.maximum(0, 1 - delta_e_cie2000(lab1, lab2) / 100)
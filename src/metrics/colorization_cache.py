@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from src.utils.process_setting import ProcessSetting
+from src.utils.storage import atomic_write
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Bump whenever the colourized html or the text colour tree changes, so that stored
+# artifacts of the previous colourizer are not reused.
+COLORIZATION_VERSION = 1
+
+
+class ColorizationCache:
+    """
+    A cache of the colour-perturbed copies of an html and its text colour tree, which only
+    depend on the html, so that they are computed once for every viewport, model and run
+    evaluating the same page.
+
+    Entries are kept in memory with LRU eviction. With `cache_dir`, they are also written
+    as small json artifacts, which are shared by every process and run using the directory.
+
+    Parameters:
+        max_entries (int): The number of entries kept in memory.
+        cache_dir (str): Optional directory to store the entries in.
+    """
+
+    def __init__(self, max_entries: int = 64, cache_dir: str = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, html: str, parser: str) -> str:
+        key = {"html": hashlib.sha256(html.encode("utf-8", errors="replace")).hexdigest(),
+               "parser": parser, "version": COLORIZATION_VERSION}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key: str) -> tuple[str, str, list] | None:
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        entry = None
+        if self.cache_dir is not None:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                entry = (data["p_html"], data["p_html_1"], [tuple(item) for item in data["tree"]])
+            except (OSError, ValueError, KeyError):
+                entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: tuple[str, str, list]):
+        self._remember(key, entry)
+        if self.cache_dir is None:
+            return
+
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"p_html": entry[0], "p_html_1": entry[1], "tree": entry[2]}, f)
+
+        atomic_write(self._path(key), write)
+
+    def _remember(self, key: str, entry: tuple[str, str, list]):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+# the cache used by `prepare_perturbed_html`, which only keeps entries in memory by
+# default, caching is disabled with None
+_colorization_cache: ProcessSetting[ColorizationCache | None] = ProcessSetting(ColorizationCache())
+set_colorization_cache = _colorization_cache.set
+get_colorization_cache = _colorization_cache.get
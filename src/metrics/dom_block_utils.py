@@ -0,0 +1,209 @@
+import argparse
+import json
+import logging
+import os
+import re
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from src.metrics.ocr_free_utils import TEXT_TAGS, get_blocks_ocr_free_multi_viewport, read_html
+from src.utils.screenshot import LoadStrategy, ScreenshotJob, run_screenshot_jobs
+from src.utils.viewport import Viewport
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Collects the bounding rects and colours of the text nodes in the page. Like the
+# pixel-diff method, text nodes are grouped by their nearest text-containing ancestor,
+# which `colorize_html` gives a unique colour, and every text node gets the bounding box
+# of its whole group.
+DOM_BLOCKS_SCRIPT = """() => {
+    const textTags = new Set(%s.map(tag => tag.toUpperCase()));
+    const skippedTags = new Set(["SCRIPT", "STYLE", "NOSCRIPT", "TEMPLATE", "TITLE"]);
+    const root = document.body || document.documentElement;
+    const walker = document.createTreeWalker(root, NodeFilter.SHOW_TEXT);
+    const range = document.createRange();
+    const groups = new Map();
+    const boxes = [];
+    const items = [];
+    for (let node = walker.nextNode(); node; node = walker.nextNode()) {
+        const text = node.textContent.trim();
+        const parent = node.parentElement;
+        if (!text || !parent || skippedTags.has(parent.tagName)) continue;
+        let owner = parent;
+        while (owner && !textTags.has(owner.tagName)) owner = owner.parentElement;
+        if (!owner) continue;
+        const style = getComputedStyle(parent);
+        if (style.visibility !== "visible") continue;
+        range.selectNodeContents(node);
+        const rects = Array.from(range.getClientRects()).filter(rect => rect.width > 0 && rect.height > 0);
+        if (rects.length === 0) continue;
+        let group = groups.get(owner);
+        if (group === undefined) {
+            group = boxes.length;
+            groups.set(owner, group);
+            boxes.push([Infinity, Infinity, -Infinity, -Infinity]);
+        }
+        const box = boxes[group];
+        for (const rect of rects) {
+            box[0] = Math.min(box[0], rect.left + window.scrollX);
+            box[1] = Math.min(box[1], rect.top + window.scrollY);
+            box[2] = Math.max(box[2], rect.right + window.scrollX);
+            box[3] = Math.max(box[3], rect.bottom + window.scrollY);
+        }
+        items.push({text: text, group: group, color: style.color});
+    }
+    return {items: items, boxes: boxes};
+}""" % json.dumps(TEXT_TAGS)
+
+
+def parse_css_color(color: str) -> tuple:
+    """
+    Returns the RGB tuple of a computed CSS colour like "rgb(1, 2, 3)" or "rgba(1, 2, 3, 0.5)".
+    """
+    values = re.findall(r"[\d.]+", color)
+    return tuple(int(round(float(value))) for value in values[:3])
+
+
+def get_blocks_from_dom(dom_result: dict, image_shape: tuple) -> list[dict]:
+    """
+    Converts the result of `DOM_BLOCKS_SCRIPT` to blocks like `get_blocks_from_image_diff_pixels`,
+    with bboxes relative to the screenshot of shape (height, width, 3). Blocks are clipped
+    to the screenshot, and dropped if they fall outside of it.
+    """
+    height, width = image_shape[0], image_shape[1]
+    boxes = []
+    for left, top, right, bottom in dom_result["boxes"]:
+        left, top = max(0.0, left), max(0.0, top)
+        right, bottom = min(float(width), right), min(float(height), bottom)
+        boxes.append((left, top, right, bottom) if right > left and bottom > top else None)
+
+    blocks = []
+    for item in dom_result["items"]:
+        box = boxes[item["group"]]
+        if box is None:
+            continue
+        left, top, right, bottom = box
+        blocks.append({'text': item["text"].lower(), 'bbox': (
+            left / width, top / height, (right - left) / width, (bottom - top) / height),
+            'color': parse_css_color(item["color"])})
+    return blocks
+
+
+def get_dom_screenshot_job(html_path, viewports: list[Viewport], html: str = None, output_files: dict = None, strategy: LoadStrategy = None) -> ScreenshotJob:
+    """
+    Returns the job capturing the page at every viewport together with its text geometry,
+    see `get_blocks_from_job`.
+    """
+    return ScreenshotJob(html_path, viewports, output_files=output_files, html=html,
+                         strategy=strategy, script=DOM_BLOCKS_SCRIPT)
+
+
+def get_blocks_from_job(job: ScreenshotJob, images: dict) -> dict:
+    """
+    Returns a mapping of viewport to the blocks of a captured `get_dom_screenshot_job`.
+    Viewports that fell back to blank images have no blocks.
+    """
+    blocks = {}
+    for viewport, image in images.items():
+        if viewport not in job.script_results:
+            logger.warning(
+                f"[Warning] No text geometry of {job.url} at {viewport}...")
+            blocks[viewport] = []
+            continue
+        blocks[viewport] = get_blocks_from_dom(job.script_results[viewport], image.shape)
+    return blocks
+
+
+def get_blocks_dom_multi_viewport(html_path, viewports: list[Viewport], html: str = None, engine=None, strategy: LoadStrategy = None) -> tuple[dict, dict]:
+    """
+    Same as `get_blocks_ocr_free_multi_viewport`, but renders the page once, and reads the
+    text blocks from the DOM instead of diffing two colour-perturbed renders.
+
+    Returns:
+        tuple[dict, dict]: Mappings of viewport to the screenshot and to its blocks.
+    """
+    job = get_dom_screenshot_job(html_path, viewports, html=html, strategy=strategy)
+    images = run_screenshot_jobs([job], engine=engine)[0]
+    return images, get_blocks_from_job(job, images)
+
+
+def bbox_iou(bbox1, bbox2) -> float:
+    x1, y1 = max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1])
+    x2 = min(bbox1[0] + bbox1[2], bbox2[0] + bbox2[2])
+    y2 = min(bbox1[1] + bbox1[3], bbox2[1] + bbox2[3])
+    intersection = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = bbox1[2] * bbox1[3] + bbox2[2] * bbox2[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def block_parity_report(pixel_blocks: list[dict], dom_blocks: list[dict]) -> dict:
+    """
+    Compares the blocks of both methods. Blocks are paired by their text, in document order.
+
+    Returns:
+        dict: The number of blocks of each method, the share of pixel-diff blocks found in
+            the DOM, and the mean bbox IoU and colour distance of the paired blocks.
+    """
+    matcher = SequenceMatcher(None, [block['text'] for block in pixel_blocks],
+                              [block['text'] for block in dom_blocks], autojunk=False)
+    ious = []
+    color_distances = []
+    for i, j, size in matcher.get_matching_blocks():
+        for k in range(size):
+            pixel_block, dom_block = pixel_blocks[i + k], dom_blocks[j + k]
+            ious.append(bbox_iou(pixel_block['bbox'], dom_block['bbox']))
+            color_distances.append(float(np.linalg.norm(
+                np.array(pixel_block['color'], dtype=float) - np.array(dom_block['color'], dtype=float))))
+    return {
+        "pixel_blocks": len(pixel_blocks),
+        "dom_blocks": len(dom_blocks),
+        "matched": len(ious),
+        "recall": len(ious) / len(pixel_blocks) if len(pixel_blocks) > 0 else 1.0,
+        "mean_iou": float(np.mean(ious)) if len(ious) > 0 else 0.0,
+        "mean_color_distance": float(np.mean(color_distances)) if len(color_distances) > 0 else 0.0,
+    }
+
+
+def compare_block_methods(html_path, viewports: list[Viewport], engine=None) -> dict:
+    """
+    Extracts the blocks of the html with both methods, and returns the parity report at
+    every viewport.
+    """
+    html = read_html(html_path)
+    images, dom_blocks = get_blocks_dom_multi_viewport(html_path, viewports, html=html, engine=engine)
+    pixel_blocks = get_blocks_ocr_free_multi_viewport(html_path, images, engine=engine, html=html)
+    return {viewport: block_parity_report(pixel_blocks[viewport], dom_blocks[viewport]) for viewport in viewports}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--html_dir', type=str, required=True,
+                        help='Directory of the html files to compare the block extractors on')
+    parser.add_argument('--viewports', type=str, nargs='+', default=['1280x720'],
+                        help='Viewports in the format "widthxheight"')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Optional json file to write the report of every file to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger.info(f"args: {args}")
+
+    viewports = [Viewport.from_str(viewport) for viewport in args.viewports]
+    reports = {}
+    for filename in sorted(os.listdir(args.html_dir)):
+        if not filename.endswith('.html'):
+            continue
+        result = compare_block_methods(os.path.join(args.html_dir, filename), viewports)
+        reports[filename] = {str(viewport): report for viewport, report in result.items()}
+        logger.info(f"{filename}: {reports[filename]}")
+
+    for viewport in viewports:
+        viewport_reports = [report[str(viewport)] for report in reports.values()]
+        if len(viewport_reports) == 0:
+            continue
+        summary = {key: float(np.mean([report[key] for report in viewport_reports]))
+                   for key in ["recall", "mean_iou", "mean_color_distance"]}
+        logger.info(f"Mean parity at {viewport} over {len(viewport_reports)} files: {summary}")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=4)
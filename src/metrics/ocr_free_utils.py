@@ -4,64 +4,216 @@ import cv2
 import numpy as np
 from PIL import Image, ImageColor
 import os
-from bs4 import BeautifulSoup, NavigableString, Tag, Comment
+from bs4 import BeautifulSoup, FeatureNotFound, NavigableString, Tag, Comment
 from pathlib import Path
-from src.utils.screenshot import take_and_save_screenshot   
+from src.metrics.colorization_cache import get_colorization_cache
+from src.utils.process_pool import get_process_pool
+from src.utils.screenshot import LoadStrategy, ScreenshotJob, TiledScreenshot, image_rows, iter_image_tiles, run_screenshot_jobs
+from src.utils.viewport import Viewport
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+# the text-containing elements that are given a unique text colour
+TEXT_TAGS = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'span', 'a', 'b', 'li',
+             'table', 'td', 'th', 'button', 'footer', 'header', 'figcaption']  # Add more tags as needed
+
+DEFAULT_HTML_PARSER = 'html.parser'
+
+
 def rgb_to_hex(rgb):
     """Convert an RGB tuple to hexadecimal format."""
     return '{:02X}{:02X}{:02X}'.format(*rgb)
 
 
-class ColorPool:
-    def __init__(self, offset=0):
+class ColorCodec:
+    """
+    Encodes the index of a text-containing element as a unique text colour, and decodes
+    rendered colours back to the index.
+
+    Every channel takes one of the values `low`, `low + spacing`, ... up to `high`, so that
+    colours stay away from the white background and black default text. Blocks are decoded
+    within ±4 per channel, so the spacing is at least 9 to keep the colours apart. The
+    spacing is the largest one with room for `n_colors`, up to 16, and indices are encoded
+    from the highest channel values down, so that pages with up to 16³ elements keep the
+    colours they were always given. Colours are generated from the
+    index on demand, and rendered pixels are decoded through per-channel lookup tables,
+    see `label_text_colors`.
+
+    Parameters:
+        n_colors (int): The number of colours needed.
+        offset (int): The shift of every channel, for the second perturbed render.
+        spacing (int): Optional fixed spacing of the channel values.
+    """
+    LOW = 10
+    HIGH = 250
+    MAX_SPACING = 16
+    MIN_SPACING = 9
+    # the most colours, with the smallest spacing
+    MAX_COLORS = ((HIGH - LOW) // MIN_SPACING + 1) ** 3
+
+    def __init__(self, n_colors: int = 0, offset: int = 0, spacing: int = None):
+        self.offset = offset
+        self.spacing = spacing or self.spacing_for(n_colors)
+        self.values = list(range(self.LOW, self.HIGH + 1, self.spacing))
+        self.capacity = len(self.values) ** 3
+        if n_colors > self.capacity:
+            raise ValueError(
+                f"{n_colors} text colours do not fit in {self.capacity} colours with a spacing of {self.spacing}")
+        # channel value -> index of the channel value, within the decoding tolerance
+        self._channel_lut = np.full(256, -1, dtype=np.int64)
+        for j, value in enumerate(self.values):
+            for delta in range(-4, 5):
+                self._channel_lut[(value + offset + delta) % 256] = j
+
+    @classmethod
+    def for_colors(cls, colors: np.ndarray) -> 'ColorCodec | None':
+        """
+        Returns the codec without offset whose colours include all of `colors`, an (n, 3)
+        array, that can be matched, or None. Colours within 4 of 0 or 255 on a channel are
+        never matched, like in `get_blocks_from_image_diff_pixels`, e.g. the default black.
+        """
+        colors = np.asarray(colors, dtype=np.int64).reshape(-1, 3)
+        colors = colors[((colors >= 4) & (colors <= 251)).all(axis=1)]
+        for spacing in range(cls.MAX_SPACING, cls.MIN_SPACING - 1, -1):
+            if np.isin(colors, np.arange(cls.LOW, cls.HIGH + 1, spacing)).all():
+                return cls(spacing=spacing)
+        return None
 
-        color_values = list(range(10, 251, 16))
-        color_list = [((r + offset) % 256, (g + offset) % 256, (b + offset) % 256)
-                      for r in color_values for g in color_values for b in color_values]
-        self.color_pool = [rgb_to_hex(color) for color in color_list]
+    @classmethod
+    def spacing_for(cls, n_colors: int) -> int:
+        for spacing in range(cls.MAX_SPACING, cls.MIN_SPACING - 1, -1):
+            if ((cls.HIGH - cls.LOW) // spacing + 1) ** 3 >= n_colors:
+                return spacing
+        return cls.MIN_SPACING
+
+    def rgb(self, index: int) -> tuple:
+        if not 0 <= index < self.capacity:
+            raise IndexError(f"Colour {index} is out of the {self.capacity} colours")
+        # the first index gets the highest channel values
+        n = len(self.values)
+        position = self.capacity - 1 - index
+        r, g, b = position // (n * n), position // n % n, position % n
+        return tuple((self.values[channel] + self.offset) % 256 for channel in (r, g, b))
+
+    def encode(self, index: int) -> str:
+        return rgb_to_hex(self.rgb(index))
+
+    def decode(self, rgb: np.ndarray) -> np.ndarray:
+        """
+        Returns the index of the colour within ±4 per channel of every RGB value of `rgb`,
+        an (..., 3) array, or -1.
+        """
+        rgb = np.asarray(rgb)
+        r, g, b = (self._channel_lut[rgb[..., channel]] for channel in range(3))
+        n = len(self.values)
+        indices = self.capacity - 1 - (r * n * n + g * n + b)
+        indices[(r < 0) | (g < 0) | (b < 0)] = -1
+        return indices
+
+
+def read_html(html_path) -> str:
+    with open(html_path, 'r', encoding="utf-8", errors="replace") as file:
+        return file.read()
 
-    def pop_color(self):
-        if self.color_pool:
-            return self.color_pool.pop()
-        else:
-            raise NotImplementedError
 
+def make_soup(html: str, parser: str = DEFAULT_HTML_PARSER) -> BeautifulSoup:
+    """
+    Parses the html with the given BeautifulSoup parser, e.g. "lxml", which is faster but
+    optional and may nest malformed markup differently. Falls back to "html.parser" if the
+    parser is not installed.
+    """
+    try:
+        return BeautifulSoup(html, parser)
+    except FeatureNotFound:
+        logger.warning(
+            f"[Warning] Parser {parser} is not installed, falling back to {DEFAULT_HTML_PARSER}...")
+        return BeautifulSoup(html, DEFAULT_HTML_PARSER)
 
-def process_html(input_file_path, output_file_path, offset=0):
-    # Read the input HTML file
-    with open(input_file_path, 'r', encoding="utf-8", errors="replace") as file:
-        soup = BeautifulSoup(file, 'html.parser')
 
-    def update_style(element, property_name, value):
-        # Update the element's style attribute with the given property and value
-        # Adding !important to ensure the style overrides others
-        important_value = f"{value} !important"
-        styles = element.attrs.get('style', '').split(';')
-        updated_styles = [s for s in styles if not s.strip(
-        ).startswith(property_name) and len(s.strip()) > 0]
-        updated_styles.append(f"{property_name}: {important_value}")
-        element['style'] = '; '.join(updated_styles).strip()
+# the text colour of elements without a unique colour, which is off the grid of every
+# `ColorCodec` and the same in every variant, so it is never decoded
+UNCODED_TEXT_COLOR = "#000000"
+
+
+def update_style(element, property_name, value):
+    # Update the element's style attribute with the given property and value
+    # Adding !important to ensure the style overrides others
+    important_value = f"{value} !important"
+    styles = element.attrs.get('style', '').split(';')
+    updated_styles = [s for s in styles if not s.strip(
+    ).startswith(property_name) and len(s.strip()) > 0]
+    updated_styles.append(f"{property_name}: {important_value}")
+    element['style'] = '; '.join(updated_styles).strip()
+
+
+def colorize_html_variants(html: str, offsets=(0, 50), parser: str = DEFAULT_HTML_PARSER, html_file="") -> tuple[list[str], list]:
+    """
+    Same as `colorize_html` for every offset, but parses the html once. The transparent
+    backgrounds are set once, and only the text colours are rewritten per offset.
+    Pages with more than 16³ text-containing elements get more closely spaced colours,
+    see `ColorCodec`. Beyond `ColorCodec.MAX_COLORS` elements, only the first ones get
+    unique colours, and the others get `UNCODED_TEXT_COLOR`, so they have no blocks.
+    `html_file` is only used for logging.
+
+    Returns:
+        tuple[list[str], list]: The html of every offset, and the flattened text colour
+            tree of the first one, like `extract_text_with_color` of its output.
+    """
+    soup = make_soup(html, parser)
 
     # Set the background color of all elements to white
     for element in soup.find_all(True):
         update_style(element, 'background-color', 'rgba(255, 255, 255, 0.0)')
 
-    color_pool = ColorPool(offset)
+    text_tags = soup.find_all(TEXT_TAGS)
+    if len(text_tags) > ColorCodec.MAX_COLORS:
+        logger.warning(
+            f"[Warning] {html_file} has {len(text_tags)} text-containing elements, only the first {ColorCodec.MAX_COLORS} get unique colours...")
+        for tag in text_tags[ColorCodec.MAX_COLORS:]:
+            update_style(tag, 'color', UNCODED_TEXT_COLOR)
+            update_style(tag, 'opacity', 1.0)
+        text_tags = text_tags[:ColorCodec.MAX_COLORS]
+    base_styles = [tag['style'] for tag in text_tags]
+
+    variants = []
+    tree = None
+    for offset in offsets:
+        color_codec = ColorCodec(len(text_tags), offset)
+
+        # Assign a unique color to text within each text-containing element
+        for index, (tag, style) in enumerate(zip(text_tags, base_styles)):
+            tag['style'] = style
+            color = f"#{color_codec.encode(index)}"
+            update_style(tag, 'color', color)
+            update_style(tag, 'opacity', 1.0)
+
+        variants.append(str(soup))
+        if tree is None:
+            tree = flatten_tree(extract_text_with_color_from_soup(soup, html_file))
+    return variants, tree
+
+
+def colorize_html(html: str, offset=0, parser: str = DEFAULT_HTML_PARSER) -> str:
+    """
+    Returns the html with a transparent background on every element, and a unique text
+    colour on every text-containing element, shifted by `offset`.
+    """
+    return colorize_html_variants(html, (offset,), parser)[0][0]
 
-    # Assign a unique color to text within each text-containing element
-    text_tags = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'span', 'a', 'b', 'li',
-                 'table', 'td', 'th', 'button', 'footer', 'header', 'figcaption']  # Add more tags as needed
-    for tag in soup.find_all(text_tags):
-        color = f"#{color_pool.pop_color()}"
-        update_style(tag, 'color', color)
-        update_style(tag, 'opacity', 1.0)
 
-    # Write the modified HTML to a new file
-    with open(output_file_path, 'w', encoding="utf-8", errors="replace") as file:
-        file.write(str(soup))
+def load_image_rgb(image) -> np.ndarray:
+    """
+    Returns the given image path, PIL image, RGB array or `TiledScreenshot` as an RGB array.
+    A `TiledScreenshot` is stitched together, so tile-aware callers check for it first.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, TiledScreenshot):
+        return image.to_array()
+    if isinstance(image, Image.Image):
+        return np.array(image.convert('RGB'))
+    with Image.open(image) as img:
+        return np.array(img.convert('RGB'))
 
 
 def similar(n1, n2):
@@ -71,44 +223,57 @@ def similar(n1, n2):
         return False
 
 
-def find_different_pixels(image1_path, image2_path):
-    # Open the images
-    img1 = Image.open(image1_path)
-    img2 = Image.open(image2_path)
+def find_different_pixels_mask(image1, image2) -> np.ndarray | None:
+    """
+    Finds the pixels whose colour in `image2` is the colour in `image1` shifted by 50 on
+    every channel, within a tolerance of 8, i.e. the text of the colour-perturbed renders.
+
+    :param image1: The render with offset 0, as a path, PIL image or RGB array.
+    :param image2: The render with offset 50, in the same format.
+    :return: A boolean mask of shape (height, width), or None if the sizes differ.
+    """
+    img1 = load_image_rgb(image1)
+    img2 = load_image_rgb(image2)
 
     # Ensure both images are of the same size
-    if img1.size != img2.size:
+    if img1.shape != img2.shape:
         logger.warning(
-            f"[Warning] Images are not the same size, {image1_path}, {image2_path}")
+            f"[Warning] Images are not the same size, {img1.shape[1::-1]}, {img2.shape[1::-1]}")
         return None
 
-    # Convert images to RGB if they are not
-    img1 = img1.convert('RGB')
-    img2 = img2.convert('RGB')
-
-    # Get pixel data
-    pixels1 = img1.load()
-    pixels2 = img2.load()
-
-    # List to store coordinates of different pixels
-    different_pixels = []
+    # uint8 addition wraps around, like (c + 50) % 256, and absdiff does not
+    diff = cv2.absdiff(img1 + np.uint8(50), img2)
+    return cv2.inRange(diff, (0, 0, 0), (8, 8, 8)) > 0
 
-    # Iterate through each pixel
-    for x in range(img1.size[0]):
-        for y in range(img1.size[1]):
-            # Compare pixel colors
-            r1, g1, b1 = pixels1[x, y]
-            r2, g2, b2 = pixels2[x, y]
-            if similar((r1 + 50) % 256, r2) and similar((g1 + 50) % 256, g2) and similar((b1 + 50) % 256, b2):
-                different_pixels.append((y, x))
 
-    if len(different_pixels) > 0:
-        return np.stack(different_pixels)
-    else:
+def find_different_pixels(image1, image2):
+    """
+    Same as `find_different_pixels_mask`, but returns the (y, x) coordinates of the pixels,
+    ordered by x and then by y, or None if there are none.
+    """
+    mask = find_different_pixels_mask(image1, image2)
+    if mask is None or not mask.any():
         return None
+    # the transposed mask is scanned in x-major order
+    return np.ascontiguousarray(np.argwhere(mask.T)[:, ::-1])
 
 
 def extract_text_with_color(html_file):
+    return extract_text_with_color_from_html(read_html(html_file), html_file)
+
+
+def extract_text_with_color_from_html(html: str, html_file=""):
+    """
+    Same as `extract_text_with_color`, but for the html content. `html_file` is only
+    used for logging.
+    """
+    return extract_text_with_color_from_soup(BeautifulSoup(html, 'html.parser'), html_file)
+
+
+def extract_text_with_color_from_soup(soup: BeautifulSoup, html_file=""):
+    """
+    Same as `extract_text_with_color_from_html`, but for the parsed html.
+    """
     def get_color(tag):
         if 'style' in tag.attrs:
             styles = tag['style'].split(';')
@@ -148,10 +313,8 @@ def extract_text_with_color(html_file):
                 child, current_color) for child in element.children])
             return list(children_texts)
 
-    with open(html_file, 'r', encoding='utf-8', errors="replace") as file:
-        soup = BeautifulSoup(file, 'html.parser')
-        body = soup.body
-        return extract_text_recursive(body) if body else []
+    body = soup.body
+    return extract_text_recursive(body) if body else []
 
 
 def flatten_tree(tree):
@@ -170,121 +333,429 @@ def flatten_tree(tree):
     return flat_list
 
 
-def average_color(image_path, coordinates):
+def hex_to_rgb(hex_color):
+    hex_color = hex_color.lstrip('#')
+    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+
+
+def get_blocks_from_image_diff_pixels(image, html_text_color_tree, different_pixels, original_image=None):
     """
-    Calculates the average color of the specified coordinates in the given image.
+    Extracts the text blocks from the colour-perturbed screenshot `image`.
 
-    :param image: A PIL Image object.
-    :param coordinates: A 2D numpy array of coordinates, where each row represents [x, y].
-    :return: A tuple representing the average color (R, G, B).
+    `different_pixels` is the boolean mask of `find_different_pixels_mask`, or the (y, x)
+    coordinates of `find_different_pixels`. Block colours are averaged over `original_image`,
+    the unperturbed screenshot. When `image` is a path like `x_p.png`, it defaults to
+    `x.png`; otherwise it must be given. Both are best given as decoded RGB arrays.
     """
-    # Convert image to numpy array
-    image_array = np.array(Image.open(image_path).convert('RGB'))
+    if isinstance(image, str) and original_image is None:
+        original_image = image.replace("_p.png", ".png")
+    # colours are matched per channel, so the RGB image is matched against RGB bounds
+    image = load_image_rgb(image)
+    original_image = load_image_rgb(original_image)
+    x_w = image.shape[0]
+    y_w = image.shape[1]
 
-    # Extract colors at the specified coordinates
-    colors = [image_array[x, y] for x, y in coordinates]
+    different_mask = np.asarray(different_pixels)
+    if different_mask.dtype != bool:
+        different_mask = np.zeros(image.shape[:2], dtype=bool)
+        different_mask[different_pixels[:, 0], different_pixels[:, 1]] = True
 
-    # Calculate the average color
-    avg_color = np.mean(colors, axis=0)
+    blocks = []
+    for item in html_text_color_tree:
+        try:
+            color = np.array(hex_to_rgb(item[1]), dtype="uint8")
+        except:
+            continue
 
-    return tuple(avg_color.astype(int))
+        lower = color - 4
+        upper = color + 4
 
+        mask = cv2.inRange(image, lower, upper) > 0
+        mask &= different_mask
 
-def get_blocks_from_image_diff_pixels(image_path, html_text_color_tree, different_pixels):
-    image = cv2.imread(image_path)
-    x_w = image.shape[0]
-    y_w = image.shape[1]
+        rows = np.flatnonzero(mask.any(axis=1))
+        if rows.size == 0:
+            continue
+        cols = np.flatnonzero(mask.any(axis=0))
 
-    def hex_to_bgr(hex_color):
-        """
-        Converts a hex color string to a BGR color tuple.
-        """
-        hex_color = hex_color.lstrip('#')
-        rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-        return rgb[::-1]
+        x_min, x_max = rows[0], rows[-1]
+        y_min, y_max = cols[0], cols[-1]
+        # pixels are averaged in row-major order, like the sorted coordinates were
+        color = tuple(np.mean(original_image[mask], axis=0).astype(int))
 
-    def get_intersect(arr1, arr2):
-        # Reshape the arrays to 1D
-        arr1_reshaped = arr1.view([('', arr1.dtype)] * arr1.shape[1])
-        arr2_reshaped = arr2.view([('', arr2.dtype)] * arr2.shape[1])
+        blocks.append({'text': item[0].lower(), 'bbox': (
+            y_min / y_w, x_min / x_w, (y_max - y_min + 1) / y_w, (x_max - x_min + 1) / x_w), 'color': color})
+    return blocks
 
-        # Find the intersection
-        common_rows = np.intersect1d(arr1_reshaped, arr2_reshaped)
 
-        # Reshape the result back to 2D, if needed
-        common_rows = common_rows.view(arr1.dtype).reshape(-1, arr1.shape[1])
-        return common_rows
+def get_text_color_luts(colors: np.ndarray) -> list | None:
+    """
+    Returns, for every channel, a lookup table of the 256 channel values to the index of
+    the distinct channel value of `colors` whose ±4 window contains it, or -1, together with
+    the distinct values. Returns None if the windows of a channel overlap, as a pixel could
+    then belong to several colours.
+    """
+    luts = []
+    for channel in range(3):
+        values = np.unique(colors[:, channel])
+        lut = np.full(256, -1, dtype=np.int64)
+        for j, value in enumerate(values):
+            # the bounds wrap around like in `get_blocks_from_image_diff_pixels`
+            lower, upper = (int(value) - 4) % 256, (int(value) + 4) % 256
+            if lower > upper:
+                continue
+            if (lut[lower:upper + 1] >= 0).any():
+                return None
+            lut[lower:upper + 1] = j
+        luts.append((lut, values))
+    return luts
+
+
+def label_text_colors(pixels: np.ndarray, colors: np.ndarray) -> tuple[np.ndarray, list]:
+    """
+    Labels every pixel for matching it against the text colours within ±4 per channel.
+    Colours of a `ColorCodec` are decoded by the codec, other colours are looked up per
+    channel or grouped by colour.
 
-    blocks = []
+    Returns:
+        tuple[np.ndarray, list]: The label of every pixel, or -1, and for every colour the
+            array of labels within its tolerance.
+    """
+    codec = ColorCodec.for_colors(colors)
+    if codec is not None:
+        # the colours were encoded by the codec, which decodes every pixel directly
+        color_indices = codec.decode(colors)
+        return codec.decode(pixels), [np.array([index]) if index >= 0 else np.array([], dtype=np.int64)
+                                      for index in color_indices]
+
+    luts = get_text_color_luts(colors)
+    if luts is not None:
+        # every pixel matches at most one colour, which is looked up per channel
+        labels = np.zeros(len(pixels), dtype=np.int64)
+        valid = np.ones(len(pixels), dtype=bool)
+        color_labels = np.zeros(len(colors), dtype=np.int64)
+        color_valid = np.ones(len(colors), dtype=bool)
+        for channel, (lut, values) in enumerate(luts):
+            channel_labels = lut[pixels[:, channel]]
+            labels = labels * len(values) + channel_labels
+            valid &= channel_labels >= 0
+            value_labels = lut[colors[:, channel]]
+            color_labels = color_labels * len(values) + np.searchsorted(values, colors[:, channel])
+            color_valid &= value_labels == np.searchsorted(values, colors[:, channel])
+        labels[~valid] = -1
+        return labels, [np.array([label]) if is_valid else np.array([], dtype=np.int64)
+                        for label, is_valid in zip(color_labels, color_valid)]
+
+    # otherwise, group the pixels by packed colour, and match every group
+    packed = (pixels[:, 0].astype(np.int64) << 16) | (pixels[:, 1].astype(np.int64) << 8) | pixels[:, 2]
+    unique_colors, labels = np.unique(packed, return_inverse=True)
+    unique_colors = np.stack([unique_colors >> 16, (unique_colors >> 8) & 255, unique_colors & 255], axis=1)
+    lower = (colors - np.uint8(4)).astype(np.int64)
+    upper = (colors + np.uint8(4)).astype(np.int64)
+    return labels.reshape(-1), [np.flatnonzero(np.all((unique_colors >= lower[k]) & (unique_colors <= upper[k]), axis=1))
+                                for k in range(len(colors))]
+
+
+def get_text_colors(html_text_color_tree) -> tuple[list, np.ndarray]:
+    """
+    Returns the distinct valid hex colours of the text colour tree, in order, and their
+    RGB values as a (n, 3) uint8 array.
+    """
+    hex_colors = []
+    rgb_colors = []
     for item in html_text_color_tree:
+        if item[1] in hex_colors:
+            continue
         try:
-            color = np.array(hex_to_bgr(item[1]), dtype="uint8")
+            rgb_colors.append(np.array(hex_to_rgb(item[1]), dtype="uint8"))
+            hex_colors.append(item[1])
         except:
             continue
+    return hex_colors, np.stack(rgb_colors) if len(rgb_colors) > 0 else np.zeros((0, 3), dtype=np.uint8)
 
-        lower = color - 4
-        upper = color + 4
 
-        mask = cv2.inRange(image, lower, upper)
-
-        coords = np.column_stack(np.where(mask > 0))
+def get_text_color_stats(image: np.ndarray, different_mask: np.ndarray, original_image: np.ndarray, rgb_colors: np.ndarray, row_offset: int = 0) -> dict:
+    """
+    Labels the pixels under `different_mask` with the text colours within ±4 per channel,
+    through per-channel lookup tables with the same tolerance as `cv2.inRange`, and reduces
+    the bbox, pixel count and colour sum of every colour at once.
+
+    Returns:
+        dict: A mapping of the index of every colour found to [row_min, row_max, col_min,
+            col_max, colour sum, pixel count], with rows shifted by `row_offset`. Sums are
+            exact integers, so that the stats of several tiles add up exactly.
+    """
+    y_w = image.shape[1]
+    # label every masked pixel, in row-major order
+    flat_index = np.flatnonzero(different_mask)
+    if flat_index.size == 0 or len(rgb_colors) == 0:
+        return {}
+    labels, color_labels = label_text_colors(image.reshape(-1, 3)[flat_index], rgb_colors)
+    valid = labels >= 0
+    labels, flat_index = labels[valid], flat_index[valid]
+    if flat_index.size == 0:
+        return {}
+
+    # reduce every label at once, over the pixels sorted by label
+    order = np.argsort(labels, kind='stable')
+    present, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    rows = flat_index[order] // y_w
+    cols = flat_index[order] % y_w
+    # rows are ascending within every label, as the pixels are in row-major order
+    row_min = rows[starts]
+    row_max = np.maximum.reduceat(rows, starts)
+    col_min = np.minimum.reduceat(cols, starts)
+    col_max = np.maximum.reduceat(cols, starts)
+    color_sums = np.add.reduceat(
+        original_image.reshape(-1, 3)[flat_index[order]].astype(np.int64), starts, axis=0)
+
+    stats = {}
+    for k, label_list in enumerate(color_labels):
+        # both are sorted, so the labels are looked up in the present ones
+        matched = np.minimum(np.searchsorted(present, label_list), len(present) - 1)
+        matched = matched[present[matched] == label_list]
+        if len(matched) == 0:
+            continue
+        stats[k] = [row_min[matched].min() + row_offset, row_max[matched].max() + row_offset,
+                    col_min[matched].min(), col_max[matched].max(),
+                    color_sums[matched].sum(axis=0), counts[matched].sum()]
+    return stats
 
-        coords = get_intersect(coords, different_pixels)
 
-        if coords.size == 0:
+def merge_text_color_stats(stats: dict, other: dict) -> dict:
+    """
+    Adds the stats of `get_text_color_stats` of another tile to `stats`.
+    """
+    for k, (x_min, x_max, y_min, y_max, color_sum, count) in other.items():
+        if k not in stats:
+            stats[k] = [x_min, x_max, y_min, y_max, color_sum, count]
             continue
+        merged = stats[k]
+        stats[k] = [min(merged[0], x_min), max(merged[1], x_max), min(merged[2], y_min), max(merged[3], y_max),
+                    merged[4] + color_sum, merged[5] + count]
+    return stats
 
-        x_min, y_min = np.min(coords, axis=0)
-        x_max, y_max = np.max(coords, axis=0)
-        color = average_color(image_path.replace("_p.png", ".png"), coords)
 
-        blocks.append({'text': item[0].lower(), 'bbox': (
-            y_min / y_w, x_min / x_w, (y_max - y_min + 1) / y_w, (x_max - x_min + 1) / x_w), 'color': color})
+def get_blocks_from_text_color_stats(html_text_color_tree, hex_colors: list, stats: dict, shape: tuple) -> list[dict]:
+    """
+    Returns the blocks of the text colour tree whose colour is in the stats of
+    `get_text_color_stats`, with bboxes relative to a screenshot of the given shape.
+    """
+    x_w, y_w = shape[0], shape[1]
+    color_blocks = {}
+    for k, (x_min, x_max, y_min, y_max, color_sum, count) in stats.items():
+        color_blocks[hex_colors[k]] = ((y_min / y_w, x_min / x_w, (y_max - y_min + 1) / y_w, (x_max - x_min + 1) / x_w),
+                                       tuple((color_sum / count).astype(int)))
+
+    blocks = []
+    for item in html_text_color_tree:
+        if item[1] in color_blocks:
+            bbox, color = color_blocks[item[1]]
+            blocks.append({'text': item[0].lower(), 'bbox': bbox, 'color': color})
     return blocks
 
 
-def get_itermediate_names(name):
-    return name.replace(".png", ".html"), name.replace(".png", "_p.html"), name.replace(".png", "_p_1.html"), name.replace(".png", "_p.png"), name.replace(".png", "_p_1.png")
+def get_blocks_from_label_image(image, html_text_color_tree, different_mask, original_image):
+    """
+    Same as `get_blocks_from_image_diff_pixels`, but in a single pass over the image instead
+    of one `cv2.inRange` pass per text colour, see `get_text_color_stats`. The block colours
+    are the same as averaging the pixels directly.
 
+    :param image: The colour-perturbed screenshot, as a path, PIL image or RGB array.
+    :param different_mask: The boolean mask of `find_different_pixels_mask`.
+    :param original_image: The unperturbed screenshot, in any format of `load_image_rgb`.
+    """
+    image = load_image_rgb(image)
+    original_image = load_image_rgb(original_image)
+    hex_colors, rgb_colors = get_text_colors(html_text_color_tree)
+    stats = get_text_color_stats(image, different_mask, original_image, rgb_colors)
+    return get_blocks_from_text_color_stats(html_text_color_tree, hex_colors, stats, image.shape)
 
-def get_blocks_ocr_free(image_path, viewport: dict = None):
-    html, p_html, p_html_1, p_png, p_png_1 = get_itermediate_names(image_path)
-    process_html(html, p_html)
-    process_html(html, p_html_1, offset=50)
 
-    take_and_save_screenshot(p_html, output_file=p_png, do_it_again=True, viewport=viewport)
-    take_and_save_screenshot(p_html_1, output_file=p_png_1, do_it_again=True, viewport=viewport)
+def get_blocks_from_tiles(p_img, p_img_1, html_text_color_tree, image) -> list[dict]:
+    """
+    Same as `get_blocks_from_screenshots` with `label_image`, for screenshots of which at
+    least one is a `TiledScreenshot`. The diff mask, the labels and the stats are computed
+    tile by tile, along the tiles of `p_img`, so that the page is never stitched together.
+    The blocks are the same as those of the stitched screenshots.
+    """
+    if p_img.shape != p_img_1.shape:
+        logger.warning(
+            f"[Warning] Images are not the same size, {p_img.shape[1::-1]}, {p_img_1.shape[1::-1]}")
+        return []
 
-    different_pixels = find_different_pixels(p_png, p_png_1)
+    hex_colors, rgb_colors = get_text_colors(html_text_color_tree)
+    stats = {}
+    found_pixels = False
+    for y, p_tile in iter_image_tiles(p_img):
+        stop = y + p_tile.shape[0]
+        different_mask = find_different_pixels_mask(p_tile, image_rows(p_img_1, y, stop))
+        if different_mask is None or not different_mask.any():
+            continue
+        found_pixels = True
+        merge_text_color_stats(stats, get_text_color_stats(
+            p_tile, different_mask, image_rows(image, y, stop), rgb_colors, row_offset=y))
 
-    if different_pixels is None:
+    if not found_pixels:
         logger.warning(
-            f"[Warning] Unable to get pixels with different colors from {p_png}, {p_png_1}...")
+            f"[Warning] Unable to get pixels with different colors from the screenshots...")
+        return []
+    return get_blocks_from_text_color_stats(html_text_color_tree, hex_colors, stats, p_img.shape)
+
+
+def remove_files(*paths):
+    for path in paths:
         try:
-            os.remove(p_html)
-            os.remove(p_png)
-            os.remove(p_html_1)
-            os.remove(p_png_1)
+            os.remove(path)
         except Exception as e:
-            logger.warning(
-                f"[Warning] Unable to remove files {p_html}, {p_png}, {p_html_1}, {p_png_1}...")
+            logger.warning(f"[Warning] Unable to remove file {path}...")
+            logger.warning(traceback.format_exc())
+
+
+def get_blocks_from_screenshots(p_img, p_img_1, html_text_color_tree, image=None, label_image=True):
+    """
+    Extracts the text blocks from both colour-perturbed screenshots. With `label_image`,
+    all text colours are matched in a single pass, see `get_blocks_from_label_image`.
+
+    Screenshots given as paths or PIL images are decoded once here, and every later
+    step works on the decoded arrays. If any screenshot is a `TiledScreenshot`, blocks
+    are extracted tile by tile instead, see `get_blocks_from_tiles`.
+    """
+    if image is None and isinstance(p_img, str):
+        image = p_img.replace("_p.png", ".png")
+    if any(isinstance(img, TiledScreenshot) for img in (p_img, p_img_1, image)):
+        try:
+            p_img, p_img_1, image = [img if isinstance(img, TiledScreenshot) else load_image_rgb(img)
+                                     for img in (p_img, p_img_1, image)]
+            return get_blocks_from_tiles(p_img, p_img_1, html_text_color_tree, image)
+        except:
+            logger.warning(f"[Warning] Unable to get blocks from the screenshots...")
             logger.warning(traceback.format_exc())
+            return []
+    p_img = load_image_rgb(p_img)
+    p_img_1 = load_image_rgb(p_img_1)
+    if image is not None:
+        image = load_image_rgb(image)
+
+    different_pixels = find_different_pixels_mask(p_img, p_img_1)
+
+    if different_pixels is None or not different_pixels.any():
+        logger.warning(
+            f"[Warning] Unable to get pixels with different colors from the screenshots...")
         return []
 
-    html_text_color_tree = flatten_tree(extract_text_with_color(p_html))
     try:
-        blocks = get_blocks_from_image_diff_pixels(
-            p_png, html_text_color_tree, different_pixels)
+        if label_image:
+            return get_blocks_from_label_image(
+                p_img, html_text_color_tree, different_pixels, image)
+        return get_blocks_from_image_diff_pixels(
+            p_img, html_text_color_tree, different_pixels, original_image=image)
     except:
-        logger.warning(f"[Warning] Unable to get blocks from {p_png}...")
-        os.remove(p_html)
-        os.remove(p_png)
-        os.remove(p_html_1)
-        os.remove(p_png_1)
+        logger.warning(f"[Warning] Unable to get blocks from the screenshots...")
+        logger.warning(traceback.format_exc())
         return []
 
-    os.remove(p_html)
-    os.remove(p_png)
-    os.remove(p_html_1)
-    os.remove(p_png_1)
+
+def get_blocks_from_screenshots_many(tasks: list[tuple], label_image=True) -> list[list[dict]]:
+    """
+    Same as `get_blocks_from_screenshots` for every (p_img, p_img_1, html_text_color_tree,
+    image) task. If a process pool is set, see `set_process_pool`, the tasks run in parallel
+    and the screenshot arrays are handed to the workers through shared memory, while tiled
+    screenshots are sent as their PNG tiles.
+
+    Returns:
+        list[list[dict]]: The blocks of every task, in order.
+    """
+    pool = get_process_pool()
+    if pool is None:
+        return [get_blocks_from_screenshots(*task, label_image=label_image) for task in tasks]
+
+    futures = []
+    for p_img, p_img_1, html_text_color_tree, image in tasks:
+        # tiled screenshots are pickled as their PNG tiles, which the worker decodes one by one
+        futures.append(pool.submit(get_blocks_from_screenshots, p_img, p_img_1,
+                       html_text_color_tree, image=image, label_image=label_image))
+
+    blocks = []
+    for task, future in zip(tasks, futures):
+        try:
+            blocks.append(future.result())
+        except Exception:
+            logger.warning(
+                f"[Warning] Unable to extract blocks in the process pool, extracting them inline...")
+            logger.warning(traceback.format_exc())
+            blocks.append(get_blocks_from_screenshots(*task, label_image=label_image))
     return blocks
+
+
+def get_viewport_image_name(html_path, viewport: Viewport):
+    return html_path.replace(".html", f"_{viewport}.png")
+
+
+def prepare_perturbed_html(html_path, html: str = None, parser: str = DEFAULT_HTML_PARSER) -> tuple[str, str, list]:
+    """
+    Returns the two colour-perturbed copies of the html, which is read from `html_path`
+    unless its content is given in `html`. The html is parsed once, see `colorize_html_variants`.
+
+    The copies only depend on the html, so they are reused from the colourization cache
+    for every viewport and evaluation of the same html, see `set_colorization_cache`.
+
+    Returns:
+        tuple[str, str, list]: The content of both copies, and the flattened text colour tree.
+    """
+    if html is None:
+        html = read_html(html_path)
+    cache = get_colorization_cache()
+    key = cache.make_key(html, parser) if cache is not None else None
+    entry = cache.get(key) if cache is not None else None
+    if entry is None:
+        (p_html, p_html_1), html_text_color_tree = colorize_html_variants(html, (0, 50), parser, html_path)
+        entry = (p_html, p_html_1, html_text_color_tree)
+        if cache is not None:
+            cache.put(key, entry)
+    p_html, p_html_1, html_text_color_tree = entry
+    # a copy, so that callers cannot change the cached tree
+    return p_html, p_html_1, list(html_text_color_tree)
+
+
+def get_perturbed_screenshot_jobs(html_path, viewports: list[Viewport], p_html: str, p_html_1: str, debug=False, strategy: LoadStrategy = None) -> list[ScreenshotJob]:
+    """
+    Returns the jobs capturing both colour-perturbed copies returned by
+    `prepare_perturbed_html` at every viewport. The copies are rendered from memory
+    next to `html_path`, and the screenshots are only written to disk when debugging.
+    """
+    jobs = []
+    for suffix, content in [("_p", p_html), ("_p_1", p_html_1)]:
+        output_files = {}
+        if debug:
+            output_files = {viewport: get_viewport_image_name(html_path, viewport).replace(
+                ".png", f"{suffix}.png") for viewport in viewports}
+        jobs.append(ScreenshotJob(html_path, viewports,
+                    output_files=output_files, html=content, strategy=strategy))
+    return jobs
+
+
+def get_blocks_ocr_free_multi_viewport(html_path, images: dict, debug=False, engine=None, html: str = None, strategy: LoadStrategy = None) -> dict:
+    """
+    Extracts the text blocks of the page at every viewport. Each colour-perturbed copy
+    of the page is loaded once and captured at all viewports, instead of once per
+    viewport, and rendered from memory.
+
+    Parameters:
+        html_path (str): The path to the html of the page.
+        images (dict): A mapping of viewport to the unperturbed screenshot as an RGB array.
+        debug (bool): Whether to write the colour-perturbed screenshots to disk.
+        engine (AsyncScreenshotEngine): Optional engine to capture both copies concurrently.
+        html (str): Optional content of the page, read from `html_path` by default.
+        strategy (LoadStrategy): How the copies are loaded and how long each capture may take.
+
+    Returns:
+        dict: A mapping of viewport to the blocks extracted at that viewport.
+    """
+    viewports = list(images.keys())
+    p_html, p_html_1, html_text_color_tree = prepare_perturbed_html(html_path, html)
+    p_imgs, p_imgs_1 = run_screenshot_jobs(
+        get_perturbed_screenshot_jobs(html_path, viewports, p_html, p_html_1, debug=debug, strategy=strategy), engine=engine)
+
+    return dict(zip(viewports, get_blocks_from_screenshots_many([
+        (p_imgs[viewport], p_imgs_1[viewport], html_text_color_tree, images[viewport]) for viewport in viewports])))
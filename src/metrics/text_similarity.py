@@ -0,0 +1,209 @@
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from difflib import SequenceMatcher
+
+import numpy as np
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+SIMILARITY_MODES = ["exact", "approx"]
+
+_similarity_mode = "exact"
+
+
+class SimilarityCache:
+    """
+    A bounded memo of the exact similarity of text pairs, with LRU eviction, so that
+    every distinct pair of an evaluation is only scored once, see `similarity_cache`.
+
+    Parameters:
+        max_entries (int): The number of pairs kept.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, text_a: str, text_b: str) -> float | None:
+        score = self._entries.get((text_a, text_b))
+        if score is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end((text_a, text_b))
+        return score
+
+    def put(self, text_a: str, text_b: str, score: float):
+        self._entries[(text_a, text_b)] = score
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+        }
+
+
+_similarity_cache: ContextVar[SimilarityCache | None] = ContextVar("similarity_cache", default=None)
+_stats_lock = threading.Lock()
+_total_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+@contextmanager
+def similarity_cache(max_entries: int = 100000):
+    """
+    Memoizes the exact text similarities computed within the block, e.g. one evaluation,
+    and drops them afterwards. The hit/miss counts are added to `get_similarity_cache_stats`.
+
+    Yields:
+        SimilarityCache: The cache of the block.
+    """
+    cache = SimilarityCache(max_entries)
+    token = _similarity_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _similarity_cache.reset(token)
+        with _stats_lock:
+            for key in _total_stats:
+                _total_stats[key] += getattr(cache, key)
+
+
+def get_similarity_cache_stats() -> dict:
+    """
+    Returns the hit/miss counts of the similarity caches of every evaluation of this process.
+    """
+    with _stats_lock:
+        lookups = _total_stats["hits"] + _total_stats["misses"]
+        return {**_total_stats, "hit_rate": _total_stats["hits"] / lookups if lookups > 0 else 0.0}
+
+
+def set_similarity_mode(mode: str):
+    """
+    Sets how `similarity_matrix` scores texts by default, see `similarity_matrix`.
+    """
+    global _similarity_mode
+    if mode not in SIMILARITY_MODES:
+        raise ValueError(f"Unknown text similarity mode {mode}, expected one of {SIMILARITY_MODES}")
+    _similarity_mode = mode
+
+
+def get_similarity_mode() -> str:
+    return _similarity_mode
+
+
+def exact_similarity(text_a: str, text_b: str) -> float:
+    """
+    Returns `SequenceMatcher(None, text_a, text_b).ratio()`, memoized within `similarity_cache`.
+    """
+    cache = _similarity_cache.get()
+    score = cache.get(text_a, text_b) if cache is not None else None
+    if score is None:
+        score = SequenceMatcher(None, text_a, text_b).ratio()
+        if cache is not None:
+            cache.put(text_a, text_b, score)
+    return score
+
+
+def exact_similarity_matrix(texts_a: list[str], texts_b: list[str]) -> np.ndarray:
+    """
+    Returns `SequenceMatcher(None, a, b).ratio()` of every pair of texts.
+
+    Every distinct pair is only scored once, and one matcher is kept per text of `texts_b`,
+    so that its index is built once instead of once per pair. Texts without a character in
+    common score 0.0 without matching, which is what `ratio` returns for them. Within
+    `similarity_cache`, pairs scored before are not scored again.
+    """
+    unique_a = list(dict.fromkeys(texts_a))
+    unique_b = list(dict.fromkeys(texts_b))
+    chars_a = [set(text) for text in unique_a]
+    cache = _similarity_cache.get()
+
+    scores = np.zeros((len(unique_a), len(unique_b)))
+    matcher = SequenceMatcher(None)
+    for j, text_b in enumerate(unique_b):
+        chars_b = set(text_b)
+        matcher_ready = False
+        for i, text_a in enumerate(unique_a):
+            if len(text_a) + len(text_b) == 0:
+                scores[i, j] = 1.0
+                continue
+            if chars_a[i].isdisjoint(chars_b):
+                continue
+            score = cache.get(text_a, text_b) if cache is not None else None
+            if score is None:
+                if not matcher_ready:
+                    # the index of the second sequence is cached by the matcher
+                    matcher.set_seq2(text_b)
+                    matcher_ready = True
+                matcher.set_seq1(text_a)
+                score = matcher.ratio()
+                if cache is not None:
+                    cache.put(text_a, text_b, score)
+            scores[i, j] = score
+
+    index_a = {text: i for i, text in enumerate(unique_a)}
+    index_b = {text: j for j, text in enumerate(unique_b)}
+    return scores[np.ix_([index_a[text] for text in texts_a], [index_b[text] for text in texts_b])]
+
+
+def approx_similarity_matrix(texts_a: list[str], texts_b: list[str]) -> np.ndarray:
+    """
+    Returns `SequenceMatcher(None, a, b).quick_ratio()` of every pair of texts, i.e. the
+    share of characters the texts have in common regardless of their order, computed on
+    character count arrays.
+
+    It is an upper bound of `ratio`, and equal to it when the common characters appear in
+    the same order, e.g. for identical texts or texts without common characters.
+    """
+    vocabulary = {char: k for k, char in enumerate(sorted(set("".join(texts_a)) | set("".join(texts_b))))}
+
+    def count_chars(texts):
+        counts = np.zeros((len(texts), len(vocabulary)), dtype=np.int32)
+        for i, text in enumerate(texts):
+            chars, char_counts = np.unique(np.array([vocabulary[char] for char in text], dtype=np.int64),
+                                           return_counts=True)
+            counts[i, chars] = char_counts
+        return counts
+
+    counts_a = count_chars(texts_a)
+    counts_b = count_chars(texts_b)
+    matches = np.zeros((len(texts_a), len(texts_b)), dtype=np.int64)
+    for k in range(len(vocabulary)):
+        matches += np.minimum.outer(counts_a[:, k], counts_b[:, k])
+
+    lengths = np.add.outer(counts_a.sum(axis=1), counts_b.sum(axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(lengths > 0, 2.0 * matches / lengths, 1.0)
+
+
+def similarity_matrix(texts_a: list[str], texts_b: list[str], mode: str = None) -> np.ndarray:
+    """
+    Returns the text similarity of every pair of texts, as an array of shape
+    (len(texts_a), len(texts_b)).
+
+    Parameters:
+        texts_a (list[str]): The texts of the rows.
+        texts_b (list[str]): The texts of the columns.
+        mode (str): "exact" for the same scores as `SequenceMatcher.ratio`, or "approx" for
+            the faster, order-insensitive `SequenceMatcher.quick_ratio`. Defaults to the
+            mode set with `set_similarity_mode`, which is "exact".
+    """
+    mode = mode or _similarity_mode
+    if mode == "exact":
+        return exact_similarity_matrix(texts_a, texts_b)
+    if mode == "approx":
+        return approx_similarity_matrix(texts_a, texts_b)
+    raise ValueError(f"Unknown text similarity mode {mode}, expected one of {SIMILARITY_MODES}")
@@ -2,78 +2,103 @@
 import logging
 import re
 from collections import Counter
-from copy import deepcopy
 import random
 
-from colormath.color_diff import delta_e_cie2000
-from colormath.color_conversions import convert_color
-from colormath.color_objects import sRGBColor, LabColor
 from bs4 import BeautifulSoup, NavigableString, Comment
-import clip
-import torch
 from PIL import Image
-from difflib import SequenceMatcher
 from scipy.optimize import linear_sum_assignment
 import cv2
 import numpy as np
 
-from src.utils.screenshot import take_and_save_screenshot
-from src.utils.dedup_post_gen import check_repetitive_content
-from src.metrics.ocr_free_utils import get_blocks_ocr_free
-# This is a patch for color map, which is not updated for newer version of numpy
+from src.utils.screenshot import DEFAULT_VIEWPORT, LoadStrategy, ScreenshotJob, TiledScreenshot, get_browser_version, run_screenshot_jobs
+from src.utils.dedup_post_gen import check_repetitive_content, remove_repetitive_content
+from src.utils.viewport import Viewport
+from src.metrics.block_store import get_block_store
+from src.metrics.color_similarity import color_similarities_ciede2000
+from src.metrics.dom_block_utils import get_blocks_from_job, get_dom_screenshot_job
+from src.metrics.text_similarity import exact_similarity, similarity_cache, similarity_matrix
+from src.metrics.ocr_free_utils import DEFAULT_HTML_PARSER, get_blocks_from_screenshots_many, get_perturbed_screenshot_jobs, get_viewport_image_name, prepare_perturbed_html, read_html
 
 logger: logging.Logger = logging.getLogger(__name__)
 
-def patch_asscalar(a):
-    return a.item()
+# CLIP is loaded on first use, so that processes which only extract blocks, like the
+# spawned workers of the process pool that import this module again, never load it
+_clip_model = None
 
 
-setattr(np, "asscalar", patch_asscalar)
-
+def get_clip_model() -> tuple:
+    """
+    Returns the CLIP model, its preprocessing and the device it runs on, which are
+    loaded on first use.
+    """
+    global _clip_model
+    if _clip_model is None:
+        import clip
+        import torch
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model, preprocess = clip.load("ViT-B/32", device=device)
+        _clip_model = (model, preprocess, device)
+    return _clip_model
 
 
 def calculate_similarity(block1, block2, max_distance=1.42):
-    text_similarity = SequenceMatcher(
-        None, block1['text'], block2['text']).ratio()
+    text_similarity = exact_similarity(block1['text'], block2['text'])
     return text_similarity
 
 
 def adjust_cost_for_context(cost_matrix, consecutive_bonus=1.0, window_size=20):
+    """
+    Adds a bonus to every cell below -0.5, which is the sum of the 2 * `window_size`
+    lowest other costs within `window_size` rows and columns of it, times
+    `consecutive_bonus`.
+
+    The windows of all such cells are taken at once from the matrix padded with inf, their
+    lowest costs are selected, and the cell itself is removed from them. The lowest costs are summed
+    in the order of a descending sort of every window, so that the sums are the same as
+    adjusting cell by cell.
+    """
     if window_size <= 0:
         return cost_matrix
 
-    n, m = cost_matrix.shape
     adjusted_cost_matrix = np.copy(cost_matrix)
-
-    for i in range(n):
-        for j in range(m):
-            bonus = 0
-            if adjusted_cost_matrix[i][j] >= -0.5:
-                continue
-            nearby_matrix = cost_matrix[max(0, i - window_size):min(
-                n, i + window_size + 1), max(0, j - window_size):min(m, j + window_size + 1)]
-            flattened_array = nearby_matrix.flatten()
-            sorted_array = np.sort(flattened_array)[::-1]
-            sorted_array = np.delete(sorted_array, np.where(
-                sorted_array == cost_matrix[i, j])[0][0])
-            top_k_elements = sorted_array[- window_size * 2:]
-            sum_top_k = np.sum(top_k_elements)
-            bonus = consecutive_bonus * sum_top_k
-            adjusted_cost_matrix[i][j] += bonus
+    rows, cols = np.nonzero(cost_matrix < -0.5)
+    if rows.size == 0:
+        return adjusted_cost_matrix
+
+    size = 2 * window_size + 1
+    k = 2 * window_size
+    padded = np.pad(cost_matrix.astype(np.float64), window_size, constant_values=np.inf)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (size, size))
+    # bound the memory of the windows of a batch of cells to about 32 MB
+    batch_size = max(1, (4 << 20) // (size * size))
+    for start in range(0, rows.size, batch_size):
+        batch_rows, batch_cols = rows[start:start + batch_size], cols[start:start + batch_size]
+        costs = cost_matrix[batch_rows, batch_cols]
+        # only the lowest k + 1 costs of a window can be summed, with the cell among them
+        nearby = windows[batch_rows, batch_cols].reshape(len(batch_rows), -1)
+        nearby = np.sort(np.partition(nearby, k, axis=1)[:, :k + 1], axis=1)
+        # remove one copy of the cost of the cell, or the highest cost if the cell is not
+        # among the lowest ones
+        position = np.minimum((nearby < costs[:, None]).sum(axis=1), k)
+        keep = np.ones(nearby.shape, dtype=bool)
+        keep[np.arange(len(batch_rows)), position] = False
+        nearby = nearby[keep].reshape(len(batch_rows), -1)
+
+        # the lowest 2 * window_size costs, or all of them in windows cut by the border
+        counts = np.minimum(k, np.isfinite(nearby).sum(axis=1))
+        sums = np.zeros(len(batch_rows))
+        for count in np.unique(counts):
+            same = counts == count
+            # summed from the highest to the lowest, like the reversed sort of the loop
+            sums[same] = np.sum(np.ascontiguousarray(nearby[same, :count][:, ::-1]), axis=1)
+        adjusted_cost_matrix[batch_rows, batch_cols] += consecutive_bonus * sums
     return adjusted_cost_matrix
 
 
 def create_cost_matrix(A, B):
-    n = len(A)
-    m = len(B)
-    cost_matrix = np.zeros((n, m))
-    for i in range(n):
-        for j in range(m):
-            cost_matrix[i, j] = -calculate_similarity(A[i], B[j])
-    return cost_matrix
+    # the same as -calculate_similarity of every pair, scored in one call
+    return -similarity_matrix([block['text'] for block in A], [block['text'] for block in B])
 
 
 def draw_matched_bboxes(img1, img2, matched_bboxes):
@@ -120,39 +145,13 @@ def calculate_ratio(h1, h2):
     return max(h1, h2) / min(h1, h2)
 
 
-def rgb_to_lab(rgb):
-    """
-    Convert an RGB color to Lab color space.
-    RGB values should be in the range [0, 255].
-    """
-    # Create an sRGBColor object from RGB values
-    rgb_color = sRGBColor(rgb[0], rgb[1], rgb[2], is_upscaled=True)
-
-    # Convert to Lab color space
-    lab_color = convert_color(rgb_color, LabColor)
-
-    return lab_color
-
-
 def color_similarity_ciede2000(rgb1, rgb2):
     """
     Calculate the color similarity between two RGB colors using the CIEDE2000 formula.
     Returns a similarity score between 0 and 1, where 1 means identical.
+    To score many pairs, use `color_similarities_ciede2000` on all of them at once.
     """
-    # Convert RGB colors to Lab
-    lab1 = rgb_to_lab(rgb1)
-    lab2 = rgb_to_lab(rgb2)
-
-    # Calculate the Delta E (CIEDE2000)
-    delta_e = delta_e_cie2000(lab1, lab2)
-
-    # Normalize the Delta E value to get a similarity score
-    # Note: The normalization method here is arbitrary and can be adjusted based on your needs.
-    # A delta_e of 0 means identical colors. Higher values indicate more difference.
-    # For visualization purposes, we consider a delta_e of 100 to be completely different.
-    similarity = max(0, 1 - (delta_e / 100))
-
-    return similarity
+    return float(color_similarities_ciede2000([rgb1], [rgb2])[0])
 
 
 def calculate_current_cost(cost_matrix, row_ind, col_ind):
@@ -185,14 +184,41 @@ def calculate_current_cost(cost_matrix, row_ind, col_ind):
 
 
 def find_maximum_matching(A, B, consecutive_bonus, window_size):
-    cost_matrix = create_cost_matrix(A, B)
+    return find_maximum_matching_by_similarity(
+        -create_cost_matrix(A, B), consecutive_bonus, window_size)
+
+
+def find_maximum_matching_by_similarity(similarity, consecutive_bonus, window_size):
+    # same as `find_maximum_matching`, given the text similarity of every pair of blocks
     cost_matrix = adjust_cost_for_context(
-        cost_matrix, consecutive_bonus, window_size)
+        -similarity, consecutive_bonus, window_size)
     row_ind, col_ind = linear_sum_assignment(cost_matrix)
     current_cost = calculate_current_cost(cost_matrix, row_ind, col_ind)
     return list(zip(row_ind, col_ind)), current_cost, cost_matrix
 
 
+def get_texts(blocks):
+    return [block['text'] for block in blocks]
+
+
+def update_similarity_rows(similarity, previous_blocks, blocks, other_blocks):
+    """
+    Returns the similarity of `blocks` to `other_blocks`, given the `similarity` of the
+    `previous_blocks` they were merged from. The rows of unchanged blocks are reused, and
+    only the rows of merged blocks are scored.
+    """
+    previous_rows = {id(block): k for k, block in enumerate(previous_blocks)}
+    updated_similarity = np.zeros((len(blocks), len(other_blocks)))
+    merged = [k for k, block in enumerate(blocks) if id(block) not in previous_rows]
+    for k, block in enumerate(blocks):
+        if id(block) in previous_rows:
+            updated_similarity[k] = similarity[previous_rows[id(block)]]
+    if len(merged) > 0:
+        updated_similarity[merged] = similarity_matrix(
+            get_texts([blocks[k] for k in merged]), get_texts(other_blocks))
+    return updated_similarity
+
+
 def remove_indices(lst, indices):
     for index in sorted(indices, reverse=True):
         if index < len(lst):
@@ -253,70 +279,88 @@ def difference_of_means(list1, list2):
 
 
 def find_possible_merge(A, B, consecutive_bonus, window_size, debug=False):
+    """
+    Greedily merges adjacent blocks of A, then of B, while it improves their matching,
+    and returns the merged blocks and their final matching. A is merged in place.
+
+    The text similarity of every pair of blocks is kept between trials. A trial merge
+    only scores the merged block against the other side, and the merged similarities of
+    all adjacent pairs of a side are scored in one call. The matching of every trial is
+    the same as rebuilding the whole cost matrix.
+    """
     merge_bonus = 0.0
     merge_windows = 1
 
     def sortFn(value):
         return value[2]
 
+    similarity = similarity_matrix(get_texts(A), get_texts(B))
     while True:
         A_changed = False
         B_changed = False
 
-        matching, current_cost, cost_matrix = find_maximum_matching(
-            A, B, merge_bonus, merge_windows)
+        matching, current_cost, cost_matrix = find_maximum_matching_by_similarity(
+            similarity, merge_bonus, merge_windows)
         
         logger.debug(f"Current cost of the solution: {current_cost}")
         logger.debug(f"{matching}, {A}, {B}, {cost_matrix}")
 
         if len(A) >= 2:
             merge_list = []
+            merged_texts = [merge_blocks_wo_check(A[i], A[i + 1])['text'] for i in range(len(A) - 1)]
+            merged_rows = similarity_matrix(merged_texts, get_texts(B))
             for i in range(len(A) - 1):
-                new_A = deepcopy(A)
-                new_A[i] = merge_blocks_wo_check(new_A[i], new_A[i + 1])
-                new_A.pop(i + 1)
+                # the similarity of A with blocks i and i + 1 merged
+                updated_similarity = np.delete(similarity, i + 1, axis=0)
+                updated_similarity[i] = merged_rows[i]
 
-                updated_matching, updated_cost, cost_matrix = find_maximum_matching(
-                    new_A, B, merge_bonus, merge_windows)
+                updated_matching, updated_cost, cost_matrix = find_maximum_matching_by_similarity(
+                    updated_similarity, merge_bonus, merge_windows)
                 diff = difference_of_means(current_cost, updated_cost)
                 if diff > 0.05:
                     merge_list.append([i, i + 1, diff])
-                    logger.debug(f"{new_A[i]['text']}, {diff}")
+                    logger.debug(f"{merged_texts[i]}, {diff}")
 
             merge_list.sort(key=sortFn, reverse=True)
             if len(merge_list) > 0:
                 A_changed = True
+                previous_A = list(A)
                 A = merge_blocks_by_list(A, merge_list)
-                matching, current_cost, cost_matrix = find_maximum_matching(
-                    A, B, merge_bonus, merge_windows)
+                similarity = update_similarity_rows(similarity, previous_A, A, B)
+                matching, current_cost, cost_matrix = find_maximum_matching_by_similarity(
+                    similarity, merge_bonus, merge_windows)
                 logger.debug(f"Cost after optimization A: {current_cost}")
 
         if len(B) >= 2:
             merge_list = []
+            merged_texts = [merge_blocks_wo_check(B[i], B[i + 1])['text'] for i in range(len(B) - 1)]
+            merged_columns = similarity_matrix(get_texts(A), merged_texts)
             for i in range(len(B) - 1):
-                new_B = deepcopy(B)
-                new_B[i] = merge_blocks_wo_check(new_B[i], new_B[i + 1])
-                new_B.pop(i + 1)
+                # the similarity of B with blocks i and i + 1 merged
+                updated_similarity = np.delete(similarity, i + 1, axis=1)
+                updated_similarity[:, i] = merged_columns[:, i]
 
-                updated_matching, updated_cost, cost_matrix = find_maximum_matching(
-                    A, new_B, merge_bonus, merge_windows)
+                updated_matching, updated_cost, cost_matrix = find_maximum_matching_by_similarity(
+                    updated_similarity, merge_bonus, merge_windows)
                 diff = difference_of_means(current_cost, updated_cost)
                 if diff > 0.05:
                     merge_list.append([i, i + 1, diff])
-                    logger.debug(f"{new_B[i]['text']}, {diff}")
+                    logger.debug(f"{merged_texts[i]}, {diff}")
 
             merge_list.sort(key=sortFn, reverse=True)
             if len(merge_list) > 0:
                 B_changed = True
+                previous_B = list(B)
                 B = merge_blocks_by_list(B, merge_list)
-                matching, current_cost, cost_matrix = find_maximum_matching(
-                    A, B, merge_bonus, merge_windows)
+                similarity = update_similarity_rows(similarity.T, previous_B, B, A).T
+                matching, current_cost, cost_matrix = find_maximum_matching_by_similarity(
+                    similarity, merge_bonus, merge_windows)
                 logger.debug(f"Cost after optimization B: {current_cost}")
 
         if not A_changed and not B_changed:
             break
-    matching, _, _ = find_maximum_matching(
-        A, B, consecutive_bonus, window_size)
+    matching, _, _ = find_maximum_matching_by_similarity(
+        similarity, consecutive_bonus, window_size)
     return A, B, matching
 
 
@@ -339,37 +383,69 @@ def merge_blocks_by_bbox(blocks):
     return list(merged_blocks.values())
 
 
-def mask_bounding_boxes_with_inpainting(image, bounding_boxes):
-    # Convert PIL image to OpenCV format
-    image_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-
+def inpaint_bounding_boxes(rows, bounding_boxes, width, height, row_offset=0):
+    """
+    Inpaints the bounding boxes, relative to an image of the given size, within `rows`,
+    the RGB rows of that image starting at `row_offset`.
+    """
     # Create a black mask
-    mask = np.zeros(image_cv.shape[:2], dtype=np.uint8)
-
-    height, width = image_cv.shape[:2]
+    mask = np.zeros(rows.shape[:2], dtype=np.uint8)
 
     # Draw white rectangles on the mask
     for bbox in bounding_boxes:
         x_ratio, y_ratio, w_ratio, h_ratio = bbox
         x = int(x_ratio * width)
-        y = int(y_ratio * height)
+        y = int(y_ratio * height) - row_offset
         w = int(w_ratio * width)
         h = int(h_ratio * height)
-        mask[y:y+h, x:x+w] = 255
+        mask[max(0, y):max(0, y+h), x:x+w] = 255
 
-    # Use inpainting
-    inpainted_image = cv2.inpaint(image_cv, mask, 3, cv2.INPAINT_TELEA)
+    # Use inpainting, which works on OpenCV's BGR images
+    inpainted = cv2.inpaint(cv2.cvtColor(rows, cv2.COLOR_RGB2BGR), mask, 3, cv2.INPAINT_TELEA)
+    return cv2.cvtColor(inpainted, cv2.COLOR_BGR2RGB)
 
-    # Convert back to PIL format
-    inpainted_image_pil = Image.fromarray(
-        cv2.cvtColor(inpainted_image, cv2.COLOR_BGR2RGB))
 
-    return inpainted_image_pil
+def mask_bounding_boxes_with_inpainting(image, bounding_boxes):
+    image = np.array(image)
+    height, width = image.shape[:2]
+    return Image.fromarray(inpaint_bounding_boxes(image, bounding_boxes, width, height))
 
 
-def rescale_and_mask(image_path, blocks):
-    # Load the image
-    with Image.open(image_path) as img:
+def rescale_and_mask_tiles(image: TiledScreenshot, blocks, margin=16):
+    """
+    Same as `rescale_and_mask` for a `TiledScreenshot`, one tile at a time, so that the
+    page is never stitched together. Every tile is inpainted together with `margin` rows
+    of its neighbours, so that boxes across tile borders are filled from both sides, and
+    is then rescaled into its share of the square image.
+    """
+    width, height = image.width, image.height
+    side = min(width, height)
+    img_resized = Image.new("RGB", (side, side))
+    ends = image.offsets[1:] + [height]
+    for y, end in zip(image.offsets, ends):
+        top, bottom = round(y * side / height), round(end * side / height)
+        if bottom <= top:
+            continue
+        start = max(0, y - margin)
+        rows = image.rows(start, end + margin)
+        if len(blocks) > 0:
+            rows = inpaint_bounding_boxes(rows, blocks, width, height, row_offset=start)
+        with Image.fromarray(rows[y - start:end - start]) as tile:
+            img_resized.paste(tile.resize((side, bottom - top), Image.LANCZOS), (0, top))
+    return img_resized
+
+
+def rescale_and_mask(image, blocks):
+    # Load the image, which can be a path, a PIL image, an RGB array or a tiled screenshot
+    if isinstance(image, TiledScreenshot):
+        return rescale_and_mask_tiles(image, blocks)
+    if isinstance(image, str):
+        img = Image.open(image)
+    elif isinstance(image, np.ndarray):
+        img = Image.fromarray(image)
+    else:
+        img = image
+    with img:
         if len(blocks) > 0:
             # use inpainting instead of simple mask
             img = mask_bounding_boxes_with_inpainting(img, blocks)
@@ -390,12 +466,15 @@ def rescale_and_mask(image_path, blocks):
         return img_resized
 
 
-def calculate_clip_similarity_with_blocks(image_path1, image_path2, blocks1, blocks2):
+def calculate_clip_similarity_with_blocks(image1, image2, blocks1, blocks2):
+    import torch
+
+    model, preprocess, device = get_clip_model()
     # Load and preprocess images
     image1 = preprocess(rescale_and_mask(
-        image_path1, [block['bbox'] for block in blocks1])).unsqueeze(0).to(device)
+        image1, [block['bbox'] for block in blocks1])).unsqueeze(0).to(device)
     image2 = preprocess(rescale_and_mask(
-        image_path2, [block['bbox'] for block in blocks2])).unsqueeze(0).to(device)
+        image2, [block['bbox'] for block in blocks2])).unsqueeze(0).to(device)
 
     # Calculate features
     with torch.no_grad():
@@ -432,12 +511,18 @@ def truncate_repeated_html_elements(soup, max_count=50):
     return str(soup)
 
 
+def wrap_html(content):
+    if not re.search(r'<html[^>]*>', content, re.IGNORECASE):
+        return f'<html><body><p>{content}</p></body></html>'
+    return content
+
+
 def make_html(filename):
     with open(filename, 'r', encoding="utf-8", errors="replace") as file:
         content = file.read()
 
-    if not re.search(r'<html[^>]*>', content, re.IGNORECASE):
-        new_content = f'<html><body><p>{content}</p></body></html>'
+    new_content = wrap_html(content)
+    if new_content != content:
         with open(filename, 'w', encoding="utf-8", errors="replace") as file:
             file.write(new_content)
 
@@ -452,164 +537,281 @@ def pre_process(html_file):
         file.write(soup_str)
 
 
-def visual_eval_v3_multi(input_list, debug=False, viewport: dict=None):
-    predict_html_list, original_html = input_list[0], input_list[1]
-    predict_img_list = [html.replace(".html", ".png")
-                        for html in predict_html_list]
-    # try:
-    predict_blocks_list = []
-    for predict_html in predict_html_list:
-        predict_img = predict_html.replace(".html", ".png")
-        # This will help fix some html syntax error
-        pre_process(predict_html)
-        take_and_save_screenshot(predict_html, predict_img, do_it_again=True,viewport=viewport)
-        predict_blocks = get_blocks_ocr_free(predict_img, viewport=viewport)
-        predict_blocks_list.append(predict_blocks)
-
-    original_img = original_html.replace(".html", ".png")
-    take_and_save_screenshot(original_html, original_img, do_it_again=True,viewport=viewport)
-    original_blocks = get_blocks_ocr_free(original_img, viewport=viewport)
-    original_blocks = merge_blocks_by_bbox(original_blocks)
+def pre_process_html(html, html_file=""):
+    """
+    Same as `pre_process`, but returns the processed html instead of rewriting the file.
+    `html_file` is only used for logging.
+    """
+    html = wrap_html(remove_repetitive_content(html, html_file))
+    return truncate_repeated_html_elements(BeautifulSoup(html, 'html.parser'))
 
-    # Consider context similarity for block matching
-    consecutive_bonus, window_size = 0.1, 1
 
-    return_score_list = []
+def calculate_visual_score(predict_img, original_img, predict_blocks, original_blocks, debug=False, predict_name=None, original_name=None):
+    """
+    Scores the predicted page against the original page, given the screenshots and the
+    text blocks extracted from both. The original blocks are expected to be merged by bbox.
 
-    for k, predict_blocks in enumerate(predict_blocks_list):
-        if len(predict_blocks) == 0:
-            logger.warning("[Warning] No detected blocks in: %s",
-                           predict_img_list[k])
-            final_clip_score = calculate_clip_similarity_with_blocks(
-                predict_img_list[k], original_img, predict_blocks, original_blocks)
-            return_score_list.append(
-                [0.0, 0.2 * final_clip_score, (0.0, 0.0, 0.0, 0.0, final_clip_score)])
-            continue
-        elif len(original_blocks) == 0:
-            logger.warning("[Warning] No detected blocks in: %s", original_img)
-            final_clip_score = calculate_clip_similarity_with_blocks(
-                predict_img_list[k], original_img, predict_blocks, original_blocks)
-            return_score_list.append(
-                [0.0, 0.2 * final_clip_score, (0.0, 0.0, 0.0, 0.0, final_clip_score)])
+    The screenshots can be paths or RGB arrays. The names are only used for logging, and
+    default to the paths.
+
+    Returns:
+        list: [sum_sum_areas, final_score, (size_score, text_score, position_score, color_score, clip_score)]
+    """
+    # Consider context similarity for block matching
+    consecutive_bonus, window_size = 0.1, 1
+    predict_name = predict_name or predict_img
+    original_name = original_name or original_img
+
+    if len(predict_blocks) == 0:
+        logger.warning("[Warning] No detected blocks in: %s",
+                       predict_name)
+        final_clip_score = calculate_clip_similarity_with_blocks(
+            predict_img, original_img, predict_blocks, original_blocks)
+        return [0.0, 0.2 * final_clip_score, (0.0, 0.0, 0.0, 0.0, final_clip_score)]
+    elif len(original_blocks) == 0:
+        logger.warning("[Warning] No detected blocks in: %s", original_name)
+        final_clip_score = calculate_clip_similarity_with_blocks(
+            predict_img, original_img, predict_blocks, original_blocks)
+        return [0.0, 0.2 * final_clip_score, (0.0, 0.0, 0.0, 0.0, final_clip_score)]
+
+    
+    logger.debug(predict_blocks)
+    logger.debug(original_blocks)
+
+    predict_blocks = merge_blocks_by_bbox(predict_blocks)
+    predict_blocks_m, original_blocks_m, matching = find_possible_merge(
+        predict_blocks, list(original_blocks), consecutive_bonus, window_size, debug=debug)
+
+    filtered_matching = []
+    for i, j in matching:
+        text_similarity = exact_similarity(
+            predict_blocks_m[i]['text'], original_blocks_m[j]['text'])
+        # Filter out matching with low similarity
+        if text_similarity < 0.5:
             continue
+        filtered_matching.append([i, j, text_similarity])
+    matching = filtered_matching
+
+    indices1 = [item[0] for item in matching]
+    indices2 = [item[1] for item in matching]
+
+    matched_list = []
+    sum_areas = []
+    matched_areas = []
+    matched_text_scores = []
+    position_scores = []
+    text_color_scores = []
+
+    unmatched_area_1 = 0.0
+    for i in range(len(predict_blocks_m)):
+        if i not in indices1:
+            unmatched_area_1 += predict_blocks_m[i]['bbox'][2] * \
+                predict_blocks_m[i]['bbox'][3]
+    unmatched_area_2 = 0.0
+    for j in range(len(original_blocks_m)):
+        if j not in indices2:
+            unmatched_area_2 += original_blocks_m[j]['bbox'][2] * \
+                original_blocks_m[j]['bbox'][3]
+    sum_areas.append(unmatched_area_1 + unmatched_area_2)
+
+    # Normalized ciede2000 formula, scored for all matched pairs at once
+    text_color_similarities = color_similarities_ciede2000(
+        [predict_blocks_m[i]['color'] for i, _, _ in matching],
+        [original_blocks_m[j]['color'] for _, j, _ in matching])
+
+    for (i, j, text_similarity), text_color_similarity in zip(matching, text_color_similarities.tolist()):
+        sum_block_area = predict_blocks_m[i]['bbox'][2] * predict_blocks_m[i]['bbox'][3] + \
+            original_blocks_m[j]['bbox'][2] * \
+            original_blocks_m[j]['bbox'][3]
+
+        # Consider the max postion shift, either horizontally or vertically
+        position_similarity = 1 - calculate_distance_max_1d(predict_blocks_m[i]['bbox'][0] + predict_blocks_m[i]['bbox'][2] / 2,
+                                                            predict_blocks_m[i]['bbox'][1] +
+                                                            predict_blocks_m[i]['bbox'][3] / 2,
+                                                            original_blocks_m[j]['bbox'][0] +
+                                                            original_blocks_m[j]['bbox'][2] / 2,
+                                                            original_blocks_m[j]['bbox'][1] + original_blocks_m[j]['bbox'][3] / 2)
+        matched_list.append(
+            [predict_blocks_m[i]['bbox'], original_blocks_m[j]['bbox']])
+
+        # validation check
+        if min(predict_blocks_m[i]['bbox'][2], original_blocks_m[j]['bbox'][2], predict_blocks_m[i]['bbox'][3], original_blocks_m[j]['bbox'][3]) == 0:
+            logger.info(
+                f"{predict_blocks_m[i]} matched with {original_blocks_m[j]}")
+        assert calculate_ratio(predict_blocks_m[i]['bbox'][2], original_blocks_m[j]['bbox'][2]) > 0 and calculate_ratio(
+            predict_blocks_m[i]['bbox'][3], original_blocks_m[j]['bbox'][3]) > 0, f"{predict_blocks_m[i]} matched with {original_blocks_m[j]}"
+
+        sum_areas.append(sum_block_area)
+        matched_areas.append(sum_block_area)
+        matched_text_scores.append(text_similarity)
+        position_scores.append(position_similarity)
+        text_color_scores.append(text_color_similarity)
 
         
-        logger.debug(predict_blocks)
-        logger.debug(original_blocks)
-
-        predict_blocks = merge_blocks_by_bbox(predict_blocks)
-        predict_blocks_m, original_blocks_m, matching = find_possible_merge(
-            predict_blocks, deepcopy(original_blocks), consecutive_bonus, window_size, debug=debug)
-
-        filtered_matching = []
-        for i, j in matching:
-            text_similarity = SequenceMatcher(
-                None, predict_blocks_m[i]['text'], original_blocks_m[j]['text']).ratio()
-            # Filter out matching with low similarity
-            if text_similarity < 0.5:
-                continue
-            filtered_matching.append([i, j, text_similarity])
-        matching = filtered_matching
-
-        indices1 = [item[0] for item in matching]
-        indices2 = [item[1] for item in matching]
-
-        matched_list = []
-        sum_areas = []
-        matched_areas = []
-        matched_text_scores = []
-        position_scores = []
-        text_color_scores = []
-
-        unmatched_area_1 = 0.0
-        for i in range(len(predict_blocks_m)):
-            if i not in indices1:
-                unmatched_area_1 += predict_blocks_m[i]['bbox'][2] * \
-                    predict_blocks_m[i]['bbox'][3]
-        unmatched_area_2 = 0.0
-        for j in range(len(original_blocks_m)):
-            if j not in indices2:
-                unmatched_area_2 += original_blocks_m[j]['bbox'][2] * \
-                    original_blocks_m[j]['bbox'][3]
-        sum_areas.append(unmatched_area_1 + unmatched_area_2)
-
-        for i, j, text_similarity in matching:
-            sum_block_area = predict_blocks_m[i]['bbox'][2] * predict_blocks_m[i]['bbox'][3] + \
-                original_blocks_m[j]['bbox'][2] * \
-                original_blocks_m[j]['bbox'][3]
+        logger.debug(
+            f"{predict_blocks_m[i]} matched with {original_blocks_m[j]}")
+        logger.debug(exact_similarity(
+            predict_blocks_m[i]['text'], original_blocks_m[j]['text']))
+        logger.debug(f"text similarity score {text_similarity}")
+        logger.debug(f"position score {position_similarity}")
+        logger.debug(f"color score {text_color_similarity}")
+        logger.debug("----------------------------------")
+    """
+    if debug:
+        img1 = cv2.imread(predict_img)
+        img2 = cv2.imread(original_img)
+        img1_with_boxes, img2_with_boxes = draw_matched_bboxes(img1, img2, matched_list)
+    
+        plt.figure(figsize=(20, 10))
+        plt.subplot(1, 2, 1)
+        plt.imshow(cv2.cvtColor(img1_with_boxes, cv2.COLOR_BGR2RGB))
+        plt.axis('off')
+        plt.subplot(1, 2, 2)
+        plt.imshow(cv2.cvtColor(img2_with_boxes, cv2.COLOR_BGR2RGB))
+        plt.axis('off')
+        plt.show()
+    # """
+
+    if len(matched_areas) > 0:
+        sum_sum_areas = np.sum(sum_areas)
+
+        final_size_score = np.sum(matched_areas) / np.sum(sum_areas)
+        final_matched_text_score = np.mean(matched_text_scores)
+        final_position_score = np.mean(position_scores)
+        final_text_color_score = np.mean(text_color_scores)
+        final_clip_score = calculate_clip_similarity_with_blocks(
+            predict_img, original_img, predict_blocks, original_blocks)
+        final_score = 0.2 * (final_size_score + final_matched_text_score +
+                             final_position_score + final_text_color_score + final_clip_score)
+        return [sum_sum_areas, final_score, (final_size_score, final_matched_text_score,
+                final_position_score, final_text_color_score, final_clip_score)]
+    else:
+        logger.warning("[Warning] No matched blocks in: %s",
+                    predict_name)
+        final_clip_score = calculate_clip_similarity_with_blocks(
+            predict_img, original_img, predict_blocks, original_blocks)
+        return [0.0, 0.2 * final_clip_score, (0.0, 0.0, 0.0, 0.0, final_clip_score)]
 
-            # Consider the max postion shift, either horizontally or vertically
-            position_similarity = 1 - calculate_distance_max_1d(predict_blocks_m[i]['bbox'][0] + predict_blocks_m[i]['bbox'][2] / 2,
-                                                                predict_blocks_m[i]['bbox'][1] +
-                                                                predict_blocks_m[i]['bbox'][3] / 2,
-                                                                original_blocks_m[j]['bbox'][0] +
-                                                                original_blocks_m[j]['bbox'][2] / 2,
-                                                                original_blocks_m[j]['bbox'][1] + original_blocks_m[j]['bbox'][3] / 2)
-            # Normalized ciede2000 formula
-            text_color_similarity = color_similarity_ciede2000(
-                predict_blocks_m[i]['color'], original_blocks_m[j]['color'])
-            matched_list.append(
-                [predict_blocks_m[i]['bbox'], original_blocks_m[j]['bbox']])
-
-            # validation check
-            if min(predict_blocks_m[i]['bbox'][2], original_blocks_m[j]['bbox'][2], predict_blocks_m[i]['bbox'][3], original_blocks_m[j]['bbox'][3]) == 0:
-                logger.info(
-                    f"{predict_blocks_m[i]} matched with {original_blocks_m[j]}")
-            assert calculate_ratio(predict_blocks_m[i]['bbox'][2], original_blocks_m[j]['bbox'][2]) > 0 and calculate_ratio(
-                predict_blocks_m[i]['bbox'][3], original_blocks_m[j]['bbox'][3]) > 0, f"{predict_blocks_m[i]} matched with {original_blocks_m[j]}"
-
-            sum_areas.append(sum_block_area)
-            matched_areas.append(sum_block_area)
-            matched_text_scores.append(text_similarity)
-            position_scores.append(position_similarity)
-            text_color_scores.append(text_color_similarity)
-
-            
-            logger.debug(
-                f"{predict_blocks_m[i]} matched with {original_blocks_m[j]}")
-            logger.debug(SequenceMatcher(
-                None, predict_blocks_m[i]['text'], original_blocks_m[j]['text']).ratio())
-            logger.debug(f"text similarity score {text_similarity}")
-            logger.debug(f"position score {position_similarity}")
-            logger.debug(f"color score {text_color_similarity}")
-            logger.debug("----------------------------------")
-        """
+
+def visual_eval_v3_multi(input_list, debug=False, viewport: dict=None, engine=None, strategy: LoadStrategy = None, block_method="pixel", html_parser: str = DEFAULT_HTML_PARSER):
+    """
+    Scores every predicted html against the original html at the given viewport.
+    See `visual_eval_v3_multi_viewports`.
+    """
+    viewport = Viewport(**(viewport or DEFAULT_VIEWPORT))
+    return visual_eval_v3_multi_viewports(input_list, [viewport], debug=debug, engine=engine, strategy=strategy, block_method=block_method, html_parser=html_parser)[viewport]
+
+
+def visual_eval_v3_multi_viewports(input_list, viewports: list[Viewport], debug=False, engine=None, strategy: LoadStrategy = None, block_method="pixel", html_parser: str = DEFAULT_HTML_PARSER) -> dict:
+    """
+    Scores every predicted html against the original html at each of the given viewports.
+    Each page is loaded once and captured at all viewports, instead of once per viewport.
+
+    Screenshots are kept in memory, and only written next to the html when debugging. The
+    predicted html files are pre-processed in memory and rendered from strings, so they
+    are left untouched on disk.
+
+    Parameters:
+        input_list (list): [list of predicted html paths, original html path]
+        viewports (list[Viewport]): The viewports to evaluate.
+        debug (bool): Whether to write the screenshots to disk.
+        engine (AsyncScreenshotEngine): Optional engine to capture all pages concurrently.
+        strategy (LoadStrategy): How the pages are loaded and how long each capture may take.
+        block_method (str): "pixel" to extract the text blocks by diffing two colour-perturbed
+            renders of every page, or "dom" to read them from the geometry of a single render.
+            The blocks of the original page are read from the block store if one is set,
+            see `set_block_store`.
+        html_parser (str): The BeautifulSoup parser the html is colour-perturbed with by the
+            "pixel" method, e.g. "lxml", see `make_soup`.
+
+    Returns:
+        dict: A mapping of viewport to a score list, with one entry per predicted html.
+    """
+    predict_html_list, original_html = input_list[0], input_list[1]
+    # try:
+    # This will help fix some html syntax error
+    contents = [pre_process_html(read_html(predict_html), predict_html)
+                for predict_html in predict_html_list]
+    contents.append(read_html(original_html))
+
+    html_list = predict_html_list + [original_html]
+    # the blocks of the original page are the same for every model, so they may be stored
+    store = get_block_store()
+    original_keys = store.make_keys(original_html, contents[-1], viewports, block_method, get_browser_version(engine), strategy, html_parser) if store is not None else {}
+    original_blocks = {viewport: store.get(key) for viewport, key in original_keys.items()}
+    extract_original = store is None or any(blocks is None for blocks in original_blocks.values())
+    extract_list = html_list if extract_original else predict_html_list
+    # otherwise, the original page is only captured
+    capture_jobs = []
+    if not extract_original:
+        output_files = {}
         if debug:
-            img1 = cv2.imread(predict_img_list[k])
-            img2 = cv2.imread(original_img)
-            img1_with_boxes, img2_with_boxes = draw_matched_bboxes(img1, img2, matched_list)
-        
-            plt.figure(figsize=(20, 10))
-            plt.subplot(1, 2, 1)
-            plt.imshow(cv2.cvtColor(img1_with_boxes, cv2.COLOR_BGR2RGB))
-            plt.axis('off')
-            plt.subplot(1, 2, 2)
-            plt.imshow(cv2.cvtColor(img2_with_boxes, cv2.COLOR_BGR2RGB))
-            plt.axis('off')
-            plt.show()
-        # """
-
-        if len(matched_areas) > 0:
-            sum_sum_areas = np.sum(sum_areas)
-
-            final_size_score = np.sum(matched_areas) / np.sum(sum_areas)
-            final_matched_text_score = np.mean(matched_text_scores)
-            final_position_score = np.mean(position_scores)
-            final_text_color_score = np.mean(text_color_scores)
-            final_clip_score = calculate_clip_similarity_with_blocks(
-                predict_img_list[k], original_img, predict_blocks, original_blocks)
-            final_score = 0.2 * (final_size_score + final_matched_text_score +
-                                 final_position_score + final_text_color_score + final_clip_score)
-            return_score_list.append([sum_sum_areas, final_score, (final_size_score, final_matched_text_score,
-                                     final_position_score, final_text_color_score, final_clip_score)])
-        else:
-            logger.warning("[Warning] No matched blocks in: %s",
-                        predict_img_list[k])
-            final_clip_score = calculate_clip_similarity_with_blocks(
-                predict_img_list[k], original_img, predict_blocks, original_blocks)
-            return_score_list.append(
-                [0.0, 0.2 * final_clip_score, (0.0, 0.0, 0.0, 0.0, final_clip_score)])
-    return return_score_list
+            output_files = {viewport: get_viewport_image_name(
+                original_html, viewport) for viewport in viewports}
+        capture_jobs.append(ScreenshotJob(original_html, viewports, output_files=output_files, html=contents[-1], strategy=strategy))
+
+    images_list = []
+    blocks_list = []
+    if block_method == "dom":
+        # capture every page once, together with its text geometry
+        jobs = []
+        for html, content in zip(extract_list, contents):
+            output_files = {}
+            if debug:
+                output_files = {viewport: get_viewport_image_name(
+                    html, viewport) for viewport in viewports}
+            jobs.append(get_dom_screenshot_job(html, viewports, html=content, output_files=output_files, strategy=strategy))
+        results = run_screenshot_jobs(jobs + capture_jobs, engine=engine)
+        for job, images in zip(jobs, results):
+            images_list.append(images)
+            blocks_list.append(get_blocks_from_job(job, images))
+    else:
+        # capture every page, and both of its colour-perturbed copies, in one batch
+        jobs = []
+        html_text_color_trees = []
+        for html, content in zip(extract_list, contents):
+            p_html, p_html_1, html_text_color_tree = prepare_perturbed_html(html, content, html_parser)
+            html_text_color_trees.append(html_text_color_tree)
+            output_files = {}
+            if debug:
+                output_files = {viewport: get_viewport_image_name(
+                    html, viewport) for viewport in viewports}
+            jobs.append(ScreenshotJob(html, viewports, output_files=output_files, html=content, strategy=strategy))
+            jobs += get_perturbed_screenshot_jobs(html, viewports, p_html, p_html_1, debug=debug, strategy=strategy)
+        results = run_screenshot_jobs(jobs + capture_jobs, engine=engine)
+
+        # extract the blocks of every page at every viewport at once, in parallel with a process pool
+        tasks = []
+        for k in range(len(extract_list)):
+            images, p_imgs, p_imgs_1 = results[3 * k:3 * k + 3]
+            images_list.append(images)
+            tasks += [(p_imgs[viewport], p_imgs_1[viewport], html_text_color_trees[k], images[viewport])
+                      for viewport in viewports]
+        blocks = get_blocks_from_screenshots_many(tasks)
+        for k in range(len(extract_list)):
+            blocks_list.append(dict(zip(viewports, blocks[k * len(viewports):(k + 1) * len(viewports)])))
+
+    if extract_original:
+        original_images, original_blocks = images_list.pop(), blocks_list.pop()
+        for viewport, key in original_keys.items():
+            # no blocks may be a failed render, which falls back to a blank image
+            if len(original_blocks[viewport]) > 0:
+                store.put(key, original_blocks[viewport])
+    else:
+        original_images = results[-1]
+
+    return_score_dict = {}
+    # the same texts are compared at every viewport and merge trial, so they are memoized
+    with similarity_cache() as cache:
+        for viewport in viewports:
+            original_blocks_v = merge_blocks_by_bbox(original_blocks[viewport])
+            return_score_dict[viewport] = []
+            for k, predict_html in enumerate(predict_html_list):
+                return_score_dict[viewport].append(calculate_visual_score(
+                    images_list[k][viewport], original_images[viewport], blocks_list[k][viewport], original_blocks_v, debug=debug,
+                    predict_name=get_viewport_image_name(predict_html, viewport), original_name=get_viewport_image_name(original_html, viewport)))
+    logger.debug(f"Text similarity cache of {original_html}: {cache.stats()}")
+    return return_score_dict
 
     # except:
     #     print("[Warning] Error not handled in: ", input_list)
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import threading
+import traceback
+
+from playwright.async_api import async_playwright
+
+from src.utils.render_timings import get_render_timings
+from src.utils.screenshot import DEFAULT_LOAD_STRATEGY, PAGE_SIZE_SCRIPT, RENDER_OPTIONS, LoadStrategy, ScreenshotJob, TiledScreenshot, blank_screenshot, get_cache_keys, get_navigation, is_cacheable, is_clipped, is_past, mark_clipped, png_to_image, save_screenshot
+from src.utils.screenshot_cache import get_screenshot_cache
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class AsyncScreenshotEngine:
+    """
+    A screenshot engine built on Playwright's async API, which captures many pages
+    concurrently so that Chromium's renderers keep several cores busy.
+
+    The engine runs its own event loop on a background thread, so it can be used from
+    synchronous code like `visual_eval_v3_multi` through `capture_many`. It keeps one
+    browser, and every capture attempt runs in a fresh browser context, of which at most
+    `max_contexts` are open at once, so that no state carries over between pages. If the
+    browser crashes, it is relaunched and the affected captures are retried.
+
+    Example:
+        with AsyncScreenshotEngine(max_contexts=4) as engine:
+            images = engine.capture_many([ScreenshotJob(html_path, viewports)])
+
+    Parameters:
+        max_contexts (int): The number of captures in flight, each in its own browser context.
+        launch_options (dict): Keyword arguments passed to `chromium.launch`.
+    """
+
+    def __init__(self, max_contexts: int = 4, launch_options: dict = None):
+        self.max_contexts = max_contexts
+        self.launch_options = launch_options or {}
+        self.launch_count = 0
+        self._loop = None
+        self._thread = None
+        self._playwright = None
+        self._browser = None
+        self._slots = None
+        self._launch_lock = None
+
+    @property
+    def concurrency(self) -> int:
+        return self.max_contexts
+
+    @property
+    def browser_version(self) -> str:
+        self.start()
+        return self._browser.version
+
+    def __enter__(self) -> 'AsyncScreenshotEngine':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def start(self) -> 'AsyncScreenshotEngine':
+        if self._thread is not None:
+            return self
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="AsyncScreenshotEngine", daemon=True)
+        self._thread.start()
+        self._run(self._start())
+        return self
+
+    def close(self):
+        if self._thread is None:
+            return
+        try:
+            self._run(self._close())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._thread = None
+            self._loop = None
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def capture_many(self, jobs: list[ScreenshotJob]) -> list[dict]:
+        """
+        Captures the given jobs concurrently, blocking until all of them are done.
+
+        Returns:
+            list[dict]: For every job in order, a mapping of viewport to the RGB array.
+        """
+        self.start()
+        return self._run(self.capture_many_async(jobs))
+
+    async def capture_many_async(self, jobs: list[ScreenshotJob]) -> list[dict]:
+        return await asyncio.gather(*[self._capture_job(job) for job in jobs])
+
+    async def _start(self):
+        self._playwright = await async_playwright().start()
+        self._slots = asyncio.Semaphore(self.max_contexts)
+        self._launch_lock = asyncio.Lock()
+        await self._launch()
+
+    async def _close(self):
+        if self._browser is not None:
+            try:
+                await self._browser.close()
+            except Exception as e:
+                logger.debug(f"Ignoring error while closing browser: {e}")
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def _launch(self):
+        if self._browser is not None:
+            logger.warning("Browser is not healthy. Relaunching.")
+            try:
+                await self._browser.close()
+            except Exception as e:
+                logger.debug(f"Ignoring error while closing browser: {e}")
+        self._browser = await self._playwright.chromium.launch(**self.launch_options)
+        self.launch_count += 1
+        logger.debug(
+            f"Launched {self._browser.browser_type.name} {self._browser.version} (launch #{self.launch_count})")
+
+    async def _relaunch_if_unhealthy(self, generation: int):
+        async with self._launch_lock:
+            # another capture may have relaunched the browser already
+            if self.launch_count == generation and not self._browser.is_connected():
+                await self._launch()
+
+    async def _load_page(self, page, job: ScreenshotJob, strategy: LoadStrategy, deadline: float = None):
+        # see `load_page` of the synchronous API
+        with get_render_timings().phase("load"):
+            options = {"wait_until": strategy.wait_until,
+                       "timeout": strategy.timeout("load", deadline)}
+            interceptor, page_url, content = get_navigation(job.url, job.html)
+            if interceptor is not None:
+                await interceptor.route_async(page, job.url, job.html)
+            if content is None:
+                await page.goto(page_url, **options)
+            else:
+                await page.set_content(content, **options)
+        if strategy.settle_ms > 0:
+            with get_render_timings().phase("settle"):
+                await page.wait_for_timeout(strategy.settle_ms)
+
+    async def _capture_page(self, page, strategy: LoadStrategy, deadline: float = None):
+        # see `capture_page` of the synchronous API
+        with get_render_timings().phase("screenshot"):
+            clips = None
+            if strategy.max_canvas_height is not None:
+                width, height = await page.evaluate(PAGE_SIZE_SCRIPT)
+                clips = strategy.canvas_clips(width, height)
+            if clips is None:
+                return await page.screenshot(**RENDER_OPTIONS, timeout=strategy.timeout("screenshot", deadline))
+
+            pngs = [await page.screenshot(**RENDER_OPTIONS, clip=clip, timeout=strategy.timeout("screenshot", deadline))
+                    for clip in clips]
+            if strategy.canvas_mode == "clip":
+                return mark_clipped(pngs[0])
+            return TiledScreenshot(pngs, width, height)
+
+    async def _capture_job(self, job: ScreenshotJob) -> dict:
+        output_files = job.output_files or {}
+        images = {}
+        retry_count = 0
+        loop = asyncio.get_running_loop()
+        strategy = job.strategy or DEFAULT_LOAD_STRATEGY
+        # the time budget starts with the first attempt, not while waiting for a context
+        deadline = None
+
+        keys = dict(zip(job.viewports, get_cache_keys(
+            job.url, [viewport.to_dict() for viewport in job.viewports], lambda: self._browser.version, job.html, strategy)))
+        for viewport in job.viewports:
+            png = get_screenshot_cache().get(keys[viewport]) if keys[viewport] is not None and job.script is None else None
+            if png is not None:
+                if is_clipped(png):
+                    job.clipped.add(viewport)
+                images[viewport] = await loop.run_in_executor(
+                    None, png_to_image, png, output_files.get(viewport))
+
+        while retry_count < job.max_retries and not is_past(deadline):
+            pending = [viewport for viewport in job.viewports if viewport not in images]
+            if len(pending) == 0:
+                break
+            await self._slots.acquire()
+            if deadline is None:
+                deadline = strategy.deadline()
+            generation = self.launch_count
+            context = None
+            try:
+                context = await self._browser.new_context(viewport=pending[0].to_dict())
+                page = await context.new_page()
+                await self._load_page(page, job, strategy, deadline)
+                for viewport in pending:
+                    await page.set_viewport_size(viewport.to_dict())
+                    png = await self._capture_page(page, strategy, deadline)
+                    if keys[viewport] is not None and is_cacheable(png):
+                        get_screenshot_cache().put(keys[viewport], png)
+                    if job.script is not None:
+                        job.script_results[viewport] = await page.evaluate(job.script)
+                    if is_clipped(png):
+                        job.clipped.add(viewport)
+                    # decode off the event loop, so that other pages keep rendering
+                    images[viewport] = await loop.run_in_executor(
+                        None, png_to_image, png, output_files.get(viewport))
+            except Exception as e:
+                logger.warning(
+                    f"Failed to take screenshots of {job.url} due to: {e}.")
+                logger.warning(traceback.format_exc())
+                if not self._browser.is_connected():
+                    await self._relaunch_if_unhealthy(generation)
+                retry_count += 1
+                if retry_count < job.max_retries:
+                    logger.warning(
+                        f"Retrying screenshots ({retry_count}/{job.max_retries})...")
+            finally:
+                if context is not None:
+                    try:
+                        await context.close()
+                    except Exception as e:
+                        logger.debug(f"Ignoring error while closing context: {e}")
+                self._slots.release()
+
+        for viewport in job.viewports:
+            if viewport not in images:
+                logger.error(
+                    f"Max retries or time budget reached. Generating a blank image for {viewport}.")
+                images[viewport] = blank_screenshot(viewport.to_dict())
+                if viewport in output_files:
+                    save_screenshot(images[viewport], output_files[viewport])
+        return images
@@ -21,20 +21,17 @@ def map_positions(clean_text, original_text):
     return map_clean_to_original
 
 
-def check_repetitive_content(file_path, chunk_size=100, repetition_threshold=5, similarity_threshold=0.8, debug=False):
+def find_repetitive_content(content, chunk_size=100, repetition_threshold=5, similarity_threshold=0.8):
     """
-    Checks for repetitive content in a text file, considering both exact and similar chunks, 
+    Checks for repetitive content in a text, considering both exact and similar chunks, 
     ignoring HTML tags but keeping the original position reference.
 
-    :param file_path: Path to the text file.
+    :param content: The text to check.
     :param chunk_size: The size of each chunk for comparison.
     :param repetition_threshold: Minimum number of repetitions to consider it as repetitive content.
     :param similarity_threshold: The threshold for considering two chunks as similar (0 to 1).
-    :return: A tuple indicating if repetitive content was found and the position where it starts in the original file.
+    :return: A tuple indicating if repetitive content was found and the position where it starts in the original text.
     """
-    with open(file_path, 'r', encoding='utf-8', errors="replace") as file:
-        content = file.read()
-
     # Clean HTML content and keep a map of positions
     content_no_html = re.sub('<.*?>', '', content)
     position_map = map_positions(content_no_html, content)
@@ -65,6 +62,33 @@ def check_repetitive_content(file_path, chunk_size=100, repetition_threshold=5,
 
     repetitive, start_position = repetitive_start != len(
         content_no_html), repetitive_start
+    return repetitive, start_position
+
+
+def remove_repetitive_content(content, name="", chunk_size=100, repetition_threshold=5, similarity_threshold=0.8):
+    """
+    Same as `check_repetitive_content`, but returns the truncated text instead of
+    rewriting a file. `name` is only used for logging.
+    """
+    repetitive, start_position = find_repetitive_content(
+        content, chunk_size, repetition_threshold, similarity_threshold)
+    if repetitive:
+        logger.warning(
+            f"[Warning] Repetitive content found in {name}, start at {start_position}")
+        return content[:start_position]
+    return content
+
+
+def check_repetitive_content(file_path, chunk_size=100, repetition_threshold=5, similarity_threshold=0.8, debug=False):
+    """
+    Checks for repetitive content in a text file, and truncates the file where it starts.
+    The original file is kept as `_old.txt`. See `find_repetitive_content`.
+    """
+    with open(file_path, 'r', encoding='utf-8', errors="replace") as file:
+        content = file.read()
+
+    repetitive, start_position = find_repetitive_content(
+        content, chunk_size, repetition_threshold, similarity_threshold)
 
     if repetitive:
         logger.warning(
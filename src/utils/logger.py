@@ -61,4 +61,3 @@ def setup_logger(std_debug_level: int = logging.INFO, file_debug_level: int = lo
 
 def suppress_module_logging():
     logging.getLogger("PIL").setLevel(logging.INFO)
-    logging.getLogger("colormath").setLevel(logging.INFO)
@@ -0,0 +1,138 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from src.utils.process_setting import ProcessSetting
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """
+    Locates an array in shared memory, so that only this small descriptor is pickled
+    when the array is handed to another process.
+    """
+    name: str
+    shape: tuple
+    dtype: str
+
+
+def to_shared_memory(array: np.ndarray) -> tuple[SharedMemory, SharedArray]:
+    """
+    Copies the array into a new shared memory block. The caller owns the block, and has
+    to close and unlink it once no process uses it anymore.
+    """
+    array = np.ascontiguousarray(array)
+    shm = SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, SharedArray(shm.name, array.shape, array.dtype.str)
+
+
+def release_shared_memory(shms: list[SharedMemory]):
+    for shm in shms:
+        try:
+            shm.close()
+            shm.unlink()
+        except OSError as e:
+            logger.debug(f"Ignoring error while releasing {shm.name}: {e}")
+
+
+def _run_with_shared_arrays(function, args: tuple, kwargs: dict):
+    # attach the shared arrays of the arguments, which are read-only views of the blocks
+    shms = []
+
+    def attach(value):
+        if not isinstance(value, SharedArray):
+            return value
+        shm = SharedMemory(name=value.name)
+        shms.append(shm)
+        array = np.ndarray(value.shape, dtype=np.dtype(value.dtype), buffer=shm.buf)
+        array.flags.writeable = False
+        return array
+
+    try:
+        return function(*[attach(arg) for arg in args], **{key: attach(value) for key, value in kwargs.items()})
+    finally:
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError:
+                # the result still views the block, which is closed once it is collected
+                pass
+
+
+class SharedMemoryPool:
+    """
+    A process pool for CPU-bound work like block extraction, which hands the NumPy arrays
+    among the arguments of a call to the worker through shared memory, instead of
+    pickling them. Arrays are read-only in the worker.
+
+    Workers are spawned rather than forked, as the parent may run browser threads.
+
+    Example:
+        with SharedMemoryPool(max_workers=8) as pool:
+            set_process_pool(pool)
+            visual_eval_v3_multi(...)
+
+    Parameters:
+        max_workers (int): The number of worker processes, the number of CPUs by default.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = None
+
+    def __enter__(self) -> 'SharedMemoryPool':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def start(self) -> 'SharedMemoryPool':
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def submit(self, function, *args, **kwargs) -> Future:
+        """
+        Runs `function(*args, **kwargs)` in a worker. The function must be importable by
+        the workers, i.e. defined at the top level of a module.
+        """
+        self.start()
+        shms = []
+
+        def share(value):
+            if not isinstance(value, np.ndarray):
+                return value
+            shm, shared = to_shared_memory(value)
+            shms.append(shm)
+            return shared
+
+        try:
+            future = self._executor.submit(
+                _run_with_shared_arrays, function, tuple(share(arg) for arg in args),
+                {key: share(value) for key, value in kwargs.items()})
+        except Exception:
+            release_shared_memory(shms)
+            raise
+        future.add_done_callback(lambda _: release_shared_memory(shms))
+        return future
+
+
+# the pool that CPU-bound work like block extraction is dispatched to, which runs
+# inline with None
+_process_pool: ProcessSetting[SharedMemoryPool | None] = ProcessSetting()
+set_process_pool = _process_pool.set
+get_process_pool = _process_pool.get
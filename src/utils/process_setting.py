@@ -0,0 +1,22 @@
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class ProcessSetting(Generic[T]):
+    """
+    A value shared by every caller of this process, like the cache used by every
+    screenshot function. Modules expose its `set` and `get` as their `set_X`/`get_X`.
+
+    Parameters:
+        default: The value until another one is set.
+    """
+
+    def __init__(self, default: T = None):
+        self._value = default
+
+    def set(self, value: T):
+        self._value = value
+
+    def get(self) -> T:
+        return self._value
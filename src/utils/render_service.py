@@ -0,0 +1,288 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import urllib.error
+import urllib.request
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from src.utils.async_screenshot import AsyncScreenshotEngine
+from src.utils.render_timings import get_render_timings
+from src.utils.request_interceptor import RequestInterceptor, set_request_interceptor
+from src.utils.screenshot import DEFAULT_VIEWPORT, LoadStrategy, ScreenshotJob, TiledScreenshot, capture_jobs_locally, decode_screenshot, get_browser_version, get_render_options
+from src.utils.screenshot_cache import ScreenshotCache, get_screenshot_cache, set_screenshot_cache
+from src.utils.viewport import Viewport
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "http://127.0.0.1:8765"
+
+
+def encode_png(image: np.ndarray) -> str:
+    # fast compression, the images only travel over localhost
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format="PNG", compress_level=1)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def encode_image(image: np.ndarray | TiledScreenshot) -> str | dict:
+    # tiled screenshots are sent as their PNG tiles, so that they are never stitched together
+    if isinstance(image, TiledScreenshot):
+        return {"tiles": [base64.b64encode(png).decode("ascii") for png in image.tiles],
+                "width": image.width, "height": image.height}
+    return encode_png(image)
+
+
+def decode_image(data: str | dict) -> np.ndarray | TiledScreenshot:
+    if isinstance(data, dict):
+        return TiledScreenshot([base64.b64decode(png) for png in data["tiles"]], data["width"], data["height"])
+    return decode_screenshot(base64.b64decode(data))
+
+
+def job_to_dict(job: ScreenshotJob, return_images=True) -> dict:
+    return {
+        # paths are resolved by the service, which runs on the same machine
+        "url": os.path.abspath(job.url) if os.path.exists(job.url) else job.url,
+        "viewports": [str(viewport) for viewport in job.viewports],
+        "output_files": {str(viewport): os.path.abspath(path) for viewport, path in (job.output_files or {}).items()},
+        "max_retries": job.max_retries,
+        "html": job.html,
+        "strategy": asdict(job.strategy) if job.strategy is not None else None,
+        "script": job.script,
+        "return_images": return_images,
+    }
+
+
+def job_from_dict(data: dict) -> ScreenshotJob:
+    return ScreenshotJob(
+        url=data["url"],
+        viewports=[Viewport.from_str(viewport) for viewport in data["viewports"]],
+        output_files={Viewport.from_str(viewport): path for viewport, path in (data.get("output_files") or {}).items()},
+        max_retries=data.get("max_retries", 3),
+        html=data.get("html"),
+        strategy=LoadStrategy(**data["strategy"]) if data.get("strategy") else None,
+        script=data.get("script"),
+    )
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves `POST /render` with a list of jobs, see `job_to_dict`, and `GET /health`.
+    Every request is handled on its own thread, and all of them share the engine of the server.
+    """
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        cache = get_screenshot_cache()
+        self._send_json(200, {
+            "status": "ok",
+            "concurrency": self.server.engine.concurrency,
+            "browser_version": self.server.engine.browser_version,
+            "render_options": get_render_options(),
+            "cache": cache.stats() if cache is not None else None,
+            "timings": get_render_timings().stats(),
+        })
+
+    def do_POST(self):
+        if self.path != "/render":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            jobs = [job_from_dict(job) for job in request["jobs"]]
+        except Exception as e:
+            self._send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        try:
+            results = self.server.engine.capture_many(jobs)
+        except Exception as e:
+            logger.exception(f"Failed to render {len(jobs)} jobs.")
+            self._send_json(500, {"error": str(e)})
+            return
+
+        response = []
+        for data, job, images in zip(request["jobs"], jobs, results):
+            response.append({
+                "images": {str(viewport): encode_image(image) for viewport, image in images.items()}
+                if data.get("return_images", True) else {},
+                "script_results": {str(viewport): result for viewport, result in job.script_results.items()},
+                "clipped": [str(viewport) for viewport in job.clipped],
+            })
+        self._send_json(200, {"results": response})
+
+
+class RenderServer(ThreadingHTTPServer):
+    """
+    A long-running local render service, which keeps warm browsers in an
+    `AsyncScreenshotEngine` and shares them with every eval process on the machine.
+
+    Example:
+        python -m src.utils.render_service --port 8765 --max_contexts 4
+
+    Parameters:
+        address (tuple): The host and port to listen on.
+        engine (AsyncScreenshotEngine): The engine that captures the jobs.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, engine: AsyncScreenshotEngine):
+        super().__init__(address, RenderRequestHandler)
+        self.engine = engine
+
+
+class RenderClient:
+    """
+    A client of the render service, with the same `capture_many` as `AsyncScreenshotEngine`,
+    so that it can be passed as `engine` to `run_screenshot_jobs` and `visual_eval_v3_multi`.
+    If the service is not reachable or fails while rendering, the jobs are rendered locally.
+
+    Parameters:
+        address (str): The URL of the render service.
+        timeout (float): Seconds to wait for a response.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, timeout: float = 600):
+        self.address = address.rstrip("/")
+        self.timeout = timeout
+        self._browser_version = None
+
+    def _request(self, path: str, body: dict = None) -> dict:
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(self.address + path, data=data,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def health(self) -> dict | None:
+        """
+        Returns the status of the service, or None if it is not reachable.
+        """
+        try:
+            return self._request("/health")
+        except (urllib.error.URLError, OSError):
+            return None
+
+    def connect(self) -> dict | None:
+        """
+        Returns the status of the service, or None if it is not reachable.
+
+        Raises:
+            ValueError: If the service renders with other options than this process, e.g.
+                other request interception flags, as the keys of stored blocks and cached
+                screenshots would then not match the renders.
+        """
+        health = self.health()
+        if health is not None and health.get("render_options") != get_render_options():
+            raise ValueError(
+                f"Render service at {self.address} renders with {health.get('render_options')}, "
+                f"but this process with {get_render_options()}. Start it with the same flags, e.g. --intercept_requests.")
+        return health
+
+    @property
+    def browser_version(self) -> str:
+        """
+        The browser version of the service, or of the local browser if it is not reachable.
+        """
+        if self._browser_version is None:
+            health = self.health()
+            if health is None:
+                return get_browser_version()
+            self._browser_version = health["browser_version"]
+        return self._browser_version
+
+    def capture_many(self, jobs: list[ScreenshotJob], return_images=True) -> list[dict]:
+        """
+        Captures the given jobs on the service, or locally if it is not reachable.
+
+        Returns:
+            list[dict]: For every job in order, a mapping of viewport to the RGB array, or
+                empty mappings if not `return_images`.
+        """
+        try:
+            response = self._request("/render", {"jobs": [job_to_dict(job, return_images) for job in jobs]})
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(
+                f"[Warning] Render service at {self.address} is not reachable due to: {e}. Rendering {len(jobs)} jobs locally.")
+            results = capture_jobs_locally(jobs)
+            return results if return_images else [{} for _ in jobs]
+        results = []
+        for job, result in zip(jobs, response["results"]):
+            job.script_results.update({Viewport.from_str(viewport): script_result
+                                       for viewport, script_result in result["script_results"].items()})
+            job.clipped.update(Viewport.from_str(viewport) for viewport in result["clipped"])
+            results.append({Viewport.from_str(viewport): decode_image(image)
+                            for viewport, image in result["images"].items()})
+        return results
+
+
+def take_and_save_screenshot(url, output_file="screenshot.png", do_it_again=False, viewport: dict = {"width": 1280, "height": 720}, max_retries=3, client: RenderClient = None):
+    """
+    Same as `take_and_save_screenshot` of `src.utils.screenshot`, but rendered by the render
+    service. Falls back to rendering locally if the service is not reachable.
+    """
+    # whether to overwrite existing screenshots
+    if os.path.exists(output_file) and not do_it_again:
+        logger.error(f"{output_file} exists! Skipping screenshot.")
+        return
+
+    client = client or RenderClient()
+    viewport = Viewport(**(viewport or DEFAULT_VIEWPORT))
+    client.capture_many([ScreenshotJob(url, [viewport], output_files={viewport: output_file},
+                                       max_retries=max_retries)], return_images=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Host to listen on, keep it local as paths are read from this machine')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on')
+    parser.add_argument('--max_contexts', type=int, default=4,
+                        help='The number of pages rendered at once, each in its own browser context')
+    parser.add_argument('--screenshot_cache_dir', type=str, default=None,
+                        help='Directory to cache screenshots in')
+    parser.add_argument('--screenshot_cache_size_mb', type=int, default=2048,
+                        help='Maximum size of the screenshot cache')
+    parser.add_argument('--intercept_requests', action='store_true',
+                        help='Serve local assets from memory and block requests to external hosts, which clients must set too')
+    parser.add_argument('--allowed_hosts', type=str, nargs='*', default=[],
+                        help='Hosts that are not blocked with --intercept_requests')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger.info(f"args: {args}")
+
+    if args.screenshot_cache_dir is not None:
+        set_screenshot_cache(ScreenshotCache(
+            args.screenshot_cache_dir, max_bytes=args.screenshot_cache_size_mb * 1024 ** 2))
+    if args.intercept_requests:
+        set_request_interceptor(RequestInterceptor(allowed_hosts=args.allowed_hosts))
+
+    with AsyncScreenshotEngine(max_contexts=args.max_contexts) as engine:
+        server = RenderServer((args.host, args.port), engine)
+        logger.info(f"Render service listening on http://{args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
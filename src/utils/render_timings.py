@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class RenderTimings:
+    """
+    Records the time spent in each phase of rendering, e.g. "load", "settle" and
+    "screenshot", and derives adaptive timeouts from it.
+
+    Only successful phases are recorded, so that timeouts do not feed back into the
+    timeouts derived from them. The timeout of a phase is a multiple of the 95th
+    percentile of its recent durations, see `timeout`.
+
+    Parameters:
+        window (int): The number of recent durations kept per phase.
+        min_samples (int): The number of durations needed before timeouts adapt.
+        factor (float): The multiple of the 95th percentile used as timeout.
+        min_timeout_ms (float): The lower bound of adaptive timeouts.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20, factor: float = 3.0, min_timeout_ms: float = 5000):
+        self.min_samples = min_samples
+        self.factor = factor
+        self.min_timeout_ms = min_timeout_ms
+        self._lock = threading.Lock()
+        self._recent = defaultdict(lambda: deque(maxlen=window))
+        self._counts = defaultdict(int)
+        self._totals = defaultdict(float)
+        self._maxima = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self._recent[name].append(seconds)
+            self._counts[name] += 1
+            self._totals[name] += seconds
+            self._maxima[name] = max(self._maxima[name], seconds)
+
+    def timeout(self, name: str, default_ms: float) -> float:
+        """
+        Returns the adaptive timeout of the phase in milliseconds, which is never above
+        `default_ms`, or `default_ms` until enough durations have been recorded.
+        """
+        with self._lock:
+            recent = list(self._recent[name])
+        if len(recent) < self.min_samples:
+            return default_ms
+        timeout_ms = self.factor * float(np.percentile(recent, 95)) * 1000
+        return min(default_ms, max(self.min_timeout_ms, timeout_ms))
+
+    def stats(self) -> dict:
+        """
+        Returns the count, total, mean, 95th percentile and maximum duration in seconds
+        of every phase.
+        """
+        with self._lock:
+            return {name: {
+                "count": self._counts[name],
+                "total": self._totals[name],
+                "mean": self._totals[name] / self._counts[name],
+                "p95": float(np.percentile(self._recent[name], 95)),
+                "max": self._maxima[name],
+            } for name in self._counts}
+
+
+_render_timings = RenderTimings()
+
+
+def get_render_timings() -> RenderTimings:
+    """
+    Returns the timings recorded by every screenshot function of this process.
+    """
+    return _render_timings
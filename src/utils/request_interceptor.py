@@ -0,0 +1,161 @@
+import logging
+import mimetypes
+import os
+import threading
+from collections import Counter
+from urllib.parse import quote, unquote, urlparse
+
+from src.utils.process_setting import ProcessSetting
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# assets that generated pages are told to use, and are served from memory
+DEFAULT_ASSET_PATHS = [
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "experiments", "temp.jpg"),
+]
+
+
+class RequestInterceptor:
+    """
+    Routes every request of a page, so that renders never wait on the network.
+
+    Local pages are loaded from a virtual origin, `http://render.local/`, which serves the
+    html and the files within its directory, and nothing outside of it. Known assets like `temp.jpg` are served from memory,
+    whatever URL they are requested from, and requests to any other host are aborted
+    immediately, unless `block_external` is False, in which case they go to the network
+    like requests of pages loaded from `file://`. The number of aborted requests is
+    counted per page in `blocked_counts`.
+
+    Every screenshot function uses the interceptor installed with `set_request_interceptor`,
+    which can be shared by the browser pools of several threads and by the async engine.
+
+    Parameters:
+        asset_paths (list[str]): Files served from memory by file name, defaults to `DEFAULT_ASSET_PATHS`.
+        allowed_hosts (list[str]): Hosts whose requests go to the network instead of being aborted.
+        block_external (bool): Whether to abort requests to hosts that are not allowed.
+    """
+    HOST = "render.local"
+
+    def __init__(self, asset_paths: list[str] = None, allowed_hosts: list[str] = None, block_external: bool = True):
+        self.assets = {}
+        for path in DEFAULT_ASSET_PATHS if asset_paths is None else asset_paths:
+            with open(path, "rb") as f:
+                self.assets[os.path.basename(path)] = f.read()
+        self.allowed_hosts = set(allowed_hosts or [])
+        self.block_external = block_external
+        # page url -> number of aborted requests
+        self.blocked_counts = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def cache_options(self) -> dict:
+        """
+        The settings that change how pages render, as part of the screenshot cache key.
+        """
+        options = {"assets": sorted(self.assets), "allowed_hosts": sorted(self.allowed_hosts)}
+        if not self.block_external:
+            options["block_external"] = False
+        return {"intercept": options}
+
+    def page_url(self, url: str) -> str:
+        """
+        Returns the URL the page is loaded from, i.e. the virtual origin for local files.
+        """
+        path = url[len("file://"):] if url.startswith("file://") else url
+        if os.path.exists(path):
+            return f"http://{self.HOST}/{quote(os.path.basename(path))}"
+        return url
+
+    def resolve(self, request_url: str, url: str, html: str = None) -> tuple:
+        """
+        Decides what to do with a request of the page loaded from `url`.
+
+        Returns:
+            tuple: ("fulfill", status, body, content type), ("continue",) or ("abort",).
+        """
+        parsed = urlparse(request_url)
+        name = os.path.basename(unquote(parsed.path))
+        page_path = url[len("file://"):] if url.startswith("file://") else url
+
+        if parsed.hostname == self.HOST:
+            page_dir = os.path.realpath(os.path.dirname(os.path.abspath(page_path)))
+            file_path = os.path.normpath(os.path.join(page_dir, unquote(parsed.path).lstrip("/")))
+            if html is not None and file_path == os.path.join(page_dir, os.path.basename(page_path)):
+                return ("fulfill", 200, html.encode("utf-8"), "text/html; charset=utf-8")
+            if name in self.assets:
+                return ("fulfill", 200, self.assets[name], guess_content_type(name))
+            # e.g. "..%2F" is decoded to a parent directory, which the page must not read
+            file_path = os.path.realpath(file_path)
+            if os.path.commonpath([page_dir, file_path]) != page_dir:
+                logger.warning(f"[Warning] Refused request to {request_url} outside the directory of {url}")
+                return ("fulfill", 404, b"", "text/plain")
+            if os.path.isfile(file_path):
+                with open(file_path, "rb") as f:
+                    return ("fulfill", 200, f.read(), guess_content_type(file_path))
+            return ("fulfill", 404, b"", "text/plain")
+
+        if name in self.assets:
+            return ("fulfill", 200, self.assets[name], guess_content_type(name))
+        if parsed.scheme in ("http", "https") and not self.block_external:
+            logger.debug(f"Passing request to {request_url} from {url} through to the network")
+            return ("continue",)
+        if parsed.scheme not in ("http", "https") or parsed.hostname in self.allowed_hosts \
+                or parsed.hostname == urlparse(page_path).hostname:
+            return ("continue",)
+
+        with self._lock:
+            self.blocked_counts[url] += 1
+        logger.debug(f"Blocked request to {request_url} from {url}")
+        return ("abort",)
+
+    def route(self, page, url: str, html: str = None):
+        """
+        Routes every request of the page through the interceptor, for the page loaded
+        from `url`. Replaces the routes of any previous page load.
+        """
+        def handler(route):
+            action = self.resolve(route.request.url, url, html)
+            if action[0] == "fulfill":
+                route.fulfill(status=action[1], body=action[2], content_type=action[3])
+            elif action[0] == "continue":
+                route.continue_()
+            else:
+                route.abort()
+
+        page.unroute("**/*")
+        page.route("**/*", handler)
+
+    async def route_async(self, page, url: str, html: str = None):
+        """
+        Same as `route`, for pages of Playwright's async API.
+        """
+        async def handler(route):
+            action = self.resolve(route.request.url, url, html)
+            if action[0] == "fulfill":
+                await route.fulfill(status=action[1], body=action[2], content_type=action[3])
+            elif action[0] == "continue":
+                await route.continue_()
+            else:
+                await route.abort()
+
+        await page.unroute("**/*")
+        await page.route("**/*", handler)
+
+    def report(self):
+        """
+        Logs the number of blocked requests of every page that had any.
+        """
+        with self._lock:
+            blocked_counts = dict(self.blocked_counts)
+        for url, count in sorted(blocked_counts.items(), key=lambda item: -item[1]):
+            logger.info(f"Blocked {count} external requests of {url}")
+
+
+# the interceptor used by every screenshot function, interception is disabled with None
+_request_interceptor: ProcessSetting[RequestInterceptor | None] = ProcessSetting()
+set_request_interceptor = _request_interceptor.set
+get_request_interceptor = _request_interceptor.get
+
+
+def guess_content_type(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
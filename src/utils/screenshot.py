@@ -1,61 +1,826 @@
 import argparse
+import atexit
 import logging
 import os
+import re
+import threading
+import time
 import traceback
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from html import escape
+from io import BytesIO
+import numpy as np
 from playwright.sync_api import sync_playwright
 from PIL import Image
 
+from src.utils.render_timings import get_render_timings
+from src.utils.request_interceptor import RequestInterceptor, get_request_interceptor
+from src.utils.screenshot_cache import get_screenshot_cache
+from src.utils.viewport import Viewport
+
 logger: logging.Logger = logging.getLogger(__name__)
 
+DEFAULT_VIEWPORT = {"width": 1280, "height": 720}
+# options of every full page screenshot, also part of the screenshot cache key
+RENDER_OPTIONS = {"full_page": True, "animations": "disabled"}
+
+
+@dataclass
+class LoadStrategy:
+    """
+    How pages are loaded and how long a capture may take.
+
+    Parameters:
+        wait_until (str): The load state to wait for, one of "commit", "domcontentloaded", "load" or "networkidle".
+        settle_ms (int): A fixed delay after the load state, e.g. for content added by scripts.
+        timeout_ms (float): The timeout of every page load and screenshot.
+        adaptive_timeout (bool): Whether to shorten the timeouts to what the observed render times suggest, see `RenderTimings`.
+        time_budget (float): Seconds for all attempts of a capture, after which it falls back to a blank image.
+        max_canvas_height (int): The height above which pages are handled by `canvas_mode`, unbounded if None.
+        canvas_mode (str): "clip" to cut taller pages at `max_canvas_height`, which is recorded in
+            `get_clipped_pages()`, or "tile" to capture them as a `TiledScreenshot`.
+        tile_height (int): The height of each tile in "tile" mode.
+    """
+    wait_until: str = "load"
+    settle_ms: int = 0
+    timeout_ms: float = 60000
+    adaptive_timeout: bool = False
+    time_budget: float = None
+    max_canvas_height: int = None
+    canvas_mode: str = "clip"
+    tile_height: int = 4096
+
+    @property
+    def cache_options(self) -> dict:
+        """
+        The settings that change how pages render, as part of the screenshot cache key.
+        """
+        options = {}
+        if self.wait_until != "load":
+            options["wait_until"] = self.wait_until
+        if self.settle_ms > 0:
+            options["settle_ms"] = self.settle_ms
+        if self.max_canvas_height is not None:
+            options["canvas"] = [self.max_canvas_height, self.canvas_mode, self.tile_height]
+        return options
+
+    def canvas_clips(self, width: int, height: int) -> list[dict] | None:
+        """
+        Returns the regions a page of the given size is captured in, or None if it fits
+        the canvas and is captured in one piece.
+        """
+        if self.max_canvas_height is None or height <= self.max_canvas_height:
+            return None
+        if self.canvas_mode == "clip":
+            return [{"x": 0, "y": 0, "width": width, "height": self.max_canvas_height}]
+        return [{"x": 0, "y": y, "width": width, "height": min(self.tile_height, height - y)}
+                for y in range(0, height, self.tile_height)]
+
+    def deadline(self) -> float | None:
+        if self.time_budget is None:
+            return None
+        return time.monotonic() + self.time_budget
+
+    def timeout(self, phase: str, deadline: float = None) -> float:
+        """
+        Returns the timeout of the phase in milliseconds, capped by the time left before
+        the deadline of the capture.
+        """
+        timeout = self.timeout_ms
+        if self.adaptive_timeout:
+            timeout = get_render_timings().timeout(phase, timeout)
+        if deadline is not None:
+            remaining = (deadline - time.monotonic()) * 1000
+            if remaining <= 0:
+                raise TimeoutError(f"Time budget of {self.time_budget}s exceeded.")
+            timeout = min(timeout, remaining)
+        return timeout
+
+
+DEFAULT_LOAD_STRATEGY = LoadStrategy()
+
+
+def is_past(deadline: float | None) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+class TiledScreenshot:
+    """
+    A full page screenshot of a page taller than the canvas, kept as PNG tiles from top
+    to bottom. Tiles are only decoded when needed, see `iter_tiles` and `rows`, so
+    consumers that work tile by tile, like the block extraction and the CLIP score, stay
+    within bounded memory. `to_array` stitches the whole page, e.g. to save it.
+    """
+
+    def __init__(self, tiles: list[bytes], width: int, height: int):
+        self.tiles = tiles
+        self.width = width
+        self.height = height
+        self._offsets = None
+
+    @property
+    def shape(self) -> tuple:
+        return (self.height, self.width, 3)
+
+    @property
+    def offsets(self) -> list[int]:
+        """
+        The vertical offset of every tile, read from the PNG headers without decoding.
+        """
+        if self._offsets is None:
+            offsets = [0]
+            for png in self.tiles[:-1]:
+                with Image.open(BytesIO(png)) as img:
+                    offsets.append(offsets[-1] + img.height)
+            self._offsets = offsets
+        return self._offsets
+
+    def iter_tiles(self):
+        """
+        Yields the vertical offset and the RGB array of every tile.
+        """
+        for y, png in zip(self.offsets, self.tiles):
+            yield y, self._fit(decode_screenshot(png), y)
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        """
+        Returns the rows from `start` to `stop` as an RGB array, only decoding the tiles
+        they overlap.
+        """
+        start, stop = max(0, start), min(self.height, stop)
+        image = np.full((max(0, stop - start), self.width, 3), 255, dtype=np.uint8)
+        ends = self.offsets[1:] + [self.height]
+        for y, end, png in zip(self.offsets, ends, self.tiles):
+            if end <= start or y >= stop:
+                continue
+            tile = self._fit(decode_screenshot(png), y)
+            top, bottom = max(start, y), min(stop, y + tile.shape[0])
+            image[top - start:bottom - start, :tile.shape[1]] = tile[top - y:bottom - y]
+        return image
+
+    def _fit(self, tile: np.ndarray, y: int) -> np.ndarray:
+        return tile[:self.height - y, :self.width]
+
+    def to_array(self) -> np.ndarray:
+        return self.rows(0, self.height)
+
+    def __array__(self, dtype=None, copy=None):
+        image = self.to_array()
+        return image if dtype is None else image.astype(dtype)
+
+
+def image_rows(image, start: int, stop: int) -> np.ndarray:
+    """
+    Returns the rows from `start` to `stop` of an RGB array or a `TiledScreenshot`.
+    """
+    if isinstance(image, TiledScreenshot):
+        return image.rows(start, stop)
+    return image[max(0, start):stop]
+
+
+def iter_image_tiles(image):
+    """
+    Yields the vertical offset and the rows of every tile of a `TiledScreenshot`, or the
+    whole RGB array as a single tile.
+    """
+    if isinstance(image, TiledScreenshot):
+        yield from image.iter_tiles()
+    else:
+        yield 0, image
+
+
+# url -> number of screenshots clipped at the maximum canvas height
+_clipped_pages = Counter()
+_clipped_pages_lock = threading.Lock()
+
+
+# the PNG text chunk of screenshots that were clipped, which stays with the PNG in the
+# screenshot cache
+CLIPPED_CHUNK = b"tEXt" + b"clipped\x00true"
+
+
+def mark_clipped(png: bytes) -> bytes:
+    """
+    Returns the PNG with a text chunk after its header, which marks it as clipped at the
+    maximum canvas height when it was captured, see `is_clipped`.
+    """
+    # the signature and the IHDR chunk, which is always first and 13 bytes long
+    header_end = 8 + 8 + 13 + 4
+    chunk = len(CLIPPED_CHUNK[4:]).to_bytes(4, "big") + CLIPPED_CHUNK + \
+        zlib.crc32(CLIPPED_CHUNK).to_bytes(4, "big")
+    return png[:header_end] + chunk + png[header_end:]
+
+
+def is_clipped(png) -> bool:
+    """
+    Whether the screenshot, as captured, was clipped at the maximum canvas height, i.e.
+    the page was taller, see `mark_clipped`. Tiled screenshots are never clipped.
+    """
+    if not isinstance(png, bytes):
+        return False
+    offset = 8
+    while offset + 8 <= len(png):
+        length = int.from_bytes(png[offset:offset + 4], "big")
+        chunk_type = png[offset + 4:offset + 8]
+        if chunk_type in (b"IDAT", b"IEND"):
+            return False
+        if png[offset + 4:offset + 8 + length] == CLIPPED_CHUNK:
+            return True
+        offset += 12 + length
+    return False
+
+
+def record_clipped_page(url: str, strategy: LoadStrategy = None):
+    max_height = (strategy or DEFAULT_LOAD_STRATEGY).max_canvas_height
+    logger.warning(
+        f"[Warning] Page {url} is taller than {max_height}px, its screenshot is clipped.")
+    with _clipped_pages_lock:
+        _clipped_pages[url] += 1
+
+
+def get_clipped_pages() -> dict:
+    """
+    Returns the number of screenshots clipped at the maximum canvas height, per page.
+    """
+    with _clipped_pages_lock:
+        return dict(_clipped_pages)
+
+
+# the size of the whole page, as captured by full page screenshots
+PAGE_SIZE_SCRIPT = """() => [
+    Math.max(document.documentElement.scrollWidth, document.body ? document.body.scrollWidth : 0, window.innerWidth),
+    Math.max(document.documentElement.scrollHeight, document.body ? document.body.scrollHeight : 0, window.innerHeight),
+]"""
+
+
+# browser executable -> its version, so that a browser is launched at most once per
+# process and executable just to key the caches
+_browser_versions = {}
+_browser_versions_lock = threading.Lock()
+
+
+class BrowserPool:
+    """
+    A long-lived Chromium instance that hands out pages for captures.
+
+    Launching Chromium dominates the cost of a single screenshot, so the pool keeps
+    one browser alive across captures. Every checkout gets a page in a fresh browser
+    context, which is cheap compared to a launch, so that no cookies, storage, service
+    workers or scroll position carry over from a previous page. Before every checkout
+    the browser is health-checked, and it is relaunched if it crashed or disconnected.
+
+    Playwright's sync API is bound to the thread that started it, so a pool must only
+    be used from the thread that created it. Use `get_browser_pool` to get the pool
+    shared by every screenshot caller of the current thread.
+
+    Parameters:
+        launch_options (dict): Keyword arguments passed to `chromium.launch`.
+    """
+
+    def __init__(self, launch_options: dict = None):
+        self.launch_options = launch_options or {}
+        self.launch_count = 0
+        self._playwright = None
+        self._browser = None
+        self._owner_thread = None
+
+    def __enter__(self) -> 'BrowserPool':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def start(self) -> 'BrowserPool':
+        self._start_playwright()
+        if not self.is_healthy():
+            self._launch()
+        return self
+
+    def _start_playwright(self):
+        if self._playwright is None:
+            self._playwright = sync_playwright().start()
+            self._owner_thread = threading.get_ident()
+
+    def _executable_path(self) -> str:
+        return self.launch_options.get("executable_path") or self._playwright.chromium.executable_path
+
+    @property
+    def browser_version(self) -> str:
+        """
+        The version of the browser, which is worked out once per executable, so that
+        screenshots served from the cache never launch a browser after the first one.
+        """
+        self._start_playwright()
+        with _browser_versions_lock:
+            version = _browser_versions.get(self._executable_path())
+        if version is None:
+            version = self.browser.version
+        return version
+
+    def is_healthy(self) -> bool:
+        return self._browser is not None and self._browser.is_connected()
+
+    @property
+    def browser(self):
+        self.start()
+        return self._browser
+
+    def _launch(self):
+        if self._browser is not None:
+            logger.warning("Browser is not healthy. Relaunching.")
+            self._discard_browser()
+        self._browser = self._playwright.chromium.launch(**self.launch_options)
+        self.launch_count += 1
+        with _browser_versions_lock:
+            _browser_versions[self._executable_path()] = self._browser.version
+        logger.debug(
+            f"Launched {self._browser.browser_type.name} {self._browser.version} (launch #{self.launch_count})")
+
+    def _discard_browser(self):
+        try:
+            self._browser.close()
+        except Exception as e:
+            logger.debug(f"Ignoring error while closing browser: {e}")
+        self._browser = None
+
+    @contextmanager
+    def page(self, viewport: dict = None):
+        """
+        Checks out a page with the given viewport in a fresh browser context, and closes
+        the context afterwards.
+        """
+        if self._owner_thread is not None and self._owner_thread != threading.get_ident():
+            raise RuntimeError(
+                "BrowserPool can only be used from the thread that started it.")
+        self.start()
+        context = self._browser.new_context(viewport=viewport or DEFAULT_VIEWPORT)
+        try:
+            yield context.new_page()
+        finally:
+            try:
+                context.close()
+            except Exception as e:
+                logger.debug(f"Ignoring error while closing page: {e}")
+
+    def close(self):
+        if self._browser is not None:
+            self._discard_browser()
+        if self._playwright is not None:
+            self._playwright.stop()
+            self._playwright = None
+            self._owner_thread = None
+
+
+_local = threading.local()
+
+
+def get_browser_pool() -> BrowserPool:
+    """
+    Returns the browser pool shared by all screenshot callers of the current thread,
+    creating it on first use.
+    """
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = BrowserPool()
+        _local.pool = pool
+        if threading.current_thread() is threading.main_thread():
+            atexit.register(close_browser_pool)
+    return pool
+
+
+def close_browser_pool():
+    pool = getattr(_local, "pool", None)
+    if pool is not None:
+        _local.pool = None
+        pool.close()
+
+
+@contextmanager
+def browser_pool(**kwargs):
+    """
+    Installs a new browser pool as the shared pool of the current thread for the
+    duration of the block, and closes it afterwards.
+
+    Example:
+        with browser_pool(launch_options={"headless": True}):
+            visual_eval_v3_multi(...)
+    """
+    previous = getattr(_local, "pool", None)
+    pool = BrowserPool(**kwargs)
+    _local.pool = pool
+    try:
+        yield pool.start()
+    finally:
+        _local.pool = previous
+        pool.close()
+
+
+def get_browser_version(engine=None, pool: BrowserPool = None) -> str:
+    """
+    Returns the version of the browser that renders with the given engine, or with the
+    browser pool if there is no engine.
+    """
+    if engine is not None:
+        return engine.browser_version
+    return (pool or get_browser_pool()).browser_version
+
+
+def get_cache_keys(url, viewports: list[dict], browser_version, html: str = None, strategy: LoadStrategy = None) -> list:
+    """
+    Returns the screenshot cache key of the url at every viewport, or Nones if caching
+    is disabled. `browser_version` is a callable, so the browser only has to be started
+    when there is a cache.
+    """
+    cache = get_screenshot_cache()
+    if cache is None:
+        return [None for _ in viewports]
+    return cache.make_keys(url, viewports, browser_version(), get_render_options(strategy), html)
 
-def take_and_save_screenshot(url, output_file="screenshot.png", do_it_again=False, viewport: dict = {"width": 1280, "height": 720}, max_retries=3):
+
+def get_render_options(strategy: LoadStrategy = None) -> dict:
+    """
+    Returns the settings of this process that change how a page renders with the given
+    strategy, which are part of the keys of cached renders.
+    """
+    options = {**RENDER_OPTIONS, **(strategy or DEFAULT_LOAD_STRATEGY).cache_options}
+    interceptor = get_request_interceptor()
+    if interceptor is not None:
+        options = {**options, **interceptor.cache_options}
+    return options
+
+
+def to_page_url(url: str) -> str:
     # Convert local path to file:// URL if it's a file
     if os.path.exists(url):
-        url = "file://" + os.path.abspath(url)
+        return "file://" + os.path.abspath(url)
+    return url
+
+
+# serves local pages rendered from a string and the files within their directory when no
+# `RequestInterceptor` is set, and explicitly passes requests to other hosts through to
+# the network, as they went when these pages were loaded from file://
+LOCAL_PAGE_SERVER = RequestInterceptor(asset_paths=[], block_external=False)
+
+
+def with_base_url(html: str, base_url: str) -> str:
+    """
+    Returns the html with a `<base href>` to `base_url` at the start of its head, so
+    that its relative URLs resolve against it. An html that has a base already is
+    returned as is.
+    """
+    if re.search(r"<base\b", html, flags=re.IGNORECASE):
+        return html
+    base = f'<base href="{escape(base_url, quote=True)}">'
+    head = re.search(r"<head\b[^>]*>", html, flags=re.IGNORECASE)
+    if head is None:
+        # keep a leading doctype first, so that the page is not rendered in quirks mode
+        head = re.match(r"\s*(<!doctype[^>]*>)?", html, flags=re.IGNORECASE)
+    return html[:head.end()] + base + html[head.end():]
+
+
+def get_navigation(url: str, html: str = None) -> tuple:
+    """
+    Decides how the page of `url`, or `html` rendered in its place, is loaded.
+
+    Local pages rendered from a string are served from the virtual origin of the
+    `RequestInterceptor`, or of `LOCAL_PAGE_SERVER` if none is set, which fulfils the
+    page with the html and its relative assets from disk. Other html is rendered with
+    `set_content` and a `<base href>` to the URL.
+
+    Returns:
+        tuple: The interceptor the requests of the page are routed through, or None, the
+            URL to navigate to, or None, and the html to render with `set_content`, or None.
+    """
+    interceptor = get_request_interceptor()
+    if interceptor is None and html is not None and LOCAL_PAGE_SERVER.page_url(url) != url:
+        interceptor = LOCAL_PAGE_SERVER
+    if interceptor is not None:
+        page_url = interceptor.page_url(url)
+        if page_url != url or html is None:
+            return interceptor, page_url, None
+    if html is None:
+        return interceptor, to_page_url(url), None
+    return interceptor, None, with_base_url(html, url)
+
+
+def load_page(page, url: str, html: str = None, strategy: LoadStrategy = None, deadline: float = None):
+    """
+    Navigates the page to the URL, or renders `html` if given, so that relative assets
+    resolve as if the html had been written in place of the URL, see `get_navigation`.
+
+    If a `RequestInterceptor` is set, every request of the page is routed through it, and
+    local pages are served from its virtual origin instead.
+
+    The time spent loading and settling is recorded in `get_render_timings()`.
+    """
+    strategy = strategy or DEFAULT_LOAD_STRATEGY
+    with get_render_timings().phase("load"):
+        options = {"wait_until": strategy.wait_until,
+                   "timeout": strategy.timeout("load", deadline)}
+        interceptor, page_url, content = get_navigation(url, html)
+        if interceptor is not None:
+            interceptor.route(page, url, html)
+        if content is None:
+            page.goto(page_url, **options)
+        else:
+            page.set_content(content, **options)
+    if strategy.settle_ms > 0:
+        with get_render_timings().phase("settle"):
+            page.wait_for_timeout(strategy.settle_ms)
+
+
+def capture_page(page, strategy: LoadStrategy = None, deadline: float = None) -> bytes | TiledScreenshot:
+    """
+    Takes a full page screenshot of the loaded page, and records the time it took.
+
+    Pages taller than the maximum canvas height of the strategy are clipped, or captured
+    as a `TiledScreenshot`, see `LoadStrategy`.
+    """
+    strategy = strategy or DEFAULT_LOAD_STRATEGY
+    with get_render_timings().phase("screenshot"):
+        clips = None
+        if strategy.max_canvas_height is not None:
+            width, height = page.evaluate(PAGE_SIZE_SCRIPT)
+            clips = strategy.canvas_clips(width, height)
+        if clips is None:
+            return page.screenshot(**RENDER_OPTIONS, timeout=strategy.timeout("screenshot", deadline))
+
+        pngs = [page.screenshot(**RENDER_OPTIONS, clip=clip, timeout=strategy.timeout("screenshot", deadline))
+                for clip in clips]
+        if strategy.canvas_mode == "clip":
+            return mark_clipped(pngs[0])
+        return TiledScreenshot(pngs, width, height)
+
+
+def is_cacheable(png) -> bool:
+    # tiled screenshots are too large to be worth caching
+    return isinstance(png, bytes)
+
+
+def capture_screenshot_png(url, viewport: dict = {"width": 1280, "height": 720}, max_retries=3, pool: BrowserPool = None, html: str = None, strategy: LoadStrategy = None) -> bytes | TiledScreenshot | None:
+    """
+    Takes a full page screenshot of the URL or local file path, and returns the encoded
+    PNG, or None if every attempt failed. If `html` is given, it is rendered instead,
+    with relative assets resolved against `url`. See `LoadStrategy` for `strategy`.
+    """
+    retry_count = 0
+    pool = pool or get_browser_pool()
+    strategy = strategy or DEFAULT_LOAD_STRATEGY
+    deadline = strategy.deadline()
+
+    key = get_cache_keys(url, [viewport or DEFAULT_VIEWPORT], lambda: pool.browser_version, html, strategy)[0]
+    if key is not None:
+        png = get_screenshot_cache().get(key)
+        if png is not None:
+            return png
+
+    while retry_count < max_retries and not is_past(deadline):
+        try:
+            with pool.page(viewport) as page:
+                # Navigate to the URL
+                load_page(page, url, html, strategy, deadline)
+
+                # Take the screenshot
+                png = capture_page(page, strategy, deadline)
+            if key is not None and is_cacheable(png):
+                get_screenshot_cache().put(key, png)
+            return png
+        except Exception as e:
+            logger.warning(
+                f"Failed to take screenshot due to: {e}. Generating a blank image.")
+            logger.warning(traceback.format_exc())
+            retry_count += 1
+            if retry_count < max_retries:
+                logger.warning(
+                    f"Retrying screenshot ({retry_count}/{max_retries})...")
+    logger.error("Max retries or time budget reached. Generating a blank image.")
+    return None
 
+
+def decode_screenshot(png: bytes) -> np.ndarray:
+    with Image.open(BytesIO(png)) as img:
+        return np.array(img.convert('RGB'))
+
+
+def png_to_image(png: bytes | TiledScreenshot, output_file: str = None, as_array=True):
+    """
+    Decodes the PNG to an RGB array, or to a PIL image if not `as_array`. The PNG is
+    written to `output_file` as is, if given.
+
+    A `TiledScreenshot` is returned as is instead of an array or image, so that it is
+    never stitched together.
+    """
+    if isinstance(png, TiledScreenshot):
+        if output_file is not None:
+            save_screenshot(png, output_file)
+        return png
+    if output_file is not None:
+        with open(output_file, "wb") as f:
+            f.write(png)
+    if as_array:
+        return decode_screenshot(png)
+    img = Image.open(BytesIO(png))
+    img.load()
+    return img
+
+
+def blank_screenshot(viewport: dict = None) -> np.ndarray:
+    viewport = viewport or DEFAULT_VIEWPORT
+    return np.full((viewport["height"], viewport["width"], 3), 255, dtype=np.uint8)
+
+
+def save_screenshot(image: np.ndarray | TiledScreenshot, output_file: str):
+    if isinstance(image, TiledScreenshot):
+        save_tiled_screenshot(image, output_file)
+        return
+    Image.fromarray(image).save(output_file)
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return len(data).to_bytes(4, "big") + chunk_type + data + \
+        zlib.crc32(chunk_type + data).to_bytes(4, "big")
+
+
+def save_tiled_screenshot(image: TiledScreenshot, output_file: str):
+    """
+    Writes the tiled screenshot as a single PNG, compressing one tile at a time, so that
+    the page is never stitched together in memory.
+    """
+    compressor = zlib.compressobj(6)
+    with open(output_file, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        # 8-bit RGB, without interlacing
+        f.write(png_chunk(b"IHDR", image.width.to_bytes(4, "big") + image.height.to_bytes(4, "big") + bytes([8, 2, 0, 0, 0])))
+        ends = image.offsets[1:] + [image.height]
+        for y, end in zip(image.offsets, ends):
+            rows = image.rows(y, end)
+            # every row starts with its filter type, none
+            scanlines = np.concatenate([np.zeros((len(rows), 1), dtype=np.uint8), rows.reshape(len(rows), -1)], axis=1)
+            data = compressor.compress(scanlines.tobytes())
+            if data:
+                f.write(png_chunk(b"IDAT", data))
+        f.write(png_chunk(b"IDAT", compressor.flush()))
+        f.write(png_chunk(b"IEND", b""))
+
+
+def take_screenshot(url, viewport: dict = {"width": 1280, "height": 720}, max_retries=3, pool: BrowserPool = None, html: str = None, strategy: LoadStrategy = None) -> np.ndarray:
+    """
+    Same as `take_and_save_screenshot`, but returns the screenshot as an RGB array of
+    shape (height, width, 3) instead of writing it to disk, or as a `TiledScreenshot`
+    for pages taller than the canvas in "tile" mode.
+    """
+    png = capture_screenshot_png(url, viewport, max_retries, pool, html, strategy)
+    if png is None:
+        return blank_screenshot(viewport)
+    if is_clipped(png):
+        record_clipped_page(url, strategy)
+    return png_to_image(png)
+
+
+def take_and_save_screenshot(url, output_file="screenshot.png", do_it_again=False, viewport: dict = {"width": 1280, "height": 720}, max_retries=3, pool: BrowserPool = None, strategy: LoadStrategy = None):
     # whether to overwrite existing screenshots
     if os.path.exists(output_file) and not do_it_again:
         logger.error(f"{output_file} exists! Skipping screenshot.")
         return
-    retry_count = 0
 
-    while retry_count < max_retries:
-        try:
-            with sync_playwright() as p:
-                # Choose a browser, e.g., Chromium, Firefox, or WebKit
-                browser = p.chromium.launch()
-                page = None
-                if viewport is None:
-                    page = browser.new_page()
-                else:
-                    page = browser.new_page(viewport=viewport)
+    png = capture_screenshot_png(url, viewport, max_retries, pool, strategy=strategy)
+    if png is None:
+        # Generate a blank image
+        save_screenshot(blank_screenshot(viewport), output_file)
+        return
+    if is_clipped(png):
+        record_clipped_page(url, strategy)
+    png_to_image(png, output_file)
 
-                # Navigate to the URL
-                page.goto(url, timeout=60000)
 
-                # Take the screenshot
-                page.screenshot(path=output_file, full_page=True,
-                                animations="disabled", timeout=60000)
+def take_screenshots_multi_viewport(url, viewports: list[Viewport], output_files: dict = None, max_retries=3, pool: BrowserPool = None, as_array=False, html: str = None, strategy: LoadStrategy = None, script: str = None, script_results: dict = None, clipped: set = None) -> dict:
+    """
+    Loads the page once, then resizes the viewport and takes a full page screenshot for
+    each of the given viewports. The page is laid out again after every resize, so this
+    replaces one navigation per viewport with a single one.
+
+    Parameters:
+        url (str): URL or local file path to take the screenshots of.
+        viewports (list[Viewport]): The viewports to capture, in capture order.
+        output_files (dict): Optional mapping of viewport to the path the screenshot is saved to.
+        max_retries (int): The number of page loads attempted before falling back to blank images.
+        pool (BrowserPool): The browser pool to use, defaults to the shared pool.
+        as_array (bool): Whether to return the screenshots as RGB arrays instead of PIL images.
+        html (str): Optional html to render instead of `url`, which then only locates the relative assets.
+        strategy (LoadStrategy): How the page is loaded and how long the capture may take.
+        script (str): Optional JavaScript function evaluated in the page after every screenshot.
+            Screenshots are then never served from the cache, since the page must be loaded.
+        script_results (dict): The mapping of viewport to the result of `script`, filled in by this function.
+        clipped (set): The viewports whose screenshot was clipped at the maximum canvas height, filled in by this function.
+
+    Returns:
+        dict: A mapping of viewport to the screenshot.
+    """
+    output_files = output_files or {}
+    pool = pool or get_browser_pool()
+    images = {}
+    retry_count = 0
+    strategy = strategy or DEFAULT_LOAD_STRATEGY
+    deadline = strategy.deadline()
 
-                browser.close()
+    keys = dict(zip(viewports, get_cache_keys(
+        url, [viewport.to_dict() for viewport in viewports], lambda: pool.browser_version, html, strategy)))
+    for viewport in viewports:
+        png = get_screenshot_cache().get(keys[viewport]) if keys[viewport] is not None and script is None else None
+        if png is not None:
+            if clipped is not None and is_clipped(png):
+                clipped.add(viewport)
+            images[viewport] = png_to_image(png, output_files.get(viewport), as_array)
 
-                break
+    while retry_count < max_retries and not is_past(deadline):
+        pending = [viewport for viewport in viewports if viewport not in images]
+        if len(pending) == 0:
+            break
+        try:
+            with pool.page(pending[0].to_dict()) as page:
+                load_page(page, url, html, strategy, deadline)
+                for viewport in pending:
+                    page.set_viewport_size(viewport.to_dict())
+                    png = capture_page(page, strategy, deadline)
+                    if keys[viewport] is not None and is_cacheable(png):
+                        get_screenshot_cache().put(keys[viewport], png)
+                    if script is not None:
+                        script_results[viewport] = page.evaluate(script)
+                    if clipped is not None and is_clipped(png):
+                        clipped.add(viewport)
+                    images[viewport] = png_to_image(
+                        png, output_files.get(viewport), as_array)
         except Exception as e:
             logger.warning(
-                f"Failed to take screenshot due to: {e}. Generating a blank image.")
+                f"Failed to take screenshots due to: {e}.")
             logger.warning(traceback.format_exc())
-            # Generate a blank image
             retry_count += 1
             if retry_count < max_retries:
                 logger.warning(
-                    f"Retrying screenshot ({retry_count}/{max_retries})...")
-                continue
-            else:
-                logger.error("Max retries reached. Generating a blank image.")
-                img = Image.new(
-                    'RGB', (viewport["width"], viewport["height"]), color='white')
-                img.save(output_file)
-                break
+                    f"Retrying screenshots ({retry_count}/{max_retries})...")
+
+    for viewport in viewports:
+        if viewport not in images:
+            logger.error(
+                f"Max retries or time budget reached. Generating a blank image for {viewport}.")
+            images[viewport] = blank_screenshot(viewport.to_dict())
+            if viewport in output_files:
+                save_screenshot(images[viewport], output_files[viewport])
+            if not as_array:
+                images[viewport] = Image.fromarray(images[viewport])
+    return images
+
+
+@dataclass
+class ScreenshotJob:
+    """
+    A request to capture a page at one or more viewports, see `take_screenshots_multi_viewport`.
+    If `html` is given, it is rendered instead of `url`, which then only locates the relative assets.
+    If `script` is given, its result at every viewport is put in `script_results` by the capture.
+    The viewports whose screenshot was clipped at the maximum canvas height are put in `clipped`.
+    """
+    url: str
+    viewports: list[Viewport]
+    output_files: dict = None
+    max_retries: int = 3
+    html: str = None
+    strategy: LoadStrategy = None
+    script: str = None
+    script_results: dict = field(default_factory=dict)
+    clipped: set = field(default_factory=set)
+
+
+def capture_jobs_locally(jobs: list[ScreenshotJob], pool: BrowserPool = None) -> list[dict]:
+    """
+    Captures the given jobs one after another with the browser pool, and returns a
+    mapping of viewport to the RGB array for every job, in order.
+    """
+    return [take_screenshots_multi_viewport(job.url, job.viewports, output_files=job.output_files,
+                                            max_retries=job.max_retries, pool=pool, as_array=True, html=job.html, strategy=job.strategy,
+                                            script=job.script, script_results=job.script_results, clipped=job.clipped)
+            for job in jobs]
+
+
+def run_screenshot_jobs(jobs: list[ScreenshotJob], engine=None, pool: BrowserPool = None) -> list[dict]:
+    """
+    Captures the given jobs, and returns a mapping of viewport to the RGB array for every
+    job, in order.
+
+    With an `AsyncScreenshotEngine`, the jobs are captured concurrently. Otherwise they
+    are captured one after another with the browser pool.
+    """
+    if engine is not None:
+        results = engine.capture_many(jobs)
+    else:
+        results = capture_jobs_locally(jobs, pool)
+    for job in jobs:
+        for _ in job.clipped:
+            record_clipped_page(job.url, job.strategy)
+    return results
+
 
 if __name__ == "__main__":
     # Example usage
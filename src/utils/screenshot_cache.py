@@ -0,0 +1,178 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from src.utils.process_setting import ProcessSetting
+from src.utils.storage import atomic_write
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def normalize_html(html: str) -> str:
+    """
+    Normalizes the line endings of an html, which the HTML parser normalizes the same way
+    before parsing, so they cannot change how it renders. Any other whitespace may, e.g.
+    within `<pre>`, so it is kept.
+    """
+    return html.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def resolve_base_dir(url: str) -> str:
+    """
+    Returns the directory the relative assets of the local page at `url`, a path or a
+    directory, resolve against, with symbolic links resolved.
+    """
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    return os.path.realpath(url if os.path.isdir(url) else os.path.dirname(os.path.abspath(url)))
+
+
+class ScreenshotCache:
+    """
+    An on-disk, content-addressed cache of PNG screenshots with LRU eviction.
+
+    Entries are keyed by the normalized html, the viewport, the browser version and the
+    render options, so identical renders of the same page cost a single file lookup. The
+    directory of the html is part of the key too, since relative assets resolve against it.
+    When the cache grows beyond `max_bytes`, the least recently used entries are evicted.
+
+    The cache can be shared by several processes. Each process only evicts the entries
+    it has seen, and the hit/miss counters are per process.
+
+    Parameters:
+        cache_dir (str): The directory the screenshots are stored in.
+        max_bytes (int): The maximum total size of the cached screenshots.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> size of the entry, from the least to the most recently used
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_entries()
+
+    def _load_entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".png"):
+                    stat = os.stat(os.path.join(root, file))
+                    entries.append((stat.st_mtime, file[:-len(".png")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+        logger.info(
+            f"Loaded {len(self._entries)} cached screenshots ({self._total_bytes / 1024 ** 2:.1f} MB) from {self.cache_dir}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+    def make_keys(self, url: str, viewports: list[dict], browser_version: str, options: dict = None, html: str = None) -> list:
+        """
+        Returns the cache key of the render at every viewport, or Nones if the url is not
+        a local html file and thus cannot be content-addressed.
+
+        If `html` is given, it is the content that is rendered, and `url` only locates the
+        relative assets.
+        """
+        if url.startswith("file://"):
+            url = url[len("file://"):]
+        if html is None:
+            if not os.path.isfile(url):
+                return [None for _ in viewports]
+            with open(url, 'r', encoding="utf-8", errors="replace") as file:
+                html = file.read()
+        elif not os.path.exists(url):
+            return [None for _ in viewports]
+        html_hash = hashlib.sha256(
+            normalize_html(html).encode("utf-8")).hexdigest()
+        base_dir = resolve_base_dir(url)
+
+        keys = []
+        for viewport in viewports:
+            key = {
+                "html": html_hash,
+                "base_dir": base_dir,
+                "viewport": [viewport["width"], viewport["height"]],
+                "browser_version": browser_version,
+                "options": options or {},
+            }
+            keys.append(hashlib.sha256(json.dumps(
+                key, sort_keys=True).encode("utf-8")).hexdigest())
+        return keys
+
+    def make_key(self, url: str, viewport: dict, browser_version: str, options: dict = None, html: str = None) -> str | None:
+        return self.make_keys(url, [viewport], browser_version, options, html)[0]
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                png = f.read()
+            # mark as recently used, also for other processes sharing the directory
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                if key in self._entries:
+                    self._total_bytes -= self._entries.pop(key)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key not in self._entries:
+                self._entries[key] = len(png)
+                self._total_bytes += len(png)
+            self._entries.move_to_end(key)
+        return png
+
+    def put(self, key: str, png: bytes):
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(png)
+
+        atomic_write(self._path(key), write)
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = len(png)
+            self._total_bytes += len(png)
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                self.evictions += 1
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except OSError as e:
+                logger.debug(f"Ignoring error while evicting {evicted_key}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+            }
+
+
+# the cache used by every screenshot function, caching is disabled with None
+_screenshot_cache: ProcessSetting[ScreenshotCache | None] = ProcessSetting()
+set_screenshot_cache = _screenshot_cache.set
+get_screenshot_cache = _screenshot_cache.get
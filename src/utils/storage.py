@@ -0,0 +1,29 @@
+import logging
+import os
+import threading
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def atomic_write(path: str, write, suffix: str = ""):
+    """
+    Writes a file through a temporary file in the same directory, which is renamed to
+    `path` once complete, so that readers in any process never see a partial file.
+
+    Parameters:
+        path (str): The path of the file, whose directory is created if needed.
+        write (callable): Writes the content to the temporary path it is called with.
+        suffix (str): The suffix of the temporary path, for writers that append an
+            extension to paths without it, like `np.savez`.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
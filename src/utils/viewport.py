@@ -0,0 +1,29 @@
+class Viewport():
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+
+    def __repr__(self) -> str:
+        return f"{self.width}x{self.height}"
+    
+    def __str__(self) -> str:
+        return f"{self.width}x{self.height}"
+    
+    def __eq__(self, value):
+        if isinstance(value, Viewport):
+            return self.width == value.width and self.height == value.height
+        return False
+
+    def __hash__(self):
+        return hash((self.width, self.height))
+    
+    def to_dict(self) -> dict:
+        return {
+            "width": self.width,
+            "height": self.height
+        }
+    
+    @staticmethod
+    def from_str(viewport_str: str) -> 'Viewport':
+        width, height = map(int, viewport_str.split('x'))
+        return Viewport(width, height)